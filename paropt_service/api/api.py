@@ -9,18 +9,23 @@ import os
 from threading import Thread 
 import json
 import traceback
+import datetime
 
-from flask import Blueprint, jsonify, request, abort, current_app
+from flask import Blueprint, jsonify, request, abort, current_app, Response, stream_with_context
+from flask import json as flask_json
 
 import psycopg2
 
 import redis
 from rq import Queue, Connection
 
-from .utils import login_required
+from .utils import login_required, currentUser, getTokenCache
+from . import job_fetch, export, events
 
 from .paropt_manager import ParoptManager
 
+from config import JOBS_PAGE_SIZE, JOBS_MAX_PAGE_SIZE, TRIALS_PAGE_SIZE, TRIALS_MAX_PAGE_SIZE, BATCH_MAX_SIZE
+
 import paropt
 from paropt.runner import ParslRunner
 from paropt.storage import LocalFile, RelationalDB
@@ -64,6 +69,33 @@ def getOrCreateExperiment():
         print(traceback.format_exc())
         return "Failed to get/create experiment: {}".format(e), 500
 
+def _batchRequestData(item_name):
+    """Returns the json list of a batch request, or an error response if it isn't one"""
+    request_data = request.get_json()
+    if not isinstance(request_data, list):
+        return None, ("Must include a json list of {} and content type header".format(item_name), 400)
+    if len(request_data) > BATCH_MAX_SIZE:
+        return None, ("Batches are limited to {} {}".format(BATCH_MAX_SIZE, item_name), 400)
+    return request_data, None
+
+@api.route('/experiments/batch', methods=['POST'])
+@login_required
+def getOrCreateExperiments():
+    """Get or create several experiments in one request and database transaction
+    Expects a json list of experiments, each as for `POST /experiments`. Returns a list with the result of
+    each experiment in order: `{"status": "success", "experiment": <experiment>}` or
+    `{"status": "failed", "message": <why>}`.
+    """
+    request_data, error = _batchRequestData('experiments')
+    if error != None:
+        return error
+    try:
+        return jsonify(ParoptManager.getOrCreateExperiments(request_data)), 200
+    except psycopg2.OperationalError as e:
+        print("DB Error: {}".format(e))
+        print(traceback.format_exc())
+        return "Failed to get/create experiments due to database error. Please retry your request", 500
+
 @api.route('/experiments/<int:experiment_id>', methods=['GET'])
 @login_required
 def getExperiment(experiment_id):
@@ -75,12 +107,189 @@ def getExperiment(experiment_id):
     experiment['job'] = ParoptManager.jobToDict(ParoptManager.getRunningExperiment(experiment_id))
     return jsonify(experiment), 200
 
+def _numberArg(name, type):
+    """Parse an optional int or float query arg, raising ValueError if it's malformed"""
+    value = request.args.get(name)
+    if value == None:
+        return None
+    try:
+        return type(value)
+    except ValueError:
+        raise ValueError("{} must be {}".format(name, 'an integer' if type == int else 'a number'))
+
+def _timestampArg(name):
+    """Parse an optional unix seconds query arg as a UTC datetime, raising ValueError if it's malformed"""
+    seconds = _numberArg(name, float)
+    if seconds == None:
+        return None
+    try:
+        return datetime.datetime.utcfromtimestamp(seconds)
+    except (OverflowError, OSError, ValueError):
+        raise ValueError("{} must be a unix timestamp".format(name))
+
+def _trialQueryArgs():
+    """Parse filtering and sorting query args of the trials endpoints, raising ValueError if any is malformed
+    ```
+    after_id=<trial id>              only trials after this id (keyset pagination)
+    min_objective=<float>            only trials with outcome >= min_objective
+    max_objective=<float>            only trials with outcome <= max_objective
+    since=<unix seconds>             only trials recorded at or after this time
+    until=<unix seconds>             only trials recorded before this time
+    sort=id | objective              order of trials (default id)
+    order=asc | desc                 direction of objective sort (default asc)
+    ```
+    """
+    args = request.args
+    sort = args.get('sort', 'id')
+    if sort not in ('id', 'objective'):
+        raise ValueError("sort must be 'id' or 'objective'")
+    order = args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise ValueError("order must be 'asc' or 'desc'")
+    return {
+        'after_id': _numberArg('after_id', int),
+        'min_objective': _numberArg('min_objective', float),
+        'max_objective': _numberArg('max_objective', float),
+        'since': _timestampArg('since'),
+        'until': _timestampArg('until'),
+        'sort': sort,
+        'descending': order == 'desc',
+    }
+
+def _wantsNDJSON():
+    return (request.args.get('format') == 'ndjson'
+            or request.accept_mimetypes.best == 'application/x-ndjson')
+
 @api.route('/experiments/<int:experiment_id>/trials', methods=['GET'])
 @login_required
 def getTrials(experiment_id):
-    """Get all recorded trials for experiment"""
-    trials = ParoptManager.getTrials(experiment_id)
-    return jsonify(trials), 200
+    """Get recorded trials for experiment
+    Filters and sorting are described in `_trialQueryArgs`. Returns all matching trials as a json list, or
+    with `limit` or `after_id`, a page of up to `limit` trials; if there may be more trials, the
+    `X-Next-After-Id` header holds the `after_id` of the next page.
+    With `sort=objective`, `top=<k>` returns the best k trials.
+    With `format=ndjson` (or `Accept: application/x-ndjson`), all matching trials are streamed as
+    newline delimited json, up to `limit` if given.
+    """
+    try:
+        query_args = _trialQueryArgs()
+        limit = _numberArg('top' if query_args['sort'] == 'objective' else 'limit', int)
+        if limit != None and limit < 1:
+            raise ValueError("limit and top must be > 0")
+    except ValueError as e:
+        return "Invalid trials query: {}".format(e), 400
+
+    if _wantsNDJSON():
+        def generateTrials():
+            for trial in ParoptManager.iterTrials(experiment_id, limit=limit, **query_args):
+                yield flask_json.dumps(trial) + '\n'
+        return Response(stream_with_context(generateTrials()), mimetype='application/x-ndjson')
+
+    # clients which don't page get every trial, as before pagination was added
+    if limit == None and query_args['after_id'] == None:
+        return jsonify(ParoptManager.getTrials(experiment_id, **query_args)), 200
+    limit = min(limit if limit != None else TRIALS_PAGE_SIZE, TRIALS_MAX_PAGE_SIZE)
+    trials = ParoptManager.getTrials(experiment_id, limit=limit, **query_args)
+    response = jsonify(trials)
+    if query_args['sort'] == 'id' and len(trials) == limit:
+        response.headers['X-Next-After-Id'] = str(trials[-1]['id'])
+    return response, 200
+
+@api.route('/experiments/<int:experiment_id>/trials/summary', methods=['GET'])
+@login_required
+def getTrialSummary(experiment_id):
+    """Get the number of recorded trials of experiment, the best objective and when the last trial was recorded
+    Summaries are cached until the experiment's next trial is recorded.
+    """
+    if ParoptManager.getExperimentDict(experiment_id) == None:
+        return "No experiment with id {}".format(experiment_id), 404
+    return jsonify(ParoptManager.getTrialSummary(experiment_id)), 200
+
+@api.route('/experiments/<int:experiment_id>/pareto', methods=['GET'])
+@login_required
+def getParetoFront(experiment_id):
+    """Get the trials on the pareto front of runtime against EC2 cost
+    With `scope=tool` (default) the experiment is compared with the experiments running the same tool on
+    other instance models; with `scope=experiment` the front is the experiment's fastest trial.
+    """
+    scope = request.args.get('scope', 'tool')
+    if scope not in ('tool', 'experiment'):
+        return "scope must be 'tool' or 'experiment'", 400
+    front = ParoptManager.getParetoFront(experiment_id, scope=scope)
+    if front == None:
+        return "No experiment with id {}".format(experiment_id), 404
+    return jsonify(front), 200
+
+@api.route('/experiments/<int:experiment_id>/events', methods=['GET'])
+@login_required
+def streamExperimentEvents(experiment_id):
+    """Stream job status changes and newly recorded trials of experiment as server-sent events
+    The stream starts with a `job` event of the experiment's current job, if any. `job` events hold the job's
+    id, status and meta (plus its result or error once it ends), `progress` events the job's progress, and
+    `trial` events hold a trial with its id as the event id. To catch up on trials recorded while disconnected, reconnect with the `Last-Event-ID` header
+    (sent by EventSource automatically) or `after_id=<trial id>`.
+    The server closes streams after EVENTS_MAX_SECONDS; clients are expected to reconnect.
+    Responds 503 when the server process already has EVENTS_MAX_STREAMS streams open.
+    """
+    after_id = request.headers.get('Last-Event-ID', request.args.get('after_id'))
+    try:
+        after_id = int(after_id) if after_id != None else None
+    except ValueError:
+        return "Invalid after_id or Last-Event-ID", 400
+    if ParoptManager.getExperimentDict(experiment_id) == None:
+        return "No experiment with id {}".format(experiment_id), 404
+    stream = ParoptManager.streamEvents(experiment_id, after_id=after_id)
+    if stream == None:
+        return "Too many open event streams, try again later", 503
+
+    def generateEvents():
+        for event, data in stream:
+            yield events.formatSSE(event, data)
+    response = Response(stream_with_context(generateEvents()), mimetype='text/event-stream')
+    # closes the stream even if the client went away before it was iterated
+    response.call_on_close(stream.close)
+    response.headers['Cache-Control'] = 'no-cache'
+    # don't let proxies buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@api.route('/experiments/<int:experiment_id>/trials/export', methods=['GET'])
+@login_required
+def exportTrials(experiment_id):
+    """Export trials of experiment as columns
+    `format` is one of `csv` (default), `arrow` (Arrow IPC stream) or `npz` (numpy archive); arrow and npz
+    require pyarrow and numpy on the server. Accepts the same filters as getTrials and an optional `limit`.
+    See `export` for the columns.
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in export.EXPORT_FORMATS:
+        return "Invalid export format '{}' - must be one of {}".format(export_format, list(export.EXPORT_FORMATS)), 400
+    if export_format not in export.availableFormats():
+        return "Export format '{}' is not supported by this server".format(export_format), 501
+    try:
+        query_args = _trialQueryArgs()
+        limit = _numberArg('limit', int)
+        if limit != None and limit < 1:
+            raise ValueError("limit must be > 0")
+    except ValueError as e:
+        return "Invalid trials query: {}".format(e), 400
+
+    experiment = ParoptManager.getExperimentDict(experiment_id)
+    if experiment == None:
+        return "No experiment with id {}".format(experiment_id), 404
+    columns = export.trialColumns(experiment)
+    row_chunks = ParoptManager.iterTrialChunks(
+        experiment_id,
+        limit=limit,
+        convert=export.trialRowConverter(experiment),
+        **query_args)
+
+    mimetype = export.EXPORT_FORMATS[export_format]
+    headers = {'Content-Disposition': 'attachment; filename=experiment_{}_trials.{}'.format(experiment_id, export_format)}
+    if export_format == 'npz':
+        return Response(export.buildNPZ(columns, row_chunks), mimetype=mimetype, headers=headers)
+    iter_export = export.iterCSV if export_format == 'csv' else export.iterArrow
+    return Response(stream_with_context(iter_export(columns, row_chunks)), mimetype=mimetype, headers=headers)
 
 @api.route('/experiments/<int:experiment_id>/trials', methods=['POST'])
 @login_required
@@ -92,48 +301,106 @@ def runTrials(experiment_id):
         "optimizer": {
             "type": "bayesopt" | "grid",
             [optimizer_specific_params]
+        },
+        "concurrency": <number of trials to run at once, default 1>,
+        "priority": "high" | "default" | "low",
+        "cache": {
+            "ttl": <max age in seconds of stored trials to reuse, default no limit>,
+            "force": <true to re-measure configurations that already have trials, default false>
         }
     }
     ```
+    The optimizer config can also have stopping rules, ending the run before the optimizer is exhausted
+    once any of them is met:
+    ```
+    "stopping": {
+        "patience": <stop after this many trials without improvement>,
+        "target": <stop once a trial's runtime is at or below this>,
+        "max_seconds": <stop once the run has taken this many seconds>,
+        "max_cost": <stop once the run's EC2 instances have cost this many USD>
+    }
+    ```
     """
     request_data = request.get_json()
     request_data = request_data if request_data != None else {}
 
-    result = ParoptManager.runTrials(experiment_id, request_data)
+    result = ParoptManager.runTrials(experiment_id, request_data, user=currentUser())
     if result['status'] == 'submitted':
         return jsonify(result), 202
     return jsonify(result), 400
 
+@api.route('/experiments/batch/trials', methods=['POST'])
+@login_required
+def runTrialsBatch():
+    """Run trials for several experiments in one request
+    Expects a json list of run configs, each as for `POST /experiments/<experiment_id>/trials` plus the
+    `experiment_id` to run. Returns a list with the result of each run in order, as returned by that endpoint:
+    `{"status": "submitted", "job": <job>}` or `{"status": "failed", "message": <why>}`.
+    """
+    request_data, error = _batchRequestData('runs')
+    if error != None:
+        return error
+    if not all(isinstance(run_config, dict) for run_config in request_data):
+        return "Each run config must be a json object", 400
+    results = ParoptManager.runTrialsBatch(request_data, user=currentUser())
+    status = 400 if len(results) > 0 and all(result['status'] == 'failed' for result in results) else 202
+    return jsonify(results), status
+
+def _jobListArgs():
+    """Parse pagination and projection query args of the job listing endpoints
+    Supports `?cursor=<cursor>&limit=<limit>&fields=result,exc_info`. `job_id` is always included;
+    `fields` defaults to status and meta. All jobs are returned unless `cursor` or `limit` is passed.
+    The cursor is an offset into the registry or queues, so pages can skip or repeat jobs as they change.
+    """
+    fields = job_fetch.parseFields(request.args.get('fields'))
+    if 'cursor' not in request.args and 'limit' not in request.args:
+        return 0, None, fields
+    cursor = int(request.args.get('cursor', 0))
+    limit = int(request.args.get('limit', JOBS_PAGE_SIZE))
+    if cursor < 0 or limit < 1:
+        raise ValueError("cursor must be >= 0 and limit must be > 0")
+    return cursor, min(limit, JOBS_MAX_PAGE_SIZE), fields
+
+def _listJobs(list_jobs):
+    """Respond with the jobs, or a page of them. The cursor for the next page is returned in the X-Next-Cursor header"""
+    try:
+        cursor, limit, fields = _jobListArgs()
+    except ValueError as e:
+        return "Invalid job listing arguments: {}".format(e), 400
+    jobs, next_cursor = list_jobs(cursor=cursor, limit=limit, fields=fields)
+    response = jsonify(jobs)
+    if next_cursor != None:
+        response.headers['X-Next-Cursor'] = str(next_cursor)
+    return response
+
 @api.route('/jobs/running', methods=['GET'])
 @login_required
 def getRunningExperiments():
     """Get currently running experiments"""
-    running_exps = ParoptManager.getRunningExperiments()
-    running_exps = [ParoptManager.jobToDict(job) for job in running_exps]
-    return jsonify(running_exps)
+    return _listJobs(ParoptManager.getRunningExperiments)
 
 @api.route('/jobs/failed', methods=['GET'])
 @login_required
 def getFailedExperiments():
     """Get failed experiments"""
-    failed_exps = ParoptManager.getFailedExperiments()
-    failed_exps = [ParoptManager.jobToDict(job) for job in failed_exps]
-    return jsonify(failed_exps)
+    return _listJobs(ParoptManager.getFailedExperiments)
 
 @api.route('/jobs/queued', methods=['GET'])
 @login_required
 def getQueuedExperiments():
     """Get queued jobs"""
-    queued_exps = ParoptManager.getQueuedJobs()
-    queued_exps = [ParoptManager.jobToDict(job) for job in queued_exps]
-    return jsonify(queued_exps)
+    return _listJobs(ParoptManager.getQueuedJobs)
 
 @api.route('/experiments/<int:experiment_id>/stop', methods=['POST'])
 @login_required
 def stopExperiment(experiment_id):
-    """Stop a running experiment"""
+    """Stop a running experiment, or cancel it if it's queued"""
     stop_res = ParoptManager.stopExperiment(experiment_id)
-    return jsonify(stop_res)
+    if stop_res['status'] == 'failed':
+        return jsonify(stop_res), 404
+    if stop_res['status'] == 'pending':
+        return jsonify(stop_res), 409
+    return jsonify(stop_res), 202 if stop_res['status'] == 'stopping' else 200
 
 @api.route('/experiments/<int:experiment_id>/job', methods=['GET'])
 @login_required
@@ -154,3 +421,22 @@ def getJob(job_id):
         return jsonify({'status': 'missing', 'job': job_dict}), 404
     else:
         return jsonify({'status': 'success', 'job': job_dict}), 200
+
+@api.route('/jobs/<string:job_id>/result', methods=['GET'])
+@login_required
+def getRunResult(job_id):
+    """Get the full result of a job's run, with the message of each trial
+    The job's `job_result` is only a summary of it.
+    """
+    run_result = ParoptManager.getRunResult(job_id)
+    if run_result == None:
+        return jsonify({'status': 'missing', 'run_result': None}), 404
+    return jsonify({'status': 'success', 'run_result': run_result}), 200
+
+@api.route('/stats', methods=['GET'])
+@login_required
+def getStats():
+    """Get usage stats of the server process, eg redis connection pool usage"""
+    stats = ParoptManager.getStats()
+    stats['token_cache'] = getTokenCache().stats()
+    return jsonify(stats)
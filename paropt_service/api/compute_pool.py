@@ -0,0 +1,159 @@
+import logging
+import threading
+
+import parsl
+
+logger = logging.getLogger(__name__)
+
+# redis hash of reuse counters, summed over all workers
+STATS_KEY = 'paropt:compute_pool'
+
+class ComputePool():
+  """Keeps a worker process's parsl DataFlowKernel, and the blocks it launched, alive between runs
+
+  A run with the same compute spec (eg instance model and AMI) as the previous run of the worker reuses
+  its warm blocks instead of waiting for new instances to boot and run worker_init. parsl loads one
+  DataFlowKernel per process, so the pool holds at most one; a run with a different spec replaces it.
+  Blocks which stay idle for longer than `idle_timeout` seconds are shut down.
+  """
+  def __init__(self, idle_timeout, on_shutdown=None):
+    """
+    Args:
+      idle_timeout(float): seconds to keep idle blocks alive for the next run
+      on_shutdown(callable): called after the pool's blocks are shut down
+    """
+    self.idle_timeout = idle_timeout
+    self.on_shutdown = on_shutdown
+    self._lock = threading.Lock()
+    self._dfk = None
+    self._key = None
+    self._blocks = 0
+    self._startup_seconds = None
+    self._in_use = False
+    self._idle_timer = None
+
+  def acquire(self, key, parsl_config, blocks):
+    """Get a loaded DataFlowKernel for running trials on a compute spec
+
+    Args:
+      key(tuple): compute spec the blocks were launched with
+      parsl_config(Config): config to load when there are no warm blocks for key
+      blocks(int): number of blocks needed
+
+    Returns:
+      dfk(DataFlowKernel): loaded DataFlowKernel
+      reused(bool): True if the blocks were already warm
+    """
+    with self._lock:
+      if self._in_use:
+        raise Exception('Compute pool is already in use')
+      self._cancelIdleTimer()
+      reused = self._matches(key, blocks)
+      if not reused:
+        self._shutdown()
+        self._dfk = parsl.load(parsl_config)
+        self._key = key
+        self._blocks = blocks
+      self._in_use = True
+      return self._dfk, reused
+
+  def isWarm(self, key, blocks):
+    """Returns True if acquiring blocks for key would reuse warm blocks"""
+    with self._lock:
+      return self._matches(key, blocks)
+
+  def _matches(self, key, blocks):
+    return self._dfk != None and self._key == key and self._blocks >= blocks
+
+  def holdsBlocks(self):
+    return self._dfk != None
+
+  def startupSeconds(self):
+    """Returns seconds the warm blocks took to start; None if unknown"""
+    return self._startup_seconds
+
+  def recordStartup(self, seconds):
+    """Record how long the blocks took to start, ie the time saved each time they're reused"""
+    with self._lock:
+      self._startup_seconds = seconds
+
+  def release(self, discard=False):
+    """Return the DataFlowKernel to the pool after a run
+
+    Args:
+      discard(bool): shut the blocks down now, eg if the run failed in a way that may have broken them
+    """
+    with self._lock:
+      self._in_use = False
+      if discard:
+        self._shutdown()
+      elif self._dfk != None:
+        self._idle_timer = threading.Timer(self.idle_timeout, self._expire)
+        self._idle_timer.daemon = True
+        self._idle_timer.start()
+
+  def shutdown(self):
+    """Shut down the pool's blocks"""
+    with self._lock:
+      self._cancelIdleTimer()
+      self._shutdown()
+
+  def _expire(self):
+    with self._lock:
+      # the timer may have been replaced while waiting for the lock
+      if self._in_use or self._idle_timer is not threading.current_thread():
+        return
+      logger.info('Shutting down blocks of {} after {} idle seconds'.format(self._key, self.idle_timeout))
+      self._idle_timer = None
+      self._shutdown()
+
+  def _cancelIdleTimer(self):
+    if self._idle_timer != None:
+      self._idle_timer.cancel()
+      self._idle_timer = None
+
+  def _shutdown(self):
+    if self._dfk == None:
+      return
+    try:
+      self._dfk.cleanup()
+    finally:
+      parsl.clear()
+      self._dfk = None
+      self._key = None
+      self._blocks = 0
+      self._startup_seconds = None
+      if self.on_shutdown != None:
+        self.on_shutdown()
+
+def recordRun(conn, compute_result):
+  """Add a run's use of the pool to the shared counters
+
+  Args:
+    conn(Redis): redis connection
+    compute_result(dict): the run's `compute` result, see ConcurrentRunner
+  """
+  pipeline = conn.pipeline(transaction=False)
+  pipeline.hincrby(STATS_KEY, 'runs', 1)
+  if compute_result['reused']:
+    pipeline.hincrby(STATS_KEY, 'reused', 1)
+    if compute_result.get('saved_seconds') != None:
+      pipeline.hincrbyfloat(STATS_KEY, 'startup_seconds_saved', compute_result['saved_seconds'])
+  elif compute_result.get('startup_seconds') != None:
+    pipeline.hincrby(STATS_KEY, 'startups', 1)
+    pipeline.hincrbyfloat(STATS_KEY, 'startup_seconds', compute_result['startup_seconds'])
+  pipeline.execute()
+
+def getStats(conn):
+  """Returns reuse stats of the workers' compute pools"""
+  counters = {k.decode(): float(v) for k, v in conn.hgetall(STATS_KEY).items()}
+  runs = int(counters.get('runs', 0))
+  reused = int(counters.get('reused', 0))
+  startups = int(counters.get('startups', 0))
+  return {
+    'runs': runs,
+    'reused': reused,
+    'reuse_rate': reused / runs if runs > 0 else None,
+    'avg_startup_seconds': counters.get('startup_seconds', 0.0) / startups if startups > 0 else None,
+    'startup_seconds_saved': counters.get('startup_seconds_saved', 0.0),
+  }
@@ -0,0 +1,108 @@
+"""Database connection pool shared by the threads of a process
+
+paropt's RelationalDB makes an engine with default pool settings when it's constructed; the manager makes its
+storage with an engine made here instead (see pooledStorage), once per process, so API requests and runs check
+out pooled connections rather than each connecting.
+"""
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+class StatsQueuePool(QueuePool):
+  """SQLAlchemy connection pool which keeps checkout stats
+
+  Callers block up to `timeout` seconds for a free connection once `pool_size + max_overflow` are checked out.
+  """
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self._stats_lock = threading.Lock()
+    self._checkouts = 0
+    self._checkout_errors = 0
+    self._checkout_wait_seconds = 0.0
+    self._max_checkout_wait_seconds = 0.0
+
+  def _do_get(self):
+    start = time.time()
+    try:
+      connection = super()._do_get()
+    except Exception:
+      # no connection freed up within the timeout, or connecting failed
+      with self._stats_lock:
+        self._checkout_errors += 1
+      raise
+    waited = time.time() - start
+    with self._stats_lock:
+      self._checkouts += 1
+      self._checkout_wait_seconds += waited
+      self._max_checkout_wait_seconds = max(self._max_checkout_wait_seconds, waited)
+    return connection
+
+  def stats(self):
+    """Returns pool usage as a dict"""
+    with self._stats_lock:
+      return {
+        'pool_size': self.size(),
+        'checked_out_connections': self.checkedout(),
+        'idle_connections': self.checkedin(),
+        'overflow_connections': max(0, self.overflow()),
+        'checkouts': self._checkouts,
+        'checkout_errors': self._checkout_errors,
+        'avg_checkout_wait_seconds': self._checkout_wait_seconds / self._checkouts if self._checkouts else 0.0,
+        'max_checkout_wait_seconds': self._max_checkout_wait_seconds,
+      }
+
+def createEngine(url, pool_size, max_overflow, timeout, recycle, pre_ping):
+  """Create an engine with a StatsQueuePool, for one process
+
+  Connections made before a fork aren't used by the forked process (eg an RQ work horse): they're
+  discarded on checkout and replaced with new ones, leaving the parent's connections alone.
+
+  Args:
+    url(str): database url
+    pool_size(int): connections kept open
+    max_overflow(int): connections opened beyond pool_size when all are checked out
+    timeout(float): seconds to wait for a free connection
+    recycle(float): seconds after which a connection is replaced; -1 for never
+    pre_ping(bool): test connections with a ping when checked out, replacing dead ones
+  """
+  engine = create_engine(
+    url,
+    poolclass=StatsQueuePool,
+    pool_size=pool_size,
+    max_overflow=max_overflow,
+    pool_timeout=timeout,
+    pool_recycle=recycle,
+    pool_pre_ping=pre_ping)
+
+  @event.listens_for(engine, 'connect')
+  def connect(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+  @event.listens_for(engine, 'checkout')
+  def checkout(dbapi_connection, connection_record, connection_proxy):
+    if connection_record.info['pid'] != os.getpid():
+      connection_record.connection = connection_proxy.connection = None
+      raise exc.DisconnectionError('Connection belongs to pid {}, not {}'.format(
+        connection_record.info['pid'], os.getpid()))
+
+  return engine
+
+def pooledStorage(storage_class, engine, metadata):
+  """Make a paropt RelationalDB on a pooled engine, skipping its constructor and the engine it would make
+
+  Sets up what the constructor does: the storage's tables, its `engine` and its `Session` factory.
+
+  Args:
+    storage_class(type): RelationalDB, or a subclass of it
+    engine(Engine): engine made with createEngine
+    metadata(MetaData): metadata of the storage's tables, eg Trial.metadata
+  """
+  storage = storage_class.__new__(storage_class)
+  metadata.create_all(engine)
+  storage.engine = engine
+  storage.Session = sessionmaker(bind=engine)
+  return storage
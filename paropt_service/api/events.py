@@ -0,0 +1,180 @@
+"""Push of experiment events to clients: job status changes, job progress and recorded trials
+
+Events are published to a redis pub/sub channel per experiment by whichever process causes them (the API
+when a job is enqueued or stopped, workers as jobs run), and streamed to clients as server-sent events.
+Pub/sub doesn't keep messages, so clients catch up on trials they missed from the database, see streamEvents.
+
+Each open stream holds a server thread and a redis connection of its own for as long as the client stays
+connected, so a process only serves a limited number of streams at once (see StreamLimit).
+"""
+import json
+import threading
+import time
+
+CHANNEL_TEMPLATE = 'paropt:events:{}'
+
+def _dumps(data):
+  # trial timestamps are datetimes
+  return json.dumps(data, default=str)
+
+def publish(conn, experiment_id, event, data):
+  """Publish an event to the experiment's subscribers
+
+  Args:
+    conn(Redis): redis connection
+    experiment_id(str): id of the experiment
+    event(str): 'job', 'trial' or 'progress'
+    data(dict): job, trial or progress dict
+  """
+  conn.publish(CHANNEL_TEMPLATE.format(experiment_id), _dumps({'event': event, 'data': data}))
+
+def jobEvent(job, status=None):
+  """Returns the data of a job status event, a subset of the job dict of the API"""
+  status = status if status != None else job.get_status()
+  data = {'job_id': job.id, 'job_status': status, 'job_meta': job.meta}
+  if status == 'finished':
+    data['job_result'] = job.result
+  elif status == 'failed':
+    data['job_exc_info'] = job.exc_info
+  return data
+
+def publishJob(conn, job, status=None):
+  """Publish the status of an experiment's job
+
+  Args:
+    conn(Redis): redis connection
+    job(Job): job with an experiment_id in its meta
+    status(str): status to publish; None for the job's current status
+  """
+  experiment_id = job.meta.get('experiment_id')
+  if experiment_id != None:
+    publish(conn, experiment_id, 'job', jobEvent(job, status))
+
+def publishProgress(conn, job, progress):
+  """Publish the progress of an experiment's job, see progress.ProgressReporter"""
+  experiment_id = job.meta.get('experiment_id')
+  if experiment_id != None:
+    publish(conn, experiment_id, 'progress', dict(progress, job_id=job.id))
+
+def streamEvents(conn, experiment_id, catch_up=None, after_id=None, snapshot=None, keepalive=15, max_seconds=None):
+  """Yield events of an experiment as they're published
+
+  Subscribes before catching up, so no event is missed between the two; trials sent while catching up are
+  skipped when they're published again.
+
+  Args:
+    conn(Redis): redis connection
+    experiment_id(str): id of the experiment
+    catch_up(callable): returns an iterable of trial dicts recorded before subscribing; None to skip
+    after_id(int): id of the last trial the client already has, whose published trials up to it are skipped
+    snapshot(callable): returns the current job event data, or None if there's no job; None to skip
+    keepalive(float): seconds between keep-alive comments while there are no events
+    max_seconds(float): seconds to stream for before returning, so clients reconnect; None for no limit
+
+  Yields:
+    event(str): 'job', 'trial', 'progress', or None for a keep-alive
+    data(dict): event data
+  """
+  pubsub = conn.pubsub(ignore_subscribe_messages=True)
+  pubsub.subscribe(CHANNEL_TEMPLATE.format(experiment_id))
+  try:
+    last_trial_id = after_id
+    if catch_up != None:
+      for trial in catch_up():
+        last_trial_id = trial['id']
+        yield 'trial', trial
+    if snapshot != None:
+      job = snapshot()
+      if job != None:
+        yield 'job', job
+    started_at = time.time()
+    last_sent_at = started_at
+    while max_seconds == None or time.time() - started_at < max_seconds:
+      message = pubsub.get_message(timeout=1.0)
+      if message == None:
+        if time.time() - last_sent_at >= keepalive:
+          last_sent_at = time.time()
+          yield None, None
+        continue
+      event = json.loads(message['data'])
+      if event['event'] == 'trial' and last_trial_id != None and event['data']['id'] <= last_trial_id:
+        continue
+      last_sent_at = time.time()
+      yield event['event'], event['data']
+  finally:
+    pubsub.close()
+
+class StreamLimit():
+  """Thread-safe cap on the event streams a process has open at once"""
+  def __init__(self, max_streams):
+    """
+    Args:
+      max_streams(int): max number of streams open at once
+    """
+    self.max_streams = max_streams
+    self._lock = threading.Lock()
+    self._open = 0
+    self._rejected = 0
+
+  def acquire(self):
+    """Take a slot for a stream; returns False if all are taken"""
+    with self._lock:
+      if self._open >= self.max_streams:
+        self._rejected += 1
+        return False
+      self._open += 1
+      return True
+
+  def release(self):
+    with self._lock:
+      self._open -= 1
+
+  def stats(self):
+    with self._lock:
+      return {'open': self._open, 'max': self.max_streams, 'rejected': self._rejected}
+
+class EventStream():
+  """Events of an experiment (see streamEvents) read from a redis client of the stream's own
+
+  Iterate it for the events. Close it once the client is gone, whether or not it was iterated, to unsubscribe,
+  disconnect its redis client and call `on_close`; closing more than once is a no-op.
+  """
+  def __init__(self, conn, experiment_id, on_close=None, **kwargs):
+    """
+    Args:
+      conn(Redis): redis client used by this stream only
+      experiment_id(str): id of the experiment
+      on_close(callable): called once the stream is closed, eg to release its StreamLimit slot
+      kwargs: see streamEvents
+    """
+    self._conn = conn
+    self._on_close = on_close
+    self._events = streamEvents(conn, experiment_id, **kwargs)
+    self._lock = threading.Lock()
+    self._closed = False
+
+  def __iter__(self):
+    return self._events
+
+  def close(self):
+    with self._lock:
+      if self._closed:
+        return
+      self._closed = True
+    try:
+      self._events.close()
+      self._conn.connection_pool.disconnect()
+    finally:
+      if self._on_close != None:
+        self._on_close()
+
+def formatSSE(event, data):
+  """Returns an event as a server-sent event message; trials are sent with their id as the event id"""
+  if event == None:
+    return ': keep-alive\n\n'
+  lines = []
+  if event == 'trial':
+    lines.append('id: {}'.format(data['id']))
+  lines.append('event: {}'.format(event))
+  lines.append('data: {}'.format(_dumps(data)))
+  return '\n'.join(lines) + '\n\n'
@@ -0,0 +1,110 @@
+"""Columnar export of experiment trials
+
+Trials are exported as one column per experiment parameter plus id, objective and timing columns:
+```
+trial_id, run_number, <parameter 1>, ..., <parameter n>, objective, timestamp
+```
+`timestamp` is unix seconds (UTC). CSV and Arrow IPC exports are streamed one chunk of trials at a time;
+.npz exports are built in memory as numpy arrays since the format can't be written incrementally.
+Arrow and numpy exports are only available when pyarrow and numpy are installed.
+"""
+import calendar
+import csv
+import io
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+try:
+  import pyarrow as pa
+except ImportError:
+  pa = None
+
+EXPORT_FORMATS = {
+  'csv': 'text/csv',
+  'arrow': 'application/vnd.apache.arrow.stream',
+  'npz': 'application/octet-stream',
+}
+_INT_COLUMNS = ('trial_id', 'run_number')
+
+def availableFormats():
+  """Returns export formats supported by the installed libraries"""
+  formats = ['csv']
+  if pa != None:
+    formats.append('arrow')
+  if np != None:
+    formats.append('npz')
+  return formats
+
+def trialColumns(experiment_dict):
+  """Returns column names of an experiment's trial export"""
+  parameter_names = [param['name'] for param in experiment_dict['parameters']]
+  return ['trial_id', 'run_number'] + parameter_names + ['objective', 'timestamp']
+
+def trialRowConverter(experiment_dict):
+  """Returns a function converting a Trial to a row tuple in the order of trialColumns"""
+  parameter_names = [param['name'] for param in experiment_dict['parameters']]
+
+  def toRow(trial):
+    values = {config.parameter.name: config.value for config in trial.parameter_configs}
+    timestamp = calendar.timegm(trial.timestamp.utctimetuple()) if trial.timestamp != None else None
+    return (
+      (trial.id, trial.run_number)
+      + tuple(values.get(name) for name in parameter_names)
+      + (trial.outcome, timestamp)
+    )
+  return toRow
+
+def iterCSV(columns, row_chunks):
+  """Yields CSV text, one chunk of rows at a time"""
+  buf = io.StringIO()
+  writer = csv.writer(buf)
+  writer.writerow(columns)
+  for rows in row_chunks:
+    writer.writerows(rows)
+    yield buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+  # header only, when there are no trials
+  if buf.tell() > 0:
+    yield buf.getvalue()
+
+def _arrowSchema(columns):
+  fields = [pa.field('trial_id', pa.int64()), pa.field('run_number', pa.int64())]
+  fields += [pa.field(name, pa.float64()) for name in columns[2:-1]]
+  fields.append(pa.field('timestamp', pa.float64()))
+  return pa.schema(fields)
+
+def iterArrow(columns, row_chunks):
+  """Yields an Arrow IPC stream, one record batch per chunk of rows"""
+  schema = _arrowSchema(columns)
+  sink = io.BytesIO()
+  writer = pa.ipc.new_stream(sink, schema)
+  for rows in row_chunks:
+    arrays = [pa.array(list(column), type=field.type) for column, field in zip(zip(*rows), schema)]
+    writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+    yield sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+  writer.close()
+  yield sink.getvalue()
+
+def _npzColumn(name, values):
+  if name in _INT_COLUMNS:
+    # missing values become -1 in int columns
+    return np.array([-1 if value == None else value for value in values], dtype=np.int64)
+  # and nan in float columns
+  return np.array([np.nan if value == None else value for value in values], dtype=np.float64)
+
+def buildNPZ(columns, row_chunks):
+  """Returns an .npz archive with one array per column"""
+  chunk_arrays = {name: [_npzColumn(name, [])] for name in columns}
+  for rows in row_chunks:
+    for name, values in zip(columns, zip(*rows)):
+      chunk_arrays[name].append(_npzColumn(name, values))
+  arrays = {name: np.concatenate(chunks) for name, chunks in chunk_arrays.items()}
+  buf = io.BytesIO()
+  np.savez_compressed(buf, **arrays)
+  return buf.getvalue()
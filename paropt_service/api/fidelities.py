@@ -0,0 +1,51 @@
+"""Fidelity parameters of experiments run with multi-fidelity optimizers, kept in the database
+
+Multi-fidelity optimizers (see optimizers.HyperbandOptimizer) run most trials at a reduced value of a fidelity
+parameter, eg on part of the input, so their runtimes aren't comparable with full runs. Experiments record
+which of their parameters were used as a fidelity, and a trial only counts towards objective aggregates (best
+objective, stopping rules, warm starts, pareto fronts) if it ran at the maximum of each of them.
+"""
+from sqlalchemy import Column, Integer, String, and_, exists
+from sqlalchemy.ext.declarative import declarative_base
+
+from paropt.storage.entities import Parameter, ParameterConfig, Trial
+
+Base = declarative_base()
+
+class ExperimentFidelity(Base):
+  __tablename__ = 'experiment_fidelities'
+  experiment_id = Column(Integer, primary_key=True)
+  parameter = Column(String(255), primary_key=True)
+
+def createTables(engine):
+  """Create the experiment fidelities table if it doesn't exist"""
+  Base.metadata.create_all(engine)
+
+def recordFidelity(session, experiment_id, parameter):
+  """Record that an experiment is run with a parameter as its fidelity"""
+  session.merge(ExperimentFidelity(experiment_id=int(experiment_id), parameter=parameter))
+  session.commit()
+
+def getFidelities(session, experiment_id):
+  """Returns the names of the parameters an experiment has been run with as its fidelity"""
+  rows = session.query(ExperimentFidelity.parameter).filter(ExperimentFidelity.experiment_id == int(experiment_id))
+  return set(parameter for parameter, in rows)
+
+def isFullFidelity(trial, fidelities):
+  """Returns True if a trial ran at the maximum of each of its experiment's fidelity parameters
+
+  Args:
+    trial(Trial): trial with its parameter configs
+    fidelities(set): names of the experiment's fidelity parameters, see getFidelities
+  """
+  return all(config.value >= config.parameter.maximum for config in trial.parameter_configs
+    if config.parameter.name in fidelities)
+
+def fullFidelityClause():
+  """Returns a filter on trials matching those which isFullFidelity accepts, for queries of Trial"""
+  return ~exists().where(and_(
+    ParameterConfig.trial_id == Trial.id,
+    ParameterConfig.parameter_id == Parameter.id,
+    ExperimentFidelity.experiment_id == Trial.experiment_id,
+    ExperimentFidelity.parameter == Parameter.name,
+    ParameterConfig.value < Parameter.maximum))
@@ -0,0 +1,16 @@
+"""Stop requests for running jobs
+
+The API sets a flag in Redis for the job; the worker running it polls the flag between trials.
+"""
+STOP_KEY_TEMPLATE = 'paropt:stop:{}'
+# stop flags of jobs that never check them (eg they finished first) expire on their own
+STOP_KEY_TTL = 24 * 60 * 60
+
+def requestStop(conn, job_id):
+  conn.set(STOP_KEY_TEMPLATE.format(job_id), 1, ex=STOP_KEY_TTL)
+
+def isStopRequested(conn, job_id):
+  return conn.exists(STOP_KEY_TEMPLATE.format(job_id)) > 0
+
+def clearStop(conn, job_id):
+  conn.delete(STOP_KEY_TEMPLATE.format(job_id))
@@ -0,0 +1,100 @@
+"""Batched reads of RQ job hashes for the job listing endpoints
+
+Jobs are read with one pipelined HMGET per job for only the requested fields, so a page of
+jobs costs a single round trip and never unpickles job args or fields that weren't asked for.
+"""
+import json
+import zlib
+
+from rq.job import Job, unpickle
+
+# job dict key -> field in the job's redis hash
+JOB_FIELDS = {
+  'job_status': 'status',
+  'job_result': 'result',
+  'job_meta': 'meta',
+  'job_progress': 'progress',
+  'job_exc_info': 'exc_info',
+}
+DEFAULT_FIELDS = ('job_status', 'job_meta', 'job_progress')
+
+def _decode(value):
+  return value.decode('utf-8') if isinstance(value, bytes) else value
+
+def _decodeExcInfo(raw):
+  try:
+    return _decode(zlib.decompress(raw))
+  except zlib.error:
+    # older jobs store exc_info uncompressed
+    return _decode(raw)
+
+def _decodeField(field, raw):
+  if field == 'status':
+    return _decode(raw)
+  if field == 'meta':
+    return unpickle(raw) if raw else {}
+  if field == 'progress':
+    # see progress.ProgressReporter
+    return json.loads(raw) if raw else None
+  if raw == None:
+    return None
+  if field == 'result':
+    return unpickle(raw)
+  return _decodeExcInfo(raw)
+
+def parseFields(fields_string):
+  """Parse a comma separated list of job fields, eg 'result,exc_info'
+
+  Args:
+    fields_string(str): field names with or without the 'job_' prefix; None for the defaults
+
+  Returns:
+    fields(tuple): job dict keys to include
+
+  Raises:
+    ValueError: if a field is unknown
+  """
+  if not fields_string:
+    return DEFAULT_FIELDS
+  fields = []
+  for name in fields_string.split(','):
+    name = name.strip()
+    key = name if name.startswith('job_') else 'job_{}'.format(name)
+    if key == 'job_id':
+      continue
+    if key not in JOB_FIELDS:
+      raise ValueError("Unknown job field '{}'".format(name))
+    fields.append(key)
+  return tuple(fields)
+
+def fetchJobDicts(conn, job_ids, fields=DEFAULT_FIELDS):
+  """Fetch jobs as dicts in a single pipelined round trip
+
+  Args:
+    conn(Redis): redis connection
+    job_ids([]str): ids of jobs to fetch
+    fields(tuple): job dict keys to include in addition to job_id
+
+  Returns:
+    jobs([]dict): job dicts in the order of job_ids; jobs which no longer exist are skipped
+  """
+  if len(job_ids) == 0:
+    return []
+  hash_fields = [JOB_FIELDS[key] for key in fields]
+  # always read status so missing (expired) jobs can be detected
+  read_fields = hash_fields if 'status' in hash_fields else hash_fields + ['status']
+  with conn.pipeline(transaction=False) as pipe:
+    for job_id in job_ids:
+      pipe.hmget(Job.key_for(job_id), read_fields)
+    rows = pipe.execute()
+
+  jobs = []
+  for job_id, values in zip(job_ids, rows):
+    raw = dict(zip(read_fields, values))
+    if raw['status'] == None:
+      continue
+    job_dict = {'job_id': job_id}
+    for key, field in zip(fields, hash_fields):
+      job_dict[key] = _decodeField(field, raw[field])
+    jobs.append(job_dict)
+  return jobs
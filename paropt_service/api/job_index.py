@@ -0,0 +1,128 @@
+"""Redis index from experiment id to the id of its active (queued, deferred or started) job
+
+The index is a single hash so that finding the job for an experiment costs one round trip,
+instead of fetching every job in the queue and started registry to compare their meta.
+Entries are claimed when a job is enqueued and released when the job finishes or fails.
+Entries left behind by crashed workers are detected and dropped on lookup.
+
+An entry is claimed before its job is saved, so each entry holds the time it was claimed too: an entry
+whose job doesn't exist yet is only dropped once CLAIM_GRACE_SECONDS have passed, so lookups while a job
+is being enqueued don't take its entry away.
+"""
+import time
+
+from rq.job import Job, JobStatus
+
+EXPERIMENT_JOBS_KEY = 'paropt:experiment_jobs'
+ACTIVE_STATUSES = (JobStatus.QUEUED, JobStatus.DEFERRED, JobStatus.STARTED)
+# status of an entry claimed for a job which isn't saved yet
+PENDING_STATUS = 'pending'
+# seconds an entry can be claimed without its job being saved before it's considered stale
+CLAIM_GRACE_SECONDS = 60
+
+# entries are '<job id> <unix time claimed>'; entries without the time are stale as soon as their job is gone
+_PARSE_ENTRY = """
+local function parseEntry(entry)
+  local job_id, claimed_at = string.match(entry, '^(%S+) (%S+)$')
+  if not job_id then
+    return entry, 0
+  end
+  return job_id, tonumber(claimed_at)
+end
+"""
+
+# returns [job_id, status] for the experiment's indexed job, dropping the entry if the job is no longer
+# active, or has been missing for longer than the grace period
+_LOOKUP_SCRIPT = _PARSE_ENTRY + """
+local entry = redis.call('hget', KEYS[1], ARGV[1])
+if not entry then
+  return nil
+end
+local job_id, claimed_at = parseEntry(entry)
+local status = redis.call('hget', ARGV[2] .. job_id, 'status')
+if not status and tonumber(ARGV[3]) - claimed_at < tonumber(ARGV[4]) then
+  return {job_id, ARGV[5]}
+end
+for i = 6, #ARGV do
+  if status == ARGV[i] then
+    return {job_id, status}
+  end
+end
+redis.call('hdel', KEYS[1], ARGV[1])
+return nil
+"""
+
+# deletes the experiment's entry only if it still points at the given job
+_RELEASE_SCRIPT = _PARSE_ENTRY + """
+local entry = redis.call('hget', KEYS[1], ARGV[1])
+if entry and parseEntry(entry) == ARGV[2] then
+  return redis.call('hdel', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+def _decode(value):
+  return value.decode('utf-8') if isinstance(value, bytes) else value
+
+def entryFor(job_id):
+  """Returns the index entry claiming an experiment for a job, eg to claim it with HSETNX in a pipeline"""
+  return '{} {}'.format(job_id, time.time())
+
+def reserve(conn, experiment_id, job_id):
+  """Claim the experiment's index entry for a job that is about to be enqueued
+
+  Args:
+    conn(Redis): redis connection
+    experiment_id(int|str): id of experiment
+    job_id(str): id the job will be enqueued with
+
+  Returns:
+    reserved(bool): False if the experiment already has an active job, or one being enqueued
+  """
+  if conn.hsetnx(EXPERIMENT_JOBS_KEY, str(experiment_id), entryFor(job_id)):
+    return True
+  # the existing entry may be stale (eg worker crashed); lookup drops it if so
+  if lookup(conn, experiment_id) != None:
+    return False
+  return bool(conn.hsetnx(EXPERIMENT_JOBS_KEY, str(experiment_id), entryFor(job_id)))
+
+def release(conn, experiment_id, job_id):
+  """Remove the experiment's index entry if it still belongs to job_id
+
+  Args:
+    conn(Redis): redis connection
+    experiment_id(int|str): id of experiment
+    job_id(str): id of the job that finished, failed or was never enqueued
+  """
+  conn.eval(_RELEASE_SCRIPT, 1, EXPERIMENT_JOBS_KEY, str(experiment_id), job_id)
+
+def releaseJob(conn, job):
+  """Remove the index entry of a job, using the experiment id in its meta"""
+  experiment_id = job.meta.get('experiment_id')
+  if experiment_id != None:
+    release(conn, experiment_id, job.get_id())
+
+def lookup(conn, experiment_id):
+  """Get the id and status of the experiment's active job in a single round trip
+
+  Args:
+    conn(Redis): redis connection
+    experiment_id(int|str): id of experiment
+
+  Returns:
+    job(tuple): (job_id, job_status), or None if the experiment has no active job. The status is
+      PENDING_STATUS while the job is being enqueued
+  """
+  res = conn.eval(
+    _LOOKUP_SCRIPT,
+    1,
+    EXPERIMENT_JOBS_KEY,
+    str(experiment_id),
+    Job.redis_job_namespace_prefix,
+    time.time(),
+    CLAIM_GRACE_SECONDS,
+    PENDING_STATUS,
+    *ACTIVE_STATUSES)
+  if res == None:
+    return None
+  return _decode(res[0]), _decode(res[1])
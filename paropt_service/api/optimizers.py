@@ -0,0 +1,388 @@
+"""Optimizers provided by the service in addition to paropt's
+
+They follow paropt's optimizer interface (`setExperiment`, iteration over parameter configurations and
+`register`), and can also suggest several configurations at once with `suggestBatch`, which
+ConcurrentRunner uses to fill free trial slots.
+"""
+import collections
+import math
+
+import numpy as np
+from scipy.stats import norm
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import Matern
+
+from paropt.storage.entities import ParameterConfig, PARAMETER_TYPE_INT
+
+BATCH_STRATEGIES = ('constant_liar', 'kriging_believer', 'local_penalization')
+
+class BatchBayesianOptimizer():
+  """Bayesian optimizer suggesting batches of q configurations to evaluate at the same time
+
+  After `n_init` random configurations, each iteration fits a gaussian process to the registered trials
+  and suggests up to `batch_size` configurations, accounting for configurations still being evaluated
+  (pending) with one of these strategies:
+    constant_liar: pretend pending configurations scored the worst objective seen so far and refit
+    kriging_believer: pretend pending configurations scored the GP's predicted mean and refit
+    local_penalization: keep one GP fit and penalize the acquisition function around pending configurations
+
+  With `warm_start`, the runner passes the experiment's stored trials to `warmStart` before the first
+  suggestion. They count towards the `n_init` random configurations, so a warm started run goes straight
+  to fitting the GP when there are at least `n_init` stored trials.
+
+  The objective is the trial outcome (runtime), which is minimized.
+  """
+  def __init__(self, n_init, n_iter, batch_size=1, strategy='constant_liar', kappa=2.576, n_candidates=5000,
+               random_state=None, warm_start=False):
+    """
+    Args:
+      n_init(int): number of random configurations to start with
+      n_iter(int): number of iterations, each suggesting up to batch_size configurations
+      batch_size(int): max number of configurations suggested per iteration
+      strategy(str): one of BATCH_STRATEGIES
+      kappa(float): exploration weight of the upper confidence bound acquisition function
+      n_candidates(int): number of random points the acquisition function is maximized over
+      random_state(int): seed
+      warm_start(bool): fit to the experiment's stored trials before suggesting configurations
+    """
+    if strategy not in BATCH_STRATEGIES:
+      raise ValueError("Unknown batch strategy '{}'".format(strategy))
+    self.n_init = n_init
+    self.n_iter = n_iter
+    self.batch_size = batch_size
+    self.strategy = strategy
+    self.kappa = kappa
+    self.n_candidates = n_candidates
+    self.warm_start = warm_start
+    self._random = np.random.RandomState(random_state)
+    self._n_random = n_init
+    self._budget = n_init + n_iter * batch_size
+    self._suggested = 0
+    self.parameters = []
+    # points are kept scaled to the unit cube; targets are negated outcomes so they're maximized
+    self._X = []
+    self._y = []
+    self._pending = []
+    self._registered_ids = set()
+
+  def setExperiment(self, experiment):
+    self.parameters = list(experiment.parameters)
+    self._low = np.array([param.minimum for param in self.parameters], dtype=float)
+    self._span = np.array([param.maximum - param.minimum for param in self.parameters], dtype=float)
+    self._span[self._span == 0] = 1.0
+    self._int_mask = np.array([param.type == PARAMETER_TYPE_INT for param in self.parameters])
+
+  def __iter__(self):
+    while True:
+      batch = self.suggestBatch(1)
+      if len(batch) == 0:
+        return
+      yield batch[0]
+
+  def register(self, trial):
+    x = self._configsToPoint(trial.parameter_configs)
+    self._removePending(x)
+    # stored trials can be registered more than once, eg when warm started and then reused from the cache
+    if trial.id != None:
+      if trial.id in self._registered_ids:
+        return
+      self._registered_ids.add(trial.id)
+    if trial.outcome != None:
+      self._X.append(x)
+      self._y.append(-trial.outcome)
+
+  def warmStart(self, trials):
+    """Register previously stored trials, skipping as much random initialization as they cover
+
+    Can be called with successive chunks of the stored trials.
+
+    Args:
+      trials([]Trial): stored trials of the experiment
+    """
+    for trial in trials:
+      self.register(trial)
+    self._n_random = max(0, self.n_init - len(self._y))
+    self._budget = self._n_random + self.n_iter * self.batch_size
+
+  def suggestBatch(self, count):
+    """Suggest up to count (and batch_size) configurations
+
+    Returns:
+      configs([][]ParameterConfig): parameter configurations; empty when the budget is used up
+    """
+    count = min(count, self.batch_size, self._budget - self._suggested)
+    if count <= 0:
+      return []
+    # random points until n_init were suggested, or while there are no results to fit to
+    n_random = count if len(self._y) == 0 else max(0, min(count, self._n_random - self._suggested))
+    points = list(self._round(self._random.uniform(size=(n_random, len(self.parameters)))))
+    if count > n_random:
+      points += self._suggestPoints(count - n_random, self._pending + points)
+    self._pending += points
+    self._suggested += len(points)
+    return [self._pointToConfigs(x) for x in points]
+
+  def _suggestPoints(self, count, pending):
+    if self.strategy == 'local_penalization':
+      return self._suggestPenalized(count, pending)
+    X, y = list(self._X), list(self._y)
+    worst = min(self._y)
+    gp = self._fit(X, y)
+    for x in pending:
+      X.append(x)
+      y.append(worst if self.strategy == 'constant_liar' else gp.predict(x.reshape(1, -1))[0])
+    points = []
+    for _ in range(count):
+      gp = self._fit(X, y)
+      candidates = self._candidates()
+      x = candidates[np.argmax(self._ucb(gp, candidates))]
+      X.append(x)
+      y.append(worst if self.strategy == 'constant_liar' else gp.predict(x.reshape(1, -1))[0])
+      points.append(x)
+    return points
+
+  def _suggestPenalized(self, count, pending):
+    """Local penalization, see Gonzalez et al. 2016 "Batch Bayesian Optimization via Local Penalization"."""
+    gp = self._fit(self._X, self._y)
+    candidates = self._candidates()
+    mu, sigma = gp.predict(candidates, return_std=True)
+    # softplus keeps the acquisition positive so it can be multiplied by the penalizers
+    log_acquisition = np.log(np.logaddexp(0, mu + self.kappa * sigma))
+    lipschitz = self._estimateLipschitz(gp)
+    best = max(max(self._y), mu.max())
+    points = []
+    for x in list(pending):
+      log_acquisition += self._logPenalizer(gp, x, candidates, lipschitz, best)
+    for _ in range(count):
+      x = candidates[np.argmax(log_acquisition)]
+      log_acquisition += self._logPenalizer(gp, x, candidates, lipschitz, best)
+      points.append(self._round(x))
+    return points
+
+  def _logPenalizer(self, gp, x, candidates, lipschitz, best):
+    mu, sigma = gp.predict(x.reshape(1, -1), return_std=True)
+    sigma = max(sigma[0], 1e-9)
+    distances = np.linalg.norm(candidates - x, axis=1)
+    return norm.logcdf((lipschitz * distances - best + mu[0]) / sigma)
+
+  def _estimateLipschitz(self, gp):
+    # max norm of the GP mean's gradient, estimated with finite differences over random points
+    points = self._random.uniform(size=(200, len(self.parameters)))
+    step = 1e-4
+    base = gp.predict(points)
+    grads = np.stack([
+      (gp.predict(points + step * np.eye(len(self.parameters))[i]) - base) / step
+      for i in range(len(self.parameters))
+    ], axis=1)
+    return max(np.linalg.norm(grads, axis=1).max(), 1e-7)
+
+  def _fit(self, X, y):
+    gp = GaussianProcessRegressor(
+      kernel=Matern(nu=2.5),
+      alpha=1e-6,
+      normalize_y=True,
+      n_restarts_optimizer=2,
+      random_state=self._random)
+    gp.fit(np.array(X), np.array(y))
+    return gp
+
+  def _ucb(self, gp, X):
+    mu, sigma = gp.predict(X, return_std=True)
+    return mu + self.kappa * sigma
+
+  def _candidates(self):
+    return self._round(self._random.uniform(size=(self.n_candidates, len(self.parameters))))
+
+  def _round(self, x):
+    """Snap unit cube point(s) to valid values for int parameters"""
+    values = np.clip(self._low + x * self._span, self._low, self._low + self._span)
+    values = np.where(self._int_mask, np.round(values), values)
+    return (values - self._low) / self._span
+
+  def _removePending(self, x):
+    for i, pending in enumerate(self._pending):
+      if np.allclose(pending, x):
+        del self._pending[i]
+        return
+
+  def _pointToConfigs(self, x):
+    values = self._low + x * self._span
+    configs = []
+    for param, value in zip(self.parameters, values):
+      value = int(round(value)) if param.type == PARAMETER_TYPE_INT else float(value)
+      configs.append(ParameterConfig(parameter=param, value=value))
+    return configs
+
+  def _configsToPoint(self, parameter_configs):
+    values = {config.parameter.name: config.value for config in parameter_configs}
+    raw = np.array([values[param.name] for param in self.parameters], dtype=float)
+    return (raw - self._low) / self._span
+
+def hyperbandSchedule(min_fidelity, max_fidelity, eta=3, brackets=None, n_configs=None):
+  """Returns the brackets of a hyperband run, most aggressive first
+
+  Bracket s (from s_max = floor(log_eta(max_fidelity / min_fidelity)) down to 0) starts
+  ceil((s_max + 1) / (s + 1) * eta^s) configurations at fidelity max_fidelity * eta^-s, and keeps the best
+  1/eta of them at each rung while multiplying the fidelity by eta, up to max_fidelity.
+
+  Args:
+    min_fidelity(float): lowest fidelity a configuration is evaluated at; > 0
+    max_fidelity(float): full fidelity
+    eta(int): factor configurations are cut by and fidelity is raised by at each rung; >= 2
+    brackets(int): number of brackets to run, most aggressive first; None for all of them
+    n_configs(int): number of configurations the first bracket starts with; None for hyperband's
+
+  Returns:
+    brackets([][](int, float)): for each bracket, its rungs as (number of configurations, fidelity)
+  """
+  s_max = int(math.floor(math.log(max_fidelity / min_fidelity, eta) + 1e-9))
+  schedule = []
+  for s in list(range(s_max, -1, -1))[:brackets]:
+    n = int(math.ceil((s_max + 1) / (s + 1) * eta ** s))
+    if n_configs != None and len(schedule) == 0:
+      n = n_configs
+    schedule.append([(max(1, int(n * eta ** -i)), max_fidelity * eta ** (i - s)) for i in range(s + 1)])
+  return schedule
+
+def checkFidelity(parameter_dicts, fidelity):
+  """Returns why a parameter can't be used as the fidelity of a multi-fidelity optimizer; None if it can
+
+  Args:
+    parameter_dicts([]dict): parameters of the experiment
+    fidelity(str): name of the fidelity parameter
+  """
+  for param in parameter_dicts:
+    if param['name'] == fidelity:
+      if not 0 < param['minimum'] < param['maximum']:
+        return "fidelity parameter '{}' must have 0 < minimum < maximum".format(fidelity)
+      return None
+  return "fidelity must be one of the experiment's parameters, not '{}'".format(fidelity)
+
+class HyperbandOptimizer():
+  """Multi-fidelity optimizer running hyperband (Li et al. 2018 "Hyperband: A Novel Bandit-Based Approach to
+  Hyperparameter Optimization") or successive halving
+
+  One of the experiment's parameters is the `fidelity`, eg the fraction of the input a tool is run on; its
+  minimum is the cheapest fidelity and its maximum the full one. Random configurations of the other
+  parameters are evaluated at a low fidelity, and only the best 1/eta of them are evaluated again at eta
+  times the fidelity, up to the full fidelity, so poor configurations are discarded after cheap runs. See
+  hyperbandSchedule. With `brackets=1` this is successive halving.
+
+  The configurations of a rung are suggested together, and the next rung can only be suggested once all of
+  them have been registered; `isWaiting` tells the runner to wait for them rather than end the run.
+
+  The objective is the trial outcome (runtime), which is minimized; configurations are only compared with
+  others evaluated at the same fidelity.
+  """
+  def __init__(self, fidelity, eta=3, brackets=None, n_configs=None, random_state=None):
+    """
+    Args:
+      fidelity(str): name of the fidelity parameter
+      eta(int): factor configurations are cut by and fidelity is raised by at each rung; >= 2
+      brackets(int): number of brackets to run, most aggressive first; None for all of them
+      n_configs(int): number of configurations the first bracket starts with; None for hyperband's
+      random_state(int): seed
+    """
+    if eta < 2:
+      raise ValueError('eta must be at least 2')
+    if (brackets != None and brackets < 1) or (n_configs != None and n_configs < 1):
+      raise ValueError('brackets and n_configs must be positive')
+    self.fidelity = fidelity
+    self.eta = eta
+    self.brackets = brackets
+    self.n_configs = n_configs
+    self._random = np.random.RandomState(random_state)
+    self.parameters = []
+    self._schedule = []
+    self._bracket = 0
+    self._rung = -1
+    # values of the other parameters, by parameter name, of configurations left to suggest in the rung
+    self._to_suggest = []
+    # configurations of the rung suggested but not registered yet, and the results of those registered
+    self._pending = collections.Counter()
+    self._results = []
+
+  def setExperiment(self, experiment):
+    self.parameters = list(experiment.parameters)
+    fidelity_params = [param for param in self.parameters if param.name == self.fidelity]
+    if len(fidelity_params) == 0:
+      raise ValueError("Experiment has no fidelity parameter '{}'".format(self.fidelity))
+    self._fidelity_param = fidelity_params[0]
+    self._schedule = hyperbandSchedule(
+      self._fidelity_param.minimum, self._fidelity_param.maximum, self.eta, self.brackets, self.n_configs)
+
+  def __iter__(self):
+    while True:
+      batch = self.suggestBatch(1)
+      if len(batch) == 0:
+        return
+      yield batch[0]
+
+  def isWaiting(self):
+    """Returns True when there's nothing to suggest until the configurations in flight are registered"""
+    self._advance()
+    return len(self._to_suggest) == 0 and sum(self._pending.values()) > 0
+
+  def register(self, trial):
+    values = {config.parameter.name: float(config.value) for config in trial.parameter_configs}
+    key = self._key(values)
+    # trials which weren't suggested for the current rung (eg stored ones) don't count towards it
+    if self._pending[key] <= 0 or trial.outcome == None:
+      return
+    self._pending[key] -= 1
+    self._results.append((trial.outcome, {name: value for name, value in values.items() if name != self.fidelity}))
+
+  def suggestBatch(self, count):
+    """Suggest up to count configurations of the current rung
+
+    Returns:
+      configs([][]ParameterConfig): parameter configurations; empty when waiting on the rung's results
+        (see isWaiting) or when every bracket has been run
+    """
+    self._advance()
+    if self._bracket >= len(self._schedule):
+      return []
+    fidelity = self._fidelityValue(self._schedule[self._bracket][self._rung][1])
+    configs = []
+    while len(configs) < count and len(self._to_suggest) > 0:
+      values = dict(self._to_suggest.pop(0))
+      values[self.fidelity] = fidelity
+      self._pending[self._key(values)] += 1
+      configs.append([ParameterConfig(parameter=param, value=values[param.name]) for param in self.parameters])
+    return configs
+
+  def _advance(self):
+    """Move to the next rung, or the next bracket, once the current rung's results are all registered"""
+    # a rung can be left empty if none of the previous rung's trials had an outcome
+    while len(self._to_suggest) == 0 and sum(self._pending.values()) == 0 and self._bracket < len(self._schedule):
+      rungs = self._schedule[self._bracket]
+      if self._rung >= 0 and self._rung + 1 < len(rungs):
+        # promote the best configurations of the rung
+        self._rung += 1
+        best = sorted(self._results, key=lambda result: result[0])[:rungs[self._rung][0]]
+        self._to_suggest = [values for _, values in best]
+      else:
+        if self._rung >= 0:
+          self._bracket += 1
+          if self._bracket >= len(self._schedule):
+            return
+        self._rung = 0
+        self._to_suggest = [self._sample() for _ in range(self._schedule[self._bracket][0][0])]
+      self._results = []
+      self._pending.clear()
+
+  def _sample(self):
+    values = {}
+    for param in self.parameters:
+      if param.name == self.fidelity:
+        continue
+      value = self._random.uniform(param.minimum, param.maximum)
+      values[param.name] = int(round(value)) if param.type == PARAMETER_TYPE_INT else float(value)
+    return values
+
+  def _fidelityValue(self, fidelity):
+    fidelity = min(max(fidelity, self._fidelity_param.minimum), self._fidelity_param.maximum)
+    return int(round(fidelity)) if self._fidelity_param.type == PARAMETER_TYPE_INT else float(fidelity)
+
+  def _key(self, values):
+    return tuple(round(float(values[param.name]), 9) for param in self.parameters)
@@ -0,0 +1,33 @@
+"""Pareto fronts of runtime against EC2 cost
+
+A trial's cost is its runtime times the hourly price of its experiment's instance model. Every trial of an
+experiment runs on the same instance model, so within an experiment cost only grows with runtime and the
+front is the fastest trial. Runtime is traded against cost across experiments running the same tool on
+different instance models, so each experiment only contributes its fastest trials to the front.
+"""
+
+OBJECTIVES = ('runtime', 'cost')
+
+def trialCost(runtime, hourly_price):
+  """Returns the EC2 cost in USD of a trial; None if the price of its instance model isn't known"""
+  if runtime == None or hourly_price == None:
+    return None
+  return runtime * hourly_price / 3600.0
+
+def paretoFront(points):
+  """Returns the points which no other point dominates, minimizing both objectives
+
+  A point dominates another if it's no worse in both objectives and better in at least one; equal points
+  don't dominate each other, so they're all kept. Takes O(n log n) for n points.
+
+  Args:
+    points([](float, float, object)): first objective, second objective and the point's data
+
+  Returns:
+    front([](float, float, object)): non-dominated points by increasing first objective
+  """
+  front = []
+  for point in sorted(points, key=lambda point: (point[0], point[1])):
+    if len(front) == 0 or point[1] < front[-1][1] or point[:2] == front[-1][:2]:
+      front.append(point)
+  return front
@@ -1,17 +1,25 @@
 import multiprocessing
 import atexit
+import datetime
 import os
+import socket
 import time
-
-from flask import current_app
+import uuid
+import threading
 
 import redis
-from rq import Queue, Connection
+from rq import Queue, Connection, get_current_job
 from rq.registry import StartedJobRegistry, FailedJobRegistry, DeferredJobRegistry
-from rq.job import Job
+from rq.job import Job, JobStatus
 from rq.exceptions import NoSuchJobError
 
-from config import DB_HOST, DB_USER, DB_PASSWORD, DB_NAME, in_production, getAWSConfig
+from config import (TRIALS_CHUNK_SIZE, in_production, getAWSConfig,
+  getLocalConfig, getWorkerInit, MAX_TRIAL_CONCURRENCY, EC2_HOURLY_PRICES, COMPUTE_IDLE_TIMEOUT, WORKER_SETUP_TIMEOUT,
+  QUEUE_NAMES, DEFAULT_QUEUE, FAIR_SHARE_BY, MAX_EC2_INSTANCES,
+  REDIS_URL, REDIS_MAX_CONNECTIONS, REDIS_POOL_TIMEOUT, REDIS_CONNECT_TIMEOUT, REDIS_SOCKET_TIMEOUT,
+  REDIS_HEALTH_CHECK_INTERVAL, EVENTS_KEEPALIVE, EVENTS_MAX_SECONDS, EVENTS_MAX_STREAMS, PROGRESS_INTERVAL,
+  DB_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING, TRIAL_FLUSH_SIZE,
+  TRIAL_FLUSH_SECONDS, EXPERIMENT_CACHE_SIZE, TRIAL_SUMMARY_CACHE_TTL)
 
 import parsl
 
@@ -20,7 +28,21 @@ from paropt.runner import ParslRunner
 from paropt.storage import LocalFile, RelationalDB
 from paropt.optimizer import BayesianOptimizer, GridSearch
 from paropt.runner.parsl import timeCommand
-from paropt.storage.entities import Parameter, Experiment, EC2Compute, LocalCompute
+from paropt.storage.entities import Parameter, Experiment, Trial, EC2Compute, LocalCompute
+
+from sqlalchemy import and_, or_, func, case
+from sqlalchemy.orm import selectinload
+
+from . import job_index, job_fetch, job_control, compute_pool, worker_env, scheduling, supervisor, recovery, events, progress
+from . import db_pool, read_cache, run_results, pareto, fidelities
+from .redis_pool import StatsBlockingConnectionPool
+from .runner import ConcurrentRunner
+from .optimizers import BatchBayesianOptimizer, HyperbandOptimizer, hyperbandSchedule, checkFidelity
+from .trial_cache import TrialCache
+from .stopping import StoppingRules
+
+# optimizer of runs which don't configure one
+DEFAULT_OPTIMIZER_CONFIG = {'type': 'bayesopt', 'n_init': 2, 'n_iter': 2}
 
 def getOptimizer(optimizer_config):
   """Construct optimizer from a config dict
@@ -32,17 +54,27 @@ def getOptimizer(optimizer_config):
     Optimizer
   """
   if optimizer_config == None:
-    return BayesianOptimizer(
-      n_init=2,
-      n_iter=2
-    )
+    optimizer_config = DEFAULT_OPTIMIZER_CONFIG
   optimizer_type = optimizer_config.get('type')
   if optimizer_type == 'bayesopt':
     n_init = optimizer_config.get('n_init')
     n_iter = optimizer_config.get('n_iter')
+    batch_size = optimizer_config.get('batch_size', 1)
+    warm_start = optimizer_config.get('warm_start', False)
     try:
       n_init = int(n_init)
       n_iter = int(n_iter)
+      batch_size = int(batch_size)
+      if not isinstance(warm_start, bool):
+        return None
+      # paropt's BayesianOptimizer suggests one config at a time and always starts from scratch
+      if batch_size > 1 or warm_start:
+        return BatchBayesianOptimizer(
+          n_init=n_init,
+          n_iter=n_iter,
+          batch_size=batch_size,
+          strategy=optimizer_config.get('batch_strategy', 'constant_liar'),
+          warm_start=warm_start)
       return BayesianOptimizer(n_init=n_init, n_iter=n_iter)
     except:
       return None
@@ -53,32 +85,329 @@ def getOptimizer(optimizer_config):
       return GridSearch(num_configs_per_param=num_configs_per_param)
     except:
       return None
+  elif optimizer_type in ('hyperband', 'successive_halving'):
+    fidelity = optimizer_config.get('fidelity')
+    if not isinstance(fidelity, str):
+      return None
+    try:
+      eta = int(optimizer_config.get('eta', 3))
+      n_configs = optimizer_config.get('n_configs')
+      n_configs = int(n_configs) if n_configs != None else None
+      brackets = optimizer_config.get('brackets')
+      brackets = int(brackets) if brackets != None else None
+      if optimizer_type == 'successive_halving':
+        brackets = 1
+      return HyperbandOptimizer(fidelity=fidelity, eta=eta, brackets=brackets, n_configs=n_configs)
+    except:
+      return None
+
+def isResumable(optimizer_config):
+  """Returns True if a run of the optimizer can continue from the trials stored by an earlier attempt
+
+  Bayesian optimization is warm started with them and grid search suggests the same configs again, which are
+  reused from the trial cache. Hyperband samples new random configs, so it would start over.
+  """
+  return (optimizer_config or DEFAULT_OPTIMIZER_CONFIG).get('type') in ('bayesopt', 'grid')
+
+def getResumeOptimizer(optimizer_config):
+  """Construct the optimizer resuming a run from a config dict, see isResumable
+
+  Returns:
+    Optimizer: None if the optimizer can't resume runs or the config is invalid
+  """
+  if not isResumable(optimizer_config):
+    return None
+  optimizer_config = optimizer_config or DEFAULT_OPTIMIZER_CONFIG
+  if optimizer_config.get('type') == 'bayesopt':
+    # paropt's BayesianOptimizer can't be warm started
+    optimizer_config = dict(optimizer_config, warm_start=True)
+  return getOptimizer(optimizer_config)
+
+def getTrialCache(cache_config):
+  """Construct trial cache from a config dict like `{"ttl": <seconds>, "force": <bool>}`
+
+  Args:
+    cache_config(dict): cache policy for a run; None for the default of reusing trials of any age
+
+  Returns:
+    TrialCache: None if the config is invalid
+  """
+  if cache_config == None:
+    return TrialCache()
+  try:
+    ttl = cache_config.get('ttl')
+    ttl = float(ttl) if ttl != None else None
+    force = cache_config.get('force', False)
+    if not isinstance(force, bool) or (ttl != None and ttl < 0):
+      return None
+    return TrialCache(ttl=ttl, force=force)
+  except:
+    return None
+
+def getStoppingRules(stopping_config, compute_dict, concurrency):
+  """Construct stopping rules from a config dict like
+  `{"patience": <trials>, "target": <objective>, "max_seconds": <seconds>, "max_cost": <USD>}`
+
+  Args:
+    stopping_config(dict): stopping rules from the optimizer config; None to run the optimizer to the end
+    compute_dict(dict): compute of the experiment, used to price cost budgets
+    concurrency(int): number of trials to run at once, ie number of instances
+
+  Returns:
+    StoppingRules: None if there are no rules
+  
+  Raises:
+    ValueError: if the config is invalid
+  """
+  if stopping_config == None:
+    return None
+  if not isinstance(stopping_config, dict):
+    raise ValueError('stopping must be an object')
+  unknown = set(stopping_config) - {'patience', 'target', 'max_seconds', 'max_cost'}
+  if len(unknown) > 0:
+    raise ValueError('Unknown stopping rules: {}'.format(', '.join(sorted(unknown))))
+  patience = stopping_config.get('patience')
+  target = stopping_config.get('target')
+  max_seconds = stopping_config.get('max_seconds')
+  max_cost = stopping_config.get('max_cost')
+  patience = int(patience) if patience != None else None
+  target = float(target) if target != None else None
+  max_seconds = float(max_seconds) if max_seconds != None else None
+  max_cost = float(max_cost) if max_cost != None else None
+  if (patience != None and patience < 1) or (max_seconds != None and max_seconds <= 0) or (max_cost != None and max_cost <= 0):
+    raise ValueError('patience, max_seconds and max_cost must be positive')
+  hourly_cost = 0.0
+  if in_production:
+    price = EC2_HOURLY_PRICES.get(compute_dict.get('instance_model'))
+    if price == None and max_cost != None:
+      raise ValueError("No price known for instance model '{}'".format(compute_dict.get('instance_model')))
+    hourly_cost = (price or 0.0) * concurrency
+  return StoppingRules(
+    patience=patience,
+    target=target,
+    max_seconds=max_seconds,
+    max_cost=max_cost,
+    hourly_cost=hourly_cost)
+
+# version of the run specs jobs are enqueued with; bump it when the spec changes incompatibly
+RUN_SPEC_VERSION = 1
+
+def loadRunSpec(run_spec, compute_dict):
+  """Rebuild the optimizer, trial cache and stopping rules of a run from the spec its job was enqueued with
+
+  Args:
+    run_spec(dict): spec of the run, see ParoptManager._prepareRun
+    compute_dict(dict): compute of the experiment, used to price cost budgets
+
+  Returns:
+    optimizer(Optimizer)
+    concurrency(int)
+    trial_cache(TrialCache)
+    stopping_rules(StoppingRules)
+
+  Raises:
+    ValueError: if the spec has an unsupported version or is invalid
+  """
+  if run_spec.get('version') != RUN_SPEC_VERSION:
+    raise ValueError('Unsupported run spec version {}'.format(run_spec.get('version')))
+  optimizer = getOptimizer(run_spec['optimizer'])
+  trial_cache = getTrialCache(run_spec['cache'])
+  if optimizer == None or trial_cache == None:
+    raise ValueError('Invalid run spec')
+  concurrency = run_spec['concurrency']
+  stopping_rules = getStoppingRules((run_spec['optimizer'] or {}).get('stopping'), compute_dict, concurrency)
+  return optimizer, concurrency, trial_cache, stopping_rules
+
+def getParslConfig(compute_dict, concurrency):
+  """Construct parsl config for running an experiment
+
+  Args:
+    compute_dict(dict): compute of the experiment
+    concurrency(int): number of trials to run at once
+
+  Returns:
+    Config: EC2 config with one instance per concurrent trial in production; local threads otherwise
+  """
+  if in_production:
+    return getAWSConfig(
+      image_id=compute_dict['ami'],
+      instance_type=compute_dict['instance_model'],
+      max_blocks=concurrency,
+      worker_init=getWorkerInit(compute_dict['ami'], worker_env.pinnedVersion()))
+  return getLocalConfig(max_threads=concurrency)
+
+def estimateTrials(optimizer_config, experiment_dict):
+  """Estimate the number of trials a run will evaluate, used as its cost for fair share scheduling"""
+  optimizer_config = optimizer_config if optimizer_config != None else DEFAULT_OPTIMIZER_CONFIG
+  try:
+    if optimizer_config.get('type') == 'grid':
+      return int(optimizer_config['num_configs_per_param']) ** len(experiment_dict['parameters'])
+    if optimizer_config.get('type') in ('hyperband', 'successive_halving'):
+      # the optimizer's own defaults and validation of eta, brackets and n_configs apply to the estimate too
+      optimizer = getOptimizer(optimizer_config)
+      if optimizer == None:
+        return 1
+      fidelity = [param for param in experiment_dict['parameters'] if param['name'] == optimizer.fidelity][0]
+      schedule = hyperbandSchedule(
+        fidelity['minimum'], fidelity['maximum'], optimizer.eta, optimizer.brackets, optimizer.n_configs)
+      return sum(n for rungs in schedule for n, _ in rungs)
+    batch_size = int(optimizer_config.get('batch_size', 1))
+    return int(optimizer_config['n_init']) + int(optimizer_config['n_iter']) * batch_size
+  except (KeyError, TypeError, ValueError, IndexError, ZeroDivisionError):
+    return 1
+
+def instanceHolder():
+  """Name EC2 instances launched by this process are held under, see scheduling.acquireInstances"""
+  return scheduling.holderName(socket.gethostname(), os.getpid())
+
+def getComputeKey(compute_dict):
+  """Returns the compute spec parsl blocks are launched with, identifying blocks that can be reused"""
+  if in_production:
+    return ('ec2', compute_dict['instance_model'], compute_dict['ami'])
+  return ('local',)
+
+def trialToDict(trial):
+  """Returns trial as dict, including its id so it can be used as a pagination cursor"""
+  trial_dict = trial.asdict()
+  trial_dict.setdefault('id', trial.id)
+  return trial_dict
+
+# seconds between checks for free EC2 instances while a run waits for admission
+ADMISSION_POLL_SECONDS = 10
+
+def _pageJobIds(sources, getIds, cursor, count):
+  """Get up to count job ids starting at cursor from sources concatenated in order
+
+  Args:
+    sources(list): queues or registries
+    getIds(function): gets ids from a source given an offset and count; a count of None gets all of them
+    count(int): max number of ids; None for all of them
+  """
+  job_ids = []
+  for source in sources:
+    if count != None and len(job_ids) >= count:
+      break
+    size = source.count
+    if cursor >= size:
+      cursor -= size
+      continue
+    job_ids += getIds(source, cursor, None if count == None else count - len(job_ids))
+    cursor = 0
+  return job_ids
+
+def _pageCount(limit):
+  """Number of job ids to get for a page of limit jobs: one more, to tell if there's a next page"""
+  return None if limit == None else limit + 1
+
+def _registryJobIds(conn, registry_class, cursor, count):
+  """Get up to count job ids starting at cursor from a type of registry of all queues; None for all of them"""
+  return _pageJobIds(
+    [registry_class(name, connection=conn) for name in QUEUE_NAMES],
+    lambda registry, offset, n: registry.get_job_ids(offset, -1 if n == None else offset + n - 1),
+    cursor,
+    count)
 
 class ParoptManager():
   """Manages paropt tasks and storage records using Redis queue and paropt storage"""
   _started = False
+  _start_lock = threading.Lock()
   db_storage = None
+  redis_pool = None
+  compute_pool = None
+  experiment_cache = None
+  trial_summary_cache = None
+  event_streams = None
+  _console_logger_set = False
 
   @classmethod
   def start(cls):
-    if cls._started:
-      return
-    cls.db_storage = RelationalDB(
-      'postgresql',
-      DB_USER,
-      DB_PASSWORD,
-      DB_HOST,
-      DB_NAME
-    )
-    cls._started = True
-
-  @classmethod
-  def runTrials(cls, experiment_id, run_config):
+    with cls._start_lock:
+      if cls._started:
+        return
+      # one engine per process, shared by API requests and by the runs of workers
+      cls.db_storage = db_pool.pooledStorage(
+        RelationalDB,
+        db_pool.createEngine(
+          DB_URL,
+          pool_size=DB_POOL_SIZE,
+          max_overflow=DB_MAX_OVERFLOW,
+          timeout=DB_POOL_TIMEOUT,
+          recycle=DB_POOL_RECYCLE,
+          pre_ping=DB_POOL_PRE_PING),
+        Trial.metadata)
+      run_results.createTables(cls.db_storage.engine)
+      fidelities.createTables(cls.db_storage.engine)
+      cls.redis_pool = StatsBlockingConnectionPool.from_url(
+        REDIS_URL,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL)
+      if COMPUTE_IDLE_TIMEOUT > 0:
+        cls.compute_pool = compute_pool.ComputePool(
+          idle_timeout=COMPUTE_IDLE_TIMEOUT,
+          on_shutdown=lambda: scheduling.releaseInstances(cls.getRedis(), instanceHolder()))
+        atexit.register(cls.compute_pool.shutdown)
+      cls.experiment_cache = read_cache.ExperimentCache(max_size=EXPERIMENT_CACHE_SIZE)
+      cls.trial_summary_cache = read_cache.TrialSummaryCache(ttl=TRIAL_SUMMARY_CACHE_TTL)
+      cls.event_streams = events.StreamLimit(EVENTS_MAX_STREAMS)
+      cls._started = True
+
+  @classmethod
+  def getRedis(cls):
+    """Get a redis client backed by the process-wide connection pool"""
+    if not cls._started:
+      raise Exception("ParoptManager not started")
+    return redis.Redis(connection_pool=cls.redis_pool)
+
+  @classmethod
+  def getDedicatedRedis(cls):
+    """Get a redis client with a connection of its own, outside the shared pool, eg for a long lived
+    pub/sub subscription which would otherwise hold a pooled connection. Disconnect it once done"""
+    return redis.Redis.from_url(
+      REDIS_URL,
+      max_connections=1,
+      socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+      health_check_interval=REDIS_HEALTH_CHECK_INTERVAL)
+
+  @classmethod
+  def getStats(cls):
+    """Returns usage stats of the manager's shared resources"""
+    return {
+      'redis_pool': cls.redis_pool.stats() if cls.redis_pool != None else None,
+      'db_pool': cls.db_storage.engine.pool.stats() if cls.db_storage != None else None,
+      'compute_pool': compute_pool.getStats(cls.getRedis()) if cls._started else None,
+      'scheduling': cls.getSchedulingStats() if cls._started else None,
+      'supervisors': supervisor.getStats(cls.getRedis()) if cls._started else None,
+      'recovery': recovery.getStats(cls.getRedis()) if cls._started else None,
+      'event_streams': cls.event_streams.stats() if cls._started else None,
+      'read_cache': {
+        'experiments': cls.experiment_cache.stats(),
+        'trial_summaries': cls.trial_summary_cache.stats(),
+      } if cls._started else None
+    }
+
+  @classmethod
+  def getSchedulingStats(cls):
+    """Returns the number of jobs in each queue and the EC2 instances held by workers"""
+    conn = cls.getRedis()
+    return {
+      'queued': {name: Queue(name, connection=conn).count for name in QUEUE_NAMES},
+      'ec2_instances': scheduling.instancesHeld(conn),
+      'max_ec2_instances': MAX_EC2_INSTANCES if MAX_EC2_INSTANCES > 0 else None
+    }
+
+  @classmethod
+  def runTrials(cls, experiment_id, run_config, user=None):
     """Put experiment into job queue to be run
 
     Args:
       experiment_id(int): id of experiment to run
-      run_config(dict): dict for how to config optimizer
+      run_config(dict): dict for how to config optimizer (including optional `stopping` rules), and
+        optionally `concurrency`, the number of trials to run at once, `cache`, the policy for reusing
+        already measured trials, and `priority`, the queue to submit to
+      user(str): user submitting the run, for fair share scheduling
     
     Returns:
       result(dict): result of attempt to add job to queue
@@ -86,30 +415,36 @@ class ParoptManager():
     if not cls._started:
       raise Exception("ParoptManager not started")
 
-    # debugging get job (should be requested based on experiment id)
-    job = cls.getExperimentJob(experiment_id)
-    if job != None:
-      return {'status': 'failed', 'message': 'Experiment already enqueued or running'}
-
     # check if experiment exists
     experiment = cls.getExperimentDict(experiment_id)
     if experiment == None:
-      return {'status': 'failed', 'message': "Experiment not found with id {}".format(id)}
-    
-    optimizer = getOptimizer(run_config.get('optimizer'))
-    if optimizer == None:
-      return {'status': 'failed', 'message': "Invalid run configuration provided"}
-    
-    # submit job to redis
-    with Connection(redis.from_url(current_app.config['REDIS_URL'])):
-      q = Queue()
-      job = q.enqueue(
-        f=cls._startRunner,
-        args=(experiment, optimizer),
-        result_ttl=3600,
-        job_timeout=-1,
-        ttl=-1,
-        meta={'experiment_id': str(experiment_id)})
+      return {'status': 'failed', 'message': "Experiment not found with id {}".format(experiment_id)}
+
+    run, error = cls._prepareRun(experiment_id, experiment, run_config, user)
+    if error != None:
+      return {'status': 'failed', 'message': error}
+
+    # submit job to redis, claiming the experiment's index entry first so it can't be enqueued twice
+    conn = cls.getRedis()
+    with Connection(conn):
+      job_id = str(uuid.uuid4())
+      if not job_index.reserve(conn, experiment_id, job_id):
+        return {'status': 'failed', 'message': 'Experiment already enqueued or running'}
+      try:
+        q = Queue(run['priority'], connection=conn)
+        job = q.enqueue(
+          f=cls._startRunner,
+          args=run['args'],
+          job_id=job_id,
+          result_ttl=3600,
+          job_timeout=-1,
+          ttl=-1,
+          meta=run['meta'])
+      except:
+        job_index.release(conn, experiment_id, job_id)
+        raise
+      scheduling.placeJob(conn, q, job_id, run['share'], run['cost'])
+      events.publishJob(conn, job, 'queued')
 
     response_object = {
       'status': 'submitted',
@@ -118,59 +453,285 @@ class ParoptManager():
     return response_object
 
   @classmethod
-  def getRunningExperiments(cls):
-    """Returns experiments currently being run
+  def runTrialsBatch(cls, run_requests, user=None):
+    """Put several experiments into the job queues, loading them with one database query and enqueueing
+    them with one redis pipeline
+
+    Args:
+      run_requests([]dict): run configs as for runTrials, each with the `experiment_id` to run
+      user(str): user submitting the runs, for fair share scheduling
+
+    Returns:
+      results([]dict): result of each run request in order, as returned by runTrials
+    """
+    if not cls._started:
+      raise Exception("ParoptManager not started")
+
+    results = [None] * len(run_requests)
+    experiment_ids = {}
+    for i, run_config in enumerate(run_requests):
+      try:
+        experiment_ids[i] = int(run_config['experiment_id'])
+      except (TypeError, KeyError, ValueError):
+        results[i] = {'status': 'failed', 'message': "Each run must have an integer experiment_id"}
+    experiments = cls.getExperimentDicts(set(experiment_ids.values()))
+
+    runs = {}
+    batched_ids = set()
+    for i, experiment_id in sorted(experiment_ids.items()):
+      if experiment_id not in experiments:
+        results[i] = {'status': 'failed', 'message': "Experiment not found with id {}".format(experiment_id)}
+        continue
+      # a run earlier in the batch claims the experiment's index entry; skip preparing runs which can't claim it
+      if experiment_id in batched_ids:
+        results[i] = {'status': 'failed', 'message': 'Experiment already enqueued or running'}
+        continue
+      batched_ids.add(experiment_id)
+      run, error = cls._prepareRun(experiment_id, experiments[experiment_id], run_requests[i], user)
+      if error != None:
+        results[i] = {'status': 'failed', 'message': error}
+      else:
+        run['job_id'] = str(uuid.uuid4())
+        runs[i] = run
+
+    conn = cls.getRedis()
+    with Connection(conn):
+      # claim the experiments' index entries in one round trip; entries which are taken may be stale, in
+      # which case reserve drops and claims them
+      with conn.pipeline(transaction=False) as pipe:
+        for i, run in runs.items():
+          pipe.hsetnx(job_index.EXPERIMENT_JOBS_KEY, str(experiment_ids[i]), job_index.entryFor(run['job_id']))
+        claimed = dict(zip(runs, pipe.execute()))
+      for i in list(runs):
+        if not claimed[i] and not job_index.reserve(conn, experiment_ids[i], runs[i]['job_id']):
+          results[i] = {'status': 'failed', 'message': 'Experiment already enqueued or running'}
+          del runs[i]
+
+      jobs = {}
+      try:
+        with conn.pipeline(transaction=False) as pipe:
+          for i, run in runs.items():
+            q = Queue(run['priority'], connection=conn)
+            job = Job.create(
+              cls._startRunner,
+              args=run['args'],
+              connection=conn,
+              id=run['job_id'],
+              result_ttl=3600,
+              timeout=-1,
+              ttl=-1,
+              status=JobStatus.QUEUED,
+              origin=q.name,
+              meta=run['meta'])
+            jobs[i] = q.enqueue_job(job, pipeline=pipe)
+          # jobs are placed once they're all queued, in the order they were requested
+          for i, run in runs.items():
+            scheduling.placeJob(pipe, Queue(run['priority'], connection=conn), run['job_id'], run['share'], run['cost'])
+            events.publishJob(pipe, jobs[i], 'queued')
+          pipe.execute()
+      except:
+        for i, run in runs.items():
+          job_index.release(conn, experiment_ids[i], run['job_id'])
+        raise
+
+    for i, job in jobs.items():
+      results[i] = {
+        'status': 'submitted',
+        'job': {'job_id': job.get_id(), 'job_status': JobStatus.QUEUED, 'job_meta': job.meta},
+      }
+    return results
+
+  @classmethod
+  def _prepareRun(cls, experiment_id, experiment, run_config, user):
+    """Validate a run config and build the job for it
+
+    Args:
+      experiment_id(int): id of experiment to run
+      experiment(dict): experiment to run
+      run_config(dict): run config, see runTrials
+      user(str): user submitting the run
 
     Returns:
-      jobs(list): list of jobs that are being run
+      run(dict): `args` of _startRunner, queue (`priority`), fair `share`, estimated `cost` and job `meta`
+      error(str): why the run config is invalid; None if it's valid
+
+    The job's args are the experiment id and a spec of the run - the validated optimizer and cache configs and
+    the concurrency - which the worker rebuilds the run from (see loadRunSpec), so jobs stay small.
     """
-    with Connection(redis.from_url(current_app.config['REDIS_URL'])) as conn:
-      registry = StartedJobRegistry('default', connection=conn)
-      return [Job.fetch(id, connection=conn) for id in registry.get_job_ids()]
+    optimizer = getOptimizer(run_config.get('optimizer'))
+    if optimizer == None:
+      return None, "Invalid run configuration provided"
+    if isinstance(optimizer, HyperbandOptimizer):
+      error = checkFidelity(experiment['parameters'], optimizer.fidelity)
+      if error != None:
+        return None, error
+
+    # batch optimizers default to running a whole batch at once
+    default_concurrency = min(getattr(optimizer, 'batch_size', 1), MAX_TRIAL_CONCURRENCY)
+    try:
+      concurrency = int(run_config.get('concurrency', default_concurrency))
+    except (TypeError, ValueError):
+      concurrency = 0
+    if concurrency < 1 or concurrency > MAX_TRIAL_CONCURRENCY:
+      return None, "concurrency must be an integer from 1 to {}".format(MAX_TRIAL_CONCURRENCY)
+    if in_production and MAX_EC2_INSTANCES > 0 and concurrency > MAX_EC2_INSTANCES:
+      return None, "concurrency can't exceed the limit of {} EC2 instances".format(MAX_EC2_INSTANCES)
+
+    priority = run_config.get('priority', DEFAULT_QUEUE)
+    if priority not in QUEUE_NAMES:
+      return None, "priority must be one of {}".format(', '.join(QUEUE_NAMES))
+
+    trial_cache = getTrialCache(run_config.get('cache'))
+    if trial_cache == None:
+      return None, "Invalid cache configuration provided"
+
+    # validated here to fail fast; the job builds its own rules from the run spec
+    try:
+      getStoppingRules((run_config.get('optimizer') or {}).get('stopping'), experiment['compute'], concurrency)
+    except (TypeError, ValueError) as e:
+      return None, "Invalid stopping configuration provided: {}".format(e)
+
+    share = experiment['tool_name'] if FAIR_SHARE_BY == 'tool' else (user if user != None else 'anonymous')
+    cost = estimateTrials(run_config.get('optimizer'), experiment)
+    run_spec = {
+      'version': RUN_SPEC_VERSION,
+      'optimizer': run_config.get('optimizer'),
+      'cache': run_config.get('cache'),
+      'concurrency': concurrency,
+    }
+    return {
+      'args': (int(experiment_id), run_spec),
+      'priority': priority,
+      'share': share,
+      'cost': cost,
+      'meta': {
+        'experiment_id': str(experiment_id),
+        'priority': priority,
+        'share': share,
+        'trials_total': cost,
+        'resumable': isResumable(run_config.get('optimizer')),
+      },
+    }, None
+
+  @classmethod
+  def getRunningExperiments(cls, cursor=0, limit=None, fields=job_fetch.DEFAULT_FIELDS):
+    """Returns a page of experiments currently being run
+
+    Args:
+      cursor(int): offset of the first job of the page. It's a position in the registry rather than a key, so
+        jobs can be skipped or repeated across pages as jobs enter and leave the registry
+      limit(int): max number of jobs in the page; None for all of them
+      fields(tuple): job dict keys to include, see job_fetch.JOB_FIELDS
+
+    Returns:
+      jobs(list): dicts of jobs that are being run
+      next_cursor(int): cursor of the next page; None if there are no more jobs
+    """
+    conn = cls.getRedis()
+    with Connection(conn):
+      job_ids = _registryJobIds(conn, StartedJobRegistry, cursor, _pageCount(limit))
+      return cls._fetchJobPage(conn, job_ids, cursor, limit, fields)
   
   @classmethod
-  def getFailedExperiments(cls):
-    with Connection(redis.from_url(current_app.config['REDIS_URL'])) as conn:
-      registry = FailedJobRegistry('default', connection=conn)
-      return [Job.fetch(id, connection=conn) for id in registry.get_job_ids()]
+  def getFailedExperiments(cls, cursor=0, limit=None, fields=job_fetch.DEFAULT_FIELDS):
+    """Returns a page of failed experiments. See getRunningExperiments for args"""
+    conn = cls.getRedis()
+    with Connection(conn):
+      job_ids = _registryJobIds(conn, FailedJobRegistry, cursor, _pageCount(limit))
+      return cls._fetchJobPage(conn, job_ids, cursor, limit, fields)
   
   @classmethod
-  def getDeferredExperiments(cls):
-    with Connection(redis.from_url(current_app.config['REDIS_URL'])) as conn:
-      registry = DeferredJobRegistry('default', connection=conn)
-      return [Job.fetch(id, connection=conn) for id in registry.get_job_ids()]
+  def getDeferredExperiments(cls, cursor=0, limit=None, fields=job_fetch.DEFAULT_FIELDS):
+    """Returns a page of deferred experiments. See getRunningExperiments for args"""
+    conn = cls.getRedis()
+    with Connection(conn):
+      job_ids = _registryJobIds(conn, DeferredJobRegistry, cursor, _pageCount(limit))
+      return cls._fetchJobPage(conn, job_ids, cursor, limit, fields)
   
   @classmethod
-  def getQueuedJobs(cls):
-    """Get a list of currently enqueued jobs"""
-    with Connection(redis.from_url(current_app.config['REDIS_URL'])):
-      q = Queue()
-      return q.jobs # Gets a list of enqueued job instances
+  def getQueuedJobs(cls, cursor=0, limit=None, fields=job_fetch.DEFAULT_FIELDS):
+    """Get a page of currently enqueued jobs, in priority and then run order. See getRunningExperiments for args"""
+    conn = cls.getRedis()
+    with Connection(conn):
+      job_ids = _pageJobIds(
+        [Queue(name, connection=conn) for name in QUEUE_NAMES],
+        lambda q, offset, count: q.get_job_ids(offset, -1 if count == None else count),
+        cursor,
+        _pageCount(limit))
+      return cls._fetchJobPage(conn, job_ids, cursor, limit, fields)
+
+  @classmethod
+  def _fetchJobPage(cls, conn, job_ids, cursor, limit, fields):
+    """Fetch a page of jobs with one pipelined round trip
+
+    Args:
+      job_ids([]str): up to limit + 1 job ids starting at cursor; the extra id tells if there's a next page.
+        All of them if limit is None
+
+    Returns:
+      jobs(list): job dicts
+      next_cursor(int): cursor of the next page; None if there are no more jobs
+    """
+    if limit == None:
+      return job_fetch.fetchJobDicts(conn, job_ids, fields), None
+    next_cursor = cursor + limit if len(job_ids) > limit else None
+    return job_fetch.fetchJobDicts(conn, job_ids[:limit], fields), next_cursor
   
+  @classmethod
+  def streamEvents(cls, experiment_id, after_id=None):
+    """Stream job status changes and recorded trials of an experiment as they happen, see events.streamEvents
+
+    Args:
+      experiment_id(str): id of experiment
+      after_id(int): first send the stored trials after this trial id, eg the last one the client received;
+        None to only send new trials
+
+    Returns:
+      stream(EventStream): (event, data) tuples, starting with the experiment's current job if it has one;
+        None if the process already has EVENTS_MAX_STREAMS streams open. Close it once done
+    """
+    if not cls.event_streams.acquire():
+      return None
+    catch_up = None
+    if after_id != None:
+      catch_up = lambda: cls.iterTrials(experiment_id, after_id=after_id)
+    def snapshot():
+      job = cls.getExperimentJob(experiment_id)
+      return events.jobEvent(job) if job != None else None
+    return events.EventStream(
+      cls.getDedicatedRedis(),
+      experiment_id,
+      on_close=cls.event_streams.release,
+      catch_up=catch_up,
+      after_id=after_id,
+      snapshot=snapshot,
+      keepalive=EVENTS_KEEPALIVE,
+      max_seconds=EVENTS_MAX_SECONDS)
+
   @classmethod
   def getExperimentJob(cls, experiment_id):
     """Get job of an experiment - either enqueued or running"""
+    return cls._fetchIndexedJob(experiment_id, job_index.ACTIVE_STATUSES)
 
-    # check running jobs
-    running_jobs = cls.getRunningExperiments()
-    for job in running_jobs:
-      current_app.logger.info('Currently running: {}'.format(job))
-      if job.get_status() != 'finished' and job.meta.get('experiment_id') == str(experiment_id):
-        return job
-
-    # check queued jobs
-    queued_jobs = cls.getQueuedJobs()
-    for job in queued_jobs:
-      current_app.logger.info('Enqueued job: {}'.format(job))
-      if job.get_status() != 'finished' and job.meta.get('experiment_id') == str(experiment_id):
-        return job
-    
-    # job not found
-    return None
+  @classmethod
+  def _fetchIndexedJob(cls, experiment_id, statuses):
+    """Fetch the experiment's active job from the job index if its status is one of statuses"""
+    conn = cls.getRedis()
+    with Connection(conn):
+      indexed_job = job_index.lookup(conn, experiment_id)
+      if indexed_job == None or indexed_job[1] not in statuses:
+        return None
+      job_id, _ = indexed_job
+      try:
+        return Job.fetch(job_id, connection=conn)
+      except NoSuchJobError:
+        job_index.release(conn, experiment_id, job_id)
+        return None
   
   @classmethod
   def getJob(cls, job_id):
-    with Connection(redis.from_url(current_app.config['REDIS_URL'])) as conn:
+    conn = cls.getRedis()
+    with Connection(conn):
       job = None
       try:
         job = Job.fetch(job_id, connection=conn)
@@ -191,6 +752,7 @@ class ParoptManager():
         'job_status': job.get_status(),
         'job_result': job.result,
         'job_meta': job.meta,
+        'job_progress': progress.getProgress(job.connection, job.get_id()),
         'job_exc_info': job.exc_info
       }
   
@@ -202,30 +764,106 @@ class ParoptManager():
     Returns:
       experiment(Job): is None if not currently running
     """
-    jobs = cls.getRunningExperiments()
-    for job in jobs:
-      if job.get_status() != 'finished' and job.meta.get('experiment_id') == str(experiment_id):
-        return job
-    return None
+    return cls._fetchIndexedJob(experiment_id, ('started',))
 
   @classmethod
-  def getTrials(cls, experiment_id):
+  def getTrials(cls, experiment_id, **kwargs):
     """Gets previous trials for experiment
     Args:
       experiment_id(str): id of experiment
+      kwargs: filters, sorting and paging, see iterTrialChunks
     Returns:
       trials([]dict): List of trials in dict representation
     """
-    session = cls.db_storage.Session()
-    try:
-      trials = cls.db_storage.getTrials(session, experiment_id)
-      trials_dicts = [trial.asdict() for trial in trials]
-    except:
-      session.rollback()
-      raise
-    finally:
-      session.close()
-    return trials_dicts
+    return list(cls.iterTrials(experiment_id, **kwargs))
+
+  @classmethod
+  def iterTrials(cls, experiment_id, **kwargs):
+    """Iterate over trials of experiment as dicts, loading them from the database in chunks
+    Args:
+      experiment_id(str): id of experiment
+      kwargs: filters, sorting and paging, see iterTrialChunks
+    Yields:
+      trial(dict): trial in dict representation
+    """
+    for chunk in cls.iterTrialChunks(experiment_id, **kwargs):
+      for trial_dict in chunk:
+        yield trial_dict
+
+  @classmethod
+  def iterTrialChunks(cls, experiment_id, after_id=None, limit=None, sort=None, descending=False,
+                      min_objective=None, max_objective=None, since=None, until=None,
+                      chunk_size=TRIALS_CHUNK_SIZE, convert=None):
+    """Iterate over chunks of trials of experiment using keyset pagination
+
+    Each chunk is loaded with its own short lived session so that a slow consumer doesn't hold a
+    database connection, and no more than one chunk of trials is ever held in memory.
+
+    Args:
+      experiment_id(str): id of experiment
+      after_id(int): only trials with id greater than this (ignored when sorting by objective)
+      limit(int): max number of trials; None for all
+      sort(str): 'id' (default) or 'objective'
+      descending(bool): sort objective from highest to lowest
+      min_objective(float): only trials with outcome >= min_objective
+      max_objective(float): only trials with outcome <= max_objective
+      since(datetime): only trials recorded at or after this (UTC)
+      until(datetime): only trials recorded before this (UTC)
+      chunk_size(int): number of trials loaded per query
+      convert(callable): applied to each Trial while its session is open; defaults to trialToDict
+
+    Yields:
+      chunk(list): converted trials
+    """
+    convert = convert if convert != None else trialToDict
+    by_objective = sort == 'objective'
+    order_column = Trial.outcome.desc() if descending else Trial.outcome.asc()
+    last = None
+    remaining = limit
+    while remaining == None or remaining > 0:
+      session = cls.db_storage.Session()
+      try:
+        query = session.query(Trial).filter(Trial.experiment_id == experiment_id)
+        if min_objective != None:
+          query = query.filter(Trial.outcome >= min_objective)
+        if max_objective != None:
+          query = query.filter(Trial.outcome <= max_objective)
+        if since != None:
+          query = query.filter(Trial.timestamp >= since)
+        if until != None:
+          query = query.filter(Trial.timestamp < until)
+
+        if by_objective:
+          query = query.filter(Trial.outcome != None)
+          if last != None:
+            # keyset on (outcome, id) so chunks continue where the previous one ended
+            last_outcome, last_id = last
+            past_outcome = Trial.outcome < last_outcome if descending else Trial.outcome > last_outcome
+            query = query.filter(or_(past_outcome, and_(Trial.outcome == last_outcome, Trial.id > last_id)))
+          query = query.order_by(order_column, Trial.id.asc())
+        else:
+          last_id = last[1] if last != None else after_id
+          if last_id != None:
+            query = query.filter(Trial.id > last_id)
+          query = query.order_by(Trial.id.asc())
+
+        batch_size = chunk_size if remaining == None else min(chunk_size, remaining)
+        trials = query.options(selectinload(Trial.parameter_configs)).limit(batch_size).all()
+        if len(trials) == 0:
+          return
+        last = (trials[-1].outcome, trials[-1].id)
+        chunk = [convert(trial) for trial in trials]
+      except:
+        session.rollback()
+        raise
+      finally:
+        session.close()
+
+      yield chunk
+      if remaining != None:
+        remaining -= len(chunk)
+      if len(chunk) < batch_size:
+        return
 
   @classmethod
   def dictToExperiment(cls, experiment_dict):
@@ -260,16 +898,92 @@ class ParoptManager():
       raise
     finally:
       session.close()
+    cls.experiment_cache.put(experiment_dict)
     return experiment_dict
   
+  @classmethod
+  def getOrCreateExperiments(cls, experiment_dicts):
+    """Get or create several experiments in one database transaction
+
+    Each experiment is created in a savepoint, so an invalid one is rolled back on its own and the rest are
+    committed together at the end.
+
+    Args:
+      experiment_dicts([]dict): dictionary representations of Experiments
+
+    Returns:
+      results([]dict): for each experiment in order, status 'success' with the new or fetched `experiment`
+        as a dict, or status 'failed' with a message
+    """
+    results = []
+    session = cls.db_storage.Session()
+    try:
+      for experiment_dict in experiment_dicts:
+        savepoint = session.begin_nested()
+        try:
+          experiment = cls.dictToExperiment(dict(experiment_dict))
+          # the storage commits new experiments, which only releases the savepoint
+          experiment, _, _ = cls.db_storage.getOrCreateExperiment(session, experiment)
+          if savepoint.is_active:
+            savepoint.commit()
+          results.append({'status': 'success', 'experiment': experiment.asdict()})
+        except Exception as e:
+          if savepoint.is_active:
+            savepoint.rollback()
+          results.append({'status': 'failed', 'message': 'Failed to get/create experiment: {}'.format(e)})
+      session.commit()
+    except:
+      session.rollback()
+      raise
+    finally:
+      session.close()
+    for result in results:
+      if result['status'] == 'success':
+        cls.experiment_cache.put(result['experiment'])
+    return results
+
+  @classmethod
+  def getExperimentDicts(cls, experiment_ids):
+    """Get several experiments as dicts, from the experiment cache or with one query
+
+    Args:
+      experiment_ids([]int): ids of experiments
+
+    Returns:
+      experiments(dict): experiment dicts by id; missing experiments are left out
+    """
+    return cls.experiment_cache.getMany(experiment_ids, cls._loadExperimentDicts)
+
+  @classmethod
+  def _loadExperimentDicts(cls, experiment_ids):
+    if len(experiment_ids) == 0:
+      return {}
+    session = cls.db_storage.Session()
+    try:
+      experiments = (session.query(Experiment)
+        .filter(Experiment.id.in_(list(experiment_ids)))
+        .options(selectinload(Experiment.parameters), selectinload(Experiment.compute))
+        .all())
+      experiment_dicts = {experiment.id: experiment.asdict() for experiment in experiments}
+    except:
+      session.rollback()
+      raise
+    finally:
+      session.close()
+    return experiment_dicts
+
   @classmethod
   def getExperimentDict(cls, experiment_id):
-    """Get experiment as a dict
+    """Get experiment as a dict, from the experiment cache or the database
     Args:
       experiment_id(str): id of experiment
     Returns:
       experiment(Experiment): dict of found experiment; None if not found
     """
+    return cls.experiment_cache.get(experiment_id, cls._loadExperimentDict)
+
+  @classmethod
+  def _loadExperimentDict(cls, experiment_id):
     session = cls.db_storage.Session()
     try:
       experiment = cls.db_storage.getExperiment(session, experiment_id)
@@ -281,50 +995,339 @@ class ParoptManager():
       session.close()
     return experiment_dict
 
+  @classmethod
+  def getTrialSummary(cls, experiment_id):
+    """Get a summary of an experiment's trials, from the trial summary cache or the database
+
+    Args:
+      experiment_id(int): id of experiment
+
+    Returns:
+      summary(dict): `trial_count`, `best_objective` (lowest outcome of a trial at full fidelity, see
+        fidelities; None without such trials) and
+        `last_trial_at` (when the last trial was recorded, as an ISO 8601 UTC string; None without trials)
+    """
+    return cls.trial_summary_cache.get(cls.getRedis(), experiment_id, cls._loadTrialSummary)
+
+  @classmethod
+  def _loadTrialSummary(cls, experiment_id):
+    session = cls.db_storage.Session()
+    try:
+      # partial runs of multi-fidelity optimizers aren't comparable with full runs
+      best_outcome = case([(fidelities.fullFidelityClause(), Trial.outcome)])
+      trial_count, best_objective, last_trial_at = (session.query(
+          func.count(Trial.id), func.min(best_outcome), func.max(Trial.timestamp))
+        .filter(Trial.experiment_id == experiment_id)
+        .one())
+    except:
+      session.rollback()
+      raise
+    finally:
+      session.close()
+    return {
+      'trial_count': trial_count,
+      'best_objective': best_objective,
+      'last_trial_at': last_trial_at.isoformat() if last_trial_at != None else None,
+    }
+
+  @classmethod
+  def getParetoFront(cls, experiment_id, scope='tool'):
+    """Get the trials on the pareto front of runtime against EC2 cost, see pareto. Only trials at the full
+    fidelity count, see fidelities
+
+    Args:
+      experiment_id(int): id of experiment
+      scope(str): 'tool' to compare the experiment with the experiments running the same tool (same
+        tool_name and command template) on other instance models, or 'experiment' for the experiment alone
+
+    Returns:
+      front(dict): None if the experiment isn't found
+        objectives: names of the objectives, ie runtime and cost
+        front: non-dominated trials by increasing runtime, each with its `experiment_id`, `instance_model`,
+          `runtime`, `cost` (USD) and `trial`
+        unpriced_experiment_ids: experiments left out because the price of their instance model isn't known
+    """
+    experiment = cls.getExperimentDict(experiment_id)
+    if experiment == None:
+      return None
+    session = cls.db_storage.Session()
+    try:
+      if scope == 'tool':
+        experiments = (session.query(Experiment)
+          .filter(Experiment.tool_name == experiment['tool_name'])
+          .filter(Experiment.command_template_string == experiment['command_template_string'])
+          .options(selectinload(Experiment.compute))
+          .all())
+        prices = {other.id: EC2_HOURLY_PRICES.get(other.compute.instance_model) for other in experiments}
+        instance_models = {other.id: other.compute.instance_model for other in experiments}
+      else:
+        prices = {experiment['id']: EC2_HOURLY_PRICES.get(experiment['compute'].get('instance_model'))}
+        instance_models = {experiment['id']: experiment['compute'].get('instance_model')}
+      priced_ids = [other_id for other_id, price in prices.items() if price != None]
+
+      # cost grows with runtime within an experiment, so only its fastest trials can be on the front; partial
+      # runs of multi-fidelity optimizers never did the full work, so they're left out
+      fastest = (session.query(Trial.experiment_id, func.min(Trial.outcome).label('outcome'))
+        .filter(Trial.experiment_id.in_(priced_ids), Trial.outcome != None, fidelities.fullFidelityClause())
+        .group_by(Trial.experiment_id)
+        .subquery())
+      trials = (session.query(Trial)
+        .join(fastest, and_(Trial.experiment_id == fastest.c.experiment_id, Trial.outcome == fastest.c.outcome))
+        .filter(fidelities.fullFidelityClause())
+        .options(selectinload(Trial.parameter_configs))
+        .order_by(Trial.id)
+        .all()) if len(priced_ids) > 0 else []
+      points = [(trial.outcome, pareto.trialCost(trial.outcome, prices[trial.experiment_id]), trialToDict(trial))
+        for trial in trials]
+    except:
+      session.rollback()
+      raise
+    finally:
+      session.close()
+
+    return {
+      'objectives': list(pareto.OBJECTIVES),
+      'front': [{
+        'experiment_id': trial_dict['experiment_id'],
+        'instance_model': instance_models[trial_dict['experiment_id']],
+        'runtime': runtime,
+        'cost': cost,
+        'trial': trial_dict,
+      } for runtime, cost, trial_dict in pareto.paretoFront(points)],
+      'unpriced_experiment_ids': sorted(other_id for other_id, price in prices.items() if price == None),
+    }
+
   @classmethod
   def stopExperiment(cls, experiment_id):
     """Stops running an experiment
+    A queued job is cancelled. A running job is signalled to stop; it finishes the trials in progress,
+    shuts down its compute and ends with the trials recorded so far.
+
     Args:
       experiment_id(str): experiment to stop
+
+    Returns:
+      result(dict): status is 'cancelled', 'stopping', 'pending' if the experiment's job is still being enqueued,
+        or 'failed' if the experiment has no active job
     """
-    return {'message': 'this functionality is not implemented yet'}
+    conn = cls.getRedis()
+    with Connection(conn):
+      indexed_job = job_index.lookup(conn, experiment_id)
+      if indexed_job == None:
+        return {'status': 'failed', 'message': 'Experiment is not queued or running'}
+      job_id, status = indexed_job
+      if status == job_index.PENDING_STATUS:
+        return {'status': 'pending', 'message': 'Experiment is being queued, try again shortly'}
+      try:
+        job = Job.fetch(job_id, connection=conn)
+      except NoSuchJobError:
+        job_index.release(conn, experiment_id, job_id)
+        return {'status': 'failed', 'message': 'Experiment is not queued or running'}
+      if status != 'started':
+        # a worker may pick the job up meanwhile, in which case it isn't removed and has to be signalled instead
+        if status == 'deferred':
+          removed = DeferredJobRegistry(job.origin, connection=conn).remove(job) > 0
+        else:
+          removed = Queue(name=job.origin, connection=conn).remove(job) > 0
+        if removed:
+          scheduling.jobRemoved(conn, job.origin, job_id)
+          job_dict = cls.jobToDict(job)
+          job.delete()
+          job_index.release(conn, experiment_id, job_id)
+          events.publishJob(conn, job, 'cancelled')
+          return {'status': 'cancelled', 'job': job_dict}
+      job_control.requestStop(conn, job_id)
+      events.publishJob(conn, job, 'stopping')
+      return {'status': 'stopping', 'job': cls.jobToDict(job)}
 
   @classmethod
-  def _startRunner(cls, experiment_dict, optimizer):
+  def _startRunner(cls, experiment_id, run_spec):
     """Runs an experiment with paropt. This is the function used for job queueing
 
     Args:
-      experiment_dict(dict): dict representation of experiment to run.
-        Although it's a dict, the experiment it represents should already exist in the database.
-      optimizer(Optimizer): Optimizer instance to use for running the experiment
-    
+      experiment_id(int): id of experiment to run
+      run_spec(dict): spec of the run: optimizer and cache configs and concurrency, see loadRunSpec
+
     Returns:
-      result(dict): result of the run
+      result(dict): summary of the result of the run when run as a job, see run_results.summarizeResult; the
+        full result is saved to the database under the job's id. The full result otherwise
     
     Raises:
-      Exception: when the runner fails, it will raise an exception with the message from the result
+      Exception: when the runner fails, it will raise an exception with the errors from the result
     """
-    paropt.setConsoleLogger()
+    # workers with a compute pool run jobs in the same process, only set up logging once
+    if not cls._console_logger_set:
+      paropt.setConsoleLogger()
+      cls._console_logger_set = True
+    experiment_dict = cls.getExperimentDict(experiment_id)
+    if experiment_dict == None:
+      raise Exception("Experiment not found with id {}".format(experiment_id))
+    optimizer, concurrency, trial_cache, stopping_rules = loadRunSpec(run_spec, experiment_dict['compute'])
+    experiment_fidelities = cls._loadFidelities(
+      experiment_id, optimizer.fidelity if isinstance(optimizer, HyperbandOptimizer) else None)
+    parsl_config = getParslConfig(experiment_dict['compute'], concurrency)
+    compute_key = getComputeKey(experiment_dict['compute'])
     experiment = cls.dictToExperiment(experiment_dict)
-    storage = RelationalDB(
-      'postgresql',
-      DB_USER,
-      DB_PASSWORD,
-      DB_HOST,
-      DB_NAME
-    )
-
-    po = ParslRunner(
+    # stop requests from the API are flagged in redis under the job's id
+    job = get_current_job()
+    stop_requested = None
+    reporter = None
+    conn = cls.getRedis()
+    def on_flush(trials):
+      # summaries cached before the trials were saved are out of date
+      read_cache.invalidateTrialSummary(conn, experiment_id)
+    def on_trial(trial):
+      if job != None:
+        events.publish(job.connection, job.meta['experiment_id'], 'trial', trialToDict(trial))
+    if job != None:
+      stop_requested = lambda: job_control.isStopRequested(job.connection, job.id)
+      reporter = progress.ProgressReporter(job.connection, job, PROGRESS_INTERVAL, job.meta.get('trials_total'))
+      reporter.report({'phase': 'admission', 'trials_done': 0}, force=True)
+      if job.meta.get('recoveries', 0) > 0:
+        optimizer = cls._resumeRun(job, run_spec, trial_cache)
+
+    admission_wait = cls._awaitInstances(compute_key, concurrency, stop_requested)
+    if admission_wait == None:
+      job_control.clearStop(job.connection, job.id)
+      return {'success': True, 'message': {}, 'stopped': 'stop requested'}
+    if job != None:
+      job.meta['admission_wait_seconds'] = admission_wait
+      # recovery releases the instances (and shuts down the blocks) held under it if this worker is lost
+      job.meta['instance_holder'] = instanceHolder()
+      job.save_meta()
+    on_blocks = None
+    if in_production:
+      on_blocks = lambda block_ids: scheduling.recordBlocks(conn, instanceHolder(), block_ids)
+
+    po = ConcurrentRunner(
       parsl_app=timeCommand,
       optimizer=optimizer,
-      storage=storage,
+      storage=cls.db_storage,
       experiment=experiment,
-      logs_root_dir='/var/log/paropt')
-    po.run(debug=True)
-    # cleanup launched instances
-    po.cleanup()
+      parsl_config=parsl_config,
+      concurrency=concurrency,
+      logs_root_dir='/var/log/paropt',
+      trial_cache=trial_cache,
+      stopping_rules=stopping_rules,
+      stop_requested=stop_requested,
+      compute_pool=cls.compute_pool,
+      compute_key=compute_key,
+      worker_probe=worker_env.workerInfo,
+      paropt_version=worker_env.pinnedVersion(),
+      setup_timeout=WORKER_SETUP_TIMEOUT,
+      on_trial=on_trial,
+      on_progress=reporter.report if reporter != None else None,
+      flush_size=TRIAL_FLUSH_SIZE,
+      flush_seconds=TRIAL_FLUSH_SECONDS,
+      on_blocks=on_blocks,
+      on_flush=on_flush,
+      fidelities=experiment_fidelities)
+    try:
+      po.run()
+    finally:
+      # checkouts of the process running the job; work horses are forked per job, so these are the run's own
+      po.run_result['db_pool'] = cls.db_storage.engine.pool.stats()
+      # cleanup launched instances, or keep them warm in the compute pool
+      po.cleanup()
+      # instances kept warm stay held by the worker until the compute pool shuts them down
+      if cls.compute_pool == None or not cls.compute_pool.holdsBlocks():
+        scheduling.releaseInstances(cls.getRedis(), instanceHolder())
+      if job != None:
+        job_control.clearStop(job.connection, job.id)
+        if 'compute' in po.run_result:
+          compute_pool.recordRun(job.connection, po.run_result['compute'])
+
+    summary = run_results.summarizeResult(po.run_result)
+    if job != None:
+      session = cls.db_storage.Session()
+      try:
+        run_results.saveRunResult(session, job.id, experiment_id, po.run_result)
+      except:
+        session.rollback()
+        raise
+      finally:
+        session.close()
 
     if po.run_result['success'] == False:
-      raise Exception(po.run_result['message'])
+      raise Exception(summary['errors'])
 
-    return po.run_result
+    return summary if job != None else po.run_result
+
+  @classmethod
+  def _loadFidelities(cls, experiment_id, fidelity=None):
+    """Get the names of an experiment's fidelity parameters, first recording fidelity if given, see fidelities"""
+    session = cls.db_storage.Session()
+    try:
+      if fidelity != None:
+        fidelities.recordFidelity(session, experiment_id, fidelity)
+      return fidelities.getFidelities(session, experiment_id)
+    except:
+      session.rollback()
+      raise
+    finally:
+      session.close()
+
+  @classmethod
+  def getRunResult(cls, job_id):
+    """Get the full result of a job's run
+    Args:
+      job_id(str): id of job
+    Returns:
+      run_result(dict): `job_id`, `experiment_id`, `recorded_at` and the run's `result`; None if the job
+        hasn't finished or isn't found
+    """
+    session = cls.db_storage.Session()
+    try:
+      run_result = run_results.getRunResult(session, job_id)
+    except:
+      session.rollback()
+      raise
+    finally:
+      session.close()
+    return run_result
+
+  @classmethod
+  def _resumeRun(cls, job, run_spec, trial_cache):
+    """Set up a run recovered from a lost worker to continue from the trials it already recorded
+
+    Trials recorded since the job first started are reused even if the run's cache policy wouldn't, and
+    bayesian optimization is warm started with the experiment's stored trials, see getResumeOptimizer.
+
+    Args:
+      job(Job): job of the run
+      run_spec(dict): spec the job was enqueued with
+      trial_cache(TrialCache): cache built from the run spec, updated in place
+
+    Returns:
+      optimizer(Optimizer)
+
+    Raises:
+      Exception: if the run's optimizer can't resume it
+    """
+    optimizer = getResumeOptimizer(run_spec['optimizer'])
+    if optimizer == None:
+      raise Exception("Run was interrupted and its optimizer can't resume it")
+    first_started_at = job.meta.get('first_started_at')
+    if first_started_at != None:
+      trial_cache.resume_since = datetime.datetime.utcfromtimestamp(first_started_at)
+    return optimizer
+
+  @classmethod
+  def _awaitInstances(cls, compute_key, concurrency, stop_requested=None):
+    """Wait until the run's EC2 instances can be launched without exceeding MAX_EC2_INSTANCES
+
+    Returns:
+      waited(float): seconds waited; None if a stop was requested while waiting
+    """
+    if not in_production or MAX_EC2_INSTANCES <= 0:
+      return 0.0
+    # warm blocks are already held by this worker
+    if cls.compute_pool != None and cls.compute_pool.isWarm(compute_key, concurrency):
+      return 0.0
+    conn = cls.getRedis()
+    started_at = time.time()
+    while not scheduling.acquireInstances(conn, instanceHolder(), concurrency, MAX_EC2_INSTANCES):
+      if stop_requested != None and stop_requested():
+        return None
+      time.sleep(ADMISSION_POLL_SECONDS)
+    return time.time() - started_at
@@ -0,0 +1,57 @@
+"""Progress reports of running jobs
+
+Progress is kept as json in its own field of the job's redis hash rather than in the pickled job meta, so
+reporting it doesn't rewrite the meta and reading it doesn't unpickle anything. RQ leaves unknown fields
+of the hash alone, and the field is deleted with the job.
+"""
+import json
+import time
+
+from rq.job import Job
+
+from . import events
+
+PROGRESS_FIELD = 'progress'
+
+class ProgressReporter():
+  """Writes a job's progress at most once every `interval` seconds, unless forced
+
+  Each report also goes out as a `progress` event to the experiment's subscribers.
+  """
+  def __init__(self, conn, job, interval, trials_total=None):
+    """
+    Args:
+      conn(Redis): redis connection
+      job(Job): job to report progress of
+      interval(float): min seconds between reports
+      trials_total(int): estimated number of trials of the run; None if unknown
+    """
+    self.conn = conn
+    self.job = job
+    self.interval = interval
+    self.trials_total = trials_total
+    self._reported_at = None
+
+  def report(self, progress, force=False):
+    """Write progress if the last report is older than interval
+
+    Args:
+      progress(dict): current progress, see ConcurrentRunner
+      force(bool): write even if the last report is recent, eg on a change of phase
+
+    Returns:
+      reported(bool): False if the report was skipped
+    """
+    now = time.time()
+    if not force and self._reported_at != None and now - self._reported_at < self.interval:
+      return False
+    self._reported_at = now
+    progress = dict(progress, trials_total=self.trials_total, updated_at=now)
+    self.conn.hset(self.job.key, PROGRESS_FIELD, json.dumps(progress))
+    events.publishProgress(self.conn, self.job, progress)
+    return True
+
+def getProgress(conn, job_id):
+  """Returns the last reported progress of a job; None if it hasn't reported any"""
+  raw = conn.hget(Job.key_for(job_id), PROGRESS_FIELD)
+  return json.loads(raw) if raw else None
@@ -0,0 +1,157 @@
+"""Read-through caches of experiments and trial summaries, so hot reads (eg dashboards polling an experiment)
+don't reach the database
+"""
+import collections
+import copy
+import json
+import threading
+
+TRIAL_SUMMARY_KEY_TEMPLATE = 'paropt:cache:trial_summary:{}'
+
+class _Counters():
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._counters = {'hits': 0, 'misses': 0}
+
+  def count(self, name, n=1):
+    with self._lock:
+      self._counters[name] += n
+
+  def stats(self):
+    with self._lock:
+      stats = dict(self._counters)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups > 0 else None
+    return stats
+
+class ExperimentCache():
+  """Thread-safe LRU cache of experiment dicts, kept in process
+
+  Experiments don't change once they're created, so cached experiments are never invalidated, only evicted.
+  Experiments which aren't found aren't cached, as they may be created later. Callers get their own copy
+  of each experiment, which they're free to modify.
+  """
+  def __init__(self, max_size=1000):
+    """
+    Args:
+      max_size(int): max number of cached experiments; least recently used experiments are evicted first
+    """
+    self.max_size = max_size
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()
+    self._counters = _Counters()
+
+  def get(self, experiment_id, load):
+    """Get an experiment from the cache, or load it on a miss
+
+    Args:
+      experiment_id(int): id of experiment
+      load(callable): returns the dict of an experiment from its id, or None if it isn't found
+
+    Returns:
+      experiment(dict): dict of the experiment; None if not found
+    """
+    experiment_dict = self._lookup(experiment_id)
+    if experiment_dict != None:
+      self._counters.count('hits')
+      return experiment_dict
+    self._counters.count('misses')
+    experiment_dict = load(experiment_id)
+    if experiment_dict != None:
+      self.put(experiment_dict)
+    return experiment_dict
+
+  def getMany(self, experiment_ids, load_many):
+    """Get several experiments, loading the ones which aren't cached at once
+
+    Args:
+      experiment_ids([]int): ids of experiments
+      load_many(callable): returns experiment dicts by id for a list of ids, leaving out missing experiments
+
+    Returns:
+      experiments(dict): experiment dicts by id; missing experiments are left out
+    """
+    experiment_dicts = {}
+    missing = []
+    for experiment_id in experiment_ids:
+      experiment_dict = self._lookup(experiment_id)
+      if experiment_dict != None:
+        experiment_dicts[experiment_id] = experiment_dict
+      else:
+        missing.append(experiment_id)
+    self._counters.count('hits', len(experiment_dicts))
+    self._counters.count('misses', len(missing))
+    if len(missing) > 0:
+      loaded = load_many(missing)
+      for experiment_dict in loaded.values():
+        self.put(experiment_dict)
+      experiment_dicts.update(loaded)
+    return experiment_dicts
+
+  def put(self, experiment_dict):
+    """Cache an experiment dict, eg one just created; it must have its id"""
+    key = str(experiment_dict['id'])
+    experiment_dict = copy.deepcopy(experiment_dict)
+    with self._lock:
+      self._entries[key] = experiment_dict
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+
+  def _lookup(self, experiment_id):
+    key = str(experiment_id)
+    with self._lock:
+      experiment_dict = self._entries.get(key)
+      if experiment_dict == None:
+        return None
+      self._entries.move_to_end(key)
+    return copy.deepcopy(experiment_dict)
+
+  def stats(self):
+    stats = self._counters.stats()
+    with self._lock:
+      stats['size'] = len(self._entries)
+    return stats
+
+class TrialSummaryCache():
+  """Cache of per experiment trial summaries (count, best objective and time of the last trial), kept in redis
+
+  Summaries are shared by all processes, so a worker saving trials invalidates them for every server process
+  (see invalidateTrialSummary). They also expire after `ttl` seconds, bounding how long a summary computed
+  while trials were being saved can be stale.
+  """
+  def __init__(self, ttl=300):
+    """
+    Args:
+      ttl(int): max seconds a summary is cached
+    """
+    self.ttl = ttl
+    self._counters = _Counters()
+
+  def get(self, conn, experiment_id, load):
+    """Get an experiment's trial summary from the cache, or load it on a miss
+
+    Args:
+      conn(Redis): redis connection
+      experiment_id(int): id of experiment
+      load(callable): returns the trial summary dict of an experiment from its id
+
+    Returns:
+      summary(dict): trial summary, see load
+    """
+    key = TRIAL_SUMMARY_KEY_TEMPLATE.format(experiment_id)
+    raw = conn.get(key)
+    if raw != None:
+      self._counters.count('hits')
+      return json.loads(raw)
+    self._counters.count('misses')
+    summary = load(experiment_id)
+    conn.set(key, json.dumps(summary), ex=self.ttl)
+    return summary
+
+  def stats(self):
+    return self._counters.stats()
+
+def invalidateTrialSummary(conn, experiment_id):
+  """Drop the cached trial summary of an experiment, eg once trials of it are saved"""
+  conn.delete(TRIAL_SUMMARY_KEY_TEMPLATE.format(experiment_id))
@@ -0,0 +1,175 @@
+"""Leases of running jobs and recovery of jobs orphaned by dead workers
+
+A worker holds a lease on the job it's running, and renews it with each of its heartbeats. A job in a started
+registry whose lease expired (or which has none) lost its worker: it's requeued to resume from the trials
+already stored for its experiment, or failed once it has been recovered `max_recoveries` times or if its
+optimizer can't resume a run. Either way, the EC2 instances the lost worker held for it are released and its
+blocks shut down, so they don't count against the instance limit (and cost) forever.
+"""
+import datetime
+import logging
+import os
+import time
+
+from rq import Queue
+from rq.job import Job, JobStatus
+from rq.exceptions import NoSuchJobError
+from rq.registry import StartedJobRegistry, FailedJobRegistry
+
+from . import job_index, events, progress, scheduling
+
+logger = logging.getLogger(__name__)
+
+# sorted set of running job ids, scored by when their lease expires
+LEASES_KEY = 'paropt:leases'
+STATS_KEY = 'paropt:recovery'
+
+def renewLease(conn, job_id, ttl):
+  conn.zadd(LEASES_KEY, {job_id: time.time() + ttl})
+
+def releaseLease(conn, job_id):
+  conn.zrem(LEASES_KEY, job_id)
+
+def releaseWorkerInstances(conn, holder, terminate_blocks=None):
+  """Release the EC2 instances held by a lost worker, shutting down the blocks it recorded
+
+  Args:
+    conn(Redis): redis connection
+    holder(str): name the worker held instances under, see scheduling.acquireInstances
+    terminate_blocks(callable): shuts down blocks from their ids; None if blocks don't outlive their worker
+  """
+  block_ids = scheduling.heldBlocks(conn, holder)
+  if terminate_blocks != None and len(block_ids) > 0:
+    try:
+      terminate_blocks(block_ids)
+      logger.info('Shut down blocks {} of lost worker {}'.format(', '.join(block_ids), holder))
+    except Exception:
+      logger.exception('Failed to shut down blocks {} of lost worker {}'.format(', '.join(block_ids), holder))
+  scheduling.releaseInstances(conn, holder)
+
+def releaseDeadLocalHolders(conn, hostname, terminate_blocks=None):
+  """Release the EC2 instances held by processes of this host which are no longer running, eg after a restart
+
+  Holders on other hosts are left alone: their runs may still be live, and lost ones are released by lease
+  recovery.
+
+  Args:
+    conn(Redis): redis connection
+    hostname(str): name of this host
+    terminate_blocks(callable): shuts down the blocks of lost workers, see releaseWorkerInstances
+
+  Returns:
+    released([]str): names of the released holders
+  """
+  released = []
+  for holder in scheduling.holders(conn):
+    holder_hostname, pid = scheduling.parseHolderName(holder)
+    if holder_hostname != hostname or _isRunning(pid):
+      continue
+    releaseWorkerInstances(conn, holder, terminate_blocks)
+    released.append(holder)
+  return released
+
+def _isRunning(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    # running, as another user
+    pass
+  return True
+
+def recoverOrphans(conn, queue_names, max_recoveries, terminate_blocks=None):
+  """Requeue or fail started jobs whose lease expired
+
+  Safe to run from several processes at once; each orphan is recovered by one of them.
+
+  Args:
+    conn(Redis): redis connection
+    queue_names([]str): queues whose started registries to check
+    max_recoveries(int): times a job is requeued before it's failed instead
+    terminate_blocks(callable): shuts down the blocks of lost workers, see releaseWorkerInstances
+
+  Returns:
+    recovered([]str): ids of the recovered jobs
+  """
+  now = time.time()
+  recovered = []
+  for queue_name in queue_names:
+    registry = StartedJobRegistry(queue_name, connection=conn)
+    for job_id in conn.zrange(registry.key, 0, -1):
+      job_id = job_id.decode()
+      expires_at = conn.zscore(LEASES_KEY, job_id)
+      if expires_at != None and expires_at > now:
+        continue
+      # claim the orphan
+      if conn.zrem(registry.key, job_id) == 0:
+        continue
+      releaseLease(conn, job_id)
+      try:
+        job = Job.fetch(job_id, connection=conn)
+      except NoSuchJobError:
+        continue
+      # the worker may have died after finishing the job
+      if job.get_status() != JobStatus.STARTED:
+        continue
+      _recover(conn, job, expires_at, now, max_recoveries, terminate_blocks)
+      recovered.append(job_id)
+  return recovered
+
+def _recover(conn, job, expires_at, now, max_recoveries, terminate_blocks):
+  holder = job.meta.get('instance_holder')
+  if holder != None:
+    releaseWorkerInstances(conn, holder, terminate_blocks)
+
+  # work since the last recorded trial (or the start of the job) is lost
+  started_at = (job.started_at - datetime.datetime(1970, 1, 1)).total_seconds() if job.started_at != None else None
+  last_trial_at = (progress.getProgress(conn, job.id) or {}).get('last_trial_at')
+  last_progress = max(filter(None, [started_at, last_trial_at]), default=None)
+  lost_until = expires_at if expires_at != None else now
+  lost_seconds = max(0.0, lost_until - last_progress) if last_progress != None else 0.0
+
+  recoveries = job.meta.get('recoveries', 0)
+  pipeline = conn.pipeline(transaction=False)
+  pipeline.hincrby(STATS_KEY, 'orphans', 1)
+  pipeline.hincrbyfloat(STATS_KEY, 'lost_seconds', lost_seconds)
+  if expires_at != None:
+    # time from the lease expiring to the orphan being found
+    pipeline.hincrbyfloat(STATS_KEY, 'detection_seconds', now - expires_at)
+    pipeline.hincrby(STATS_KEY, 'detections', 1)
+
+  # jobs enqueued before resumability was recorded are assumed resumable
+  resumable = job.meta.get('resumable', True)
+  if recoveries < max_recoveries and resumable:
+    job.meta['recoveries'] = recoveries + 1
+    job.meta['lost_seconds'] = job.meta.get('lost_seconds', 0.0) + lost_seconds
+    job.save_meta()
+    # it already waited its turn
+    Queue(job.origin, connection=conn).enqueue_job(job, at_front=True)
+    events.publishJob(conn, job, 'queued')
+    pipeline.hincrby(STATS_KEY, 'requeued', 1)
+  else:
+    job.set_status(JobStatus.FAILED)
+    if resumable:
+      job.exc_info = 'Worker running the job was lost {} times'.format(recoveries + 1)
+    else:
+      job.exc_info = "Worker running the job was lost, and its optimizer can't resume the run"
+    job.save(include_meta=False)
+    FailedJobRegistry(job.origin, connection=conn).add(job, job.failure_ttl)
+    job_index.releaseJob(conn, job)
+    events.publishJob(conn, job, 'failed')
+    pipeline.hincrby(STATS_KEY, 'failed', 1)
+  pipeline.execute()
+
+def getStats(conn):
+  """Returns counters of recovered orphans and the work lost with them"""
+  counters = {k.decode(): float(v) for k, v in conn.hgetall(STATS_KEY).items()}
+  detections = int(counters.get('detections', 0))
+  return {
+    'orphans': int(counters.get('orphans', 0)),
+    'requeued': int(counters.get('requeued', 0)),
+    'failed': int(counters.get('failed', 0)),
+    'lost_seconds': counters.get('lost_seconds', 0.0),
+    'avg_detection_seconds': counters.get('detection_seconds', 0.0) / detections if detections > 0 else None,
+  }
@@ -0,0 +1,50 @@
+import threading
+import time
+
+import redis
+
+class StatsBlockingConnectionPool(redis.BlockingConnectionPool):
+  """Thread-safe redis connection pool which keeps usage stats
+
+  Callers block up to `timeout` seconds for a free connection once `max_connections` are checked out.
+  """
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self._stats_lock = threading.Lock()
+    self._checkouts = 0
+    self._checkout_errors = 0
+    self._checkout_wait_seconds = 0.0
+    self._max_checkout_wait_seconds = 0.0
+
+  def get_connection(self, command_name, *keys, **options):
+    start = time.time()
+    try:
+      connection = super().get_connection(command_name, *keys, **options)
+    except redis.ConnectionError:
+      # no connection freed up within the timeout, or connecting failed
+      with self._stats_lock:
+        self._checkout_errors += 1
+      raise
+    waited = time.time() - start
+    with self._stats_lock:
+      self._checkouts += 1
+      self._checkout_wait_seconds += waited
+      self._max_checkout_wait_seconds = max(self._max_checkout_wait_seconds, waited)
+    return connection
+
+  def stats(self):
+    """Returns pool usage as a dict"""
+    # idle connections sit in the pool's queue; None placeholders mark connections not created yet
+    idle = sum(1 for connection in list(self.pool.queue) if connection != None)
+    created = len(self._connections)
+    with self._stats_lock:
+      return {
+        'max_connections': self.max_connections,
+        'created_connections': created,
+        'in_use_connections': created - idle,
+        'idle_connections': idle,
+        'checkouts': self._checkouts,
+        'checkout_errors': self._checkout_errors,
+        'avg_checkout_wait_seconds': self._checkout_wait_seconds / self._checkouts if self._checkouts else 0.0,
+        'max_checkout_wait_seconds': self._max_checkout_wait_seconds,
+      }
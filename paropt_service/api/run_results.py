@@ -0,0 +1,59 @@
+"""Results of runs, kept in the database
+
+A run's result has a message per trial, so it grows with the run. The full result is saved here, and the
+job's result in redis (returned with every job listing) is only a summary of it, see summarizeResult.
+"""
+import datetime
+import json
+
+from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime
+from sqlalchemy.ext.declarative import declarative_base
+
+from .runner import TRIAL_SUCCEEDED_MESSAGE
+
+Base = declarative_base()
+
+class RunResult(Base):
+  __tablename__ = 'run_results'
+  job_id = Column(String(64), primary_key=True)
+  experiment_id = Column(Integer, index=True, nullable=False)
+  success = Column(Boolean, nullable=False)
+  recorded_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+  # result as json
+  result = Column(Text, nullable=False)
+
+def createTables(engine):
+  """Create the run results table if it doesn't exist"""
+  Base.metadata.create_all(engine)
+
+def summarizeResult(result):
+  """Returns the summary of a run's result kept with its job
+
+  The summary has everything but the per trial messages, and only the messages of trials which failed or
+  of the error which failed the run, so its size doesn't depend on the number of trials.
+  """
+  summary = {key: value for key, value in result.items() if key != 'message'}
+  summary['errors'] = {key: message for key, message in result.get('message', {}).items()
+    if message != TRIAL_SUCCEEDED_MESSAGE}
+  return summary
+
+def saveRunResult(session, job_id, experiment_id, result):
+  """Save the full result of a job's run, replacing any saved before"""
+  session.merge(RunResult(
+    job_id=job_id,
+    experiment_id=int(experiment_id),
+    success=result['success'],
+    result=json.dumps(result, default=str)))
+  session.commit()
+
+def getRunResult(session, job_id):
+  """Returns the full result of a job's run; None if it isn't saved"""
+  run_result = session.query(RunResult).get(job_id)
+  if run_result == None:
+    return None
+  return {
+    'job_id': run_result.job_id,
+    'experiment_id': run_result.experiment_id,
+    'recorded_at': run_result.recorded_at.isoformat(),
+    'result': json.loads(run_result.result),
+  }
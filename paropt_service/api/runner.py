@@ -0,0 +1,475 @@
+import concurrent.futures
+import logging
+import os
+import string
+import time
+
+import parsl
+from sqlalchemy.orm import selectinload
+
+from paropt.runner import RunConfig
+from paropt.storage.entities import Trial
+
+from .fidelities import isFullFidelity
+
+logger = logging.getLogger(__name__)
+
+# seconds between checks for stop requests and time/cost budgets while waiting on trials
+STOP_POLL_SECONDS = 10
+# run result message of each trial which succeeded
+TRIAL_SUCCEEDED_MESSAGE = 'Successfully completed trial'
+# stored trials loaded at once for the trial cache and warm starts
+STORED_TRIALS_CHUNK_SIZE = 1000
+
+class ConcurrentRunner():
+  """Runs trials of an experiment with parsl, evaluating up to `concurrency` trials at once
+
+  Parameter configurations are pulled from the optimizer whenever a trial slot is free. Each result is
+  saved to storage and registered with the optimizer as soon as its trial finishes.
+  With a concurrency of 1 this behaves like paropt's ParslRunner.
+
+  The run stops submitting trials when stopping rules are met or a stop is requested, and returns once
+  the trials already running finish.
+
+  With a compute pool, the run uses the pool's warm blocks when they match its compute spec and hands them
+  back to the pool afterwards, instead of launching blocks for itself and shutting them down.
+
+  With `on_blocks`, the run passes the provider ids of its blocks (eg EC2 instance ids) once they're launched,
+  so they can be shut down if the process running it is lost.
+
+  With a worker probe, the run waits for fresh blocks to start before submitting trials, recording how long
+  it took, and checks they run the same paropt version as the server.
+
+  With `on_progress`, the run reports its progress (see `progress`) as trials start and finish; reports
+  on a change of phase are marked as forced, the rest can be rate limited by the callback.
+
+  Trials run below the maximum of one of the experiment's `fidelities` (see fidelities) are only partial runs:
+  they're registered with the optimizer and saved, but don't count towards the best objective, the stopping
+  rules or warm starts.
+
+  Measured trials are registered with the optimizer right away but saved in batches, in one transaction each,
+  once `flush_size` are waiting or `flush_seconds` have passed since the last save, and when the run ends.
+  """
+  def __init__(self, parsl_app, optimizer, storage, experiment, parsl_config, concurrency=1, logs_root_dir='.',
+               trial_cache=None, stopping_rules=None, stop_requested=None, compute_pool=None, compute_key=None,
+               worker_probe=None, paropt_version=None, setup_timeout=None, on_trial=None, on_progress=None,
+               flush_size=1, flush_seconds=0, on_blocks=None, on_flush=None, fidelities=None):
+    """
+    Args:
+      parsl_app(function): parsl app which runs a trial from a RunConfig, eg timeCommand
+      optimizer(Optimizer): paropt optimizer suggesting parameter configurations
+      storage(RelationalDB): storage to save trials to
+      experiment(Experiment): experiment to run
+      parsl_config(Config): parsl config providing at least `concurrency` workers
+      concurrency(int): max number of trials running at once
+      logs_root_dir(str): directory for parsl's run info and logs
+      trial_cache(TrialCache): cache of measured trials to reuse instead of dispatching; None to measure all
+      stopping_rules(StoppingRules): early stopping criteria; None to run until the optimizer is exhausted
+      stop_requested(callable): returns True when the run has been asked to stop
+      compute_pool(ComputePool): pool of warm blocks to run on; None to launch blocks for this run only
+      compute_key(tuple): compute spec of the experiment, identifying blocks in the compute pool
+      worker_probe(function): parsl app returning a dict describing the block it runs on, eg workerInfo
+      paropt_version(str): paropt version blocks must have; None to skip the check
+      setup_timeout(float): max seconds to wait for fresh blocks to start; None to wait indefinitely
+      on_trial(callable): called with each trial the run measures, once it's saved
+      on_progress(callable): called with the run's progress dict and whether the report is forced
+      flush_size(int): number of measured trials to save at once; 1 to save each trial as it's measured
+      flush_seconds(float): max seconds between saves while trials are waiting to be saved
+      on_blocks(callable): called with the provider ids of the run's blocks once its compute is loaded
+      on_flush(callable): called with the trials saved by each flush, once they're committed and before on_trial
+      fidelities(set): names of the experiment's fidelity parameters; None if it has none
+    """
+    self.parsl_app = parsl_app
+    self.optimizer = optimizer
+    self.storage = storage
+    self.experiment = experiment
+    self.parsl_config = parsl_config
+    self.parsl_config.run_dir = os.path.join(logs_root_dir, 'runinfo')
+    self.concurrency = concurrency
+    self.trial_cache = trial_cache
+    self.stopping_rules = stopping_rules
+    self.stop_requested = stop_requested
+    self.stop_reason = None
+    self.compute_pool = compute_pool
+    self.compute_key = compute_key
+    self.worker_probe = worker_probe
+    self.paropt_version = paropt_version
+    self.setup_timeout = setup_timeout
+    self.on_trial = on_trial
+    self.on_progress = on_progress
+    self.flush_size = flush_size
+    self.flush_seconds = flush_seconds
+    self.on_blocks = on_blocks
+    self.on_flush = on_flush
+    self.fidelities = fidelities if fidelities != None else set()
+    self.session = None
+    self.run_number = 0
+    self.run_result = {'success': True, 'message': {}}
+    self._dfk = None
+    self._loaded_at = None
+    self._phase = 'starting'
+    self._trials_measured = 0
+    self._trials_reused = 0
+    self._trials_failed = 0
+    self._best_objective = None
+    self._last_trial_at = None
+    # measured trials waiting to be saved
+    self._unsaved = []
+    self._flushed_at = time.time()
+    self._flushes = 0
+    # trials in flight by run number
+    self._running = {}
+    self._timings = {'provisioning_seconds': None, 'command_seconds': 0.0, 'overhead_seconds': 0.0}
+
+  def _renderScript(self, template, parameter_configs):
+    if template == None:
+      return None
+    values = {config.parameter.name: config.value for config in parameter_configs}
+    return string.Template(template).safe_substitute(values)
+
+  def _submitTrial(self, parameter_configs):
+    run_config = RunConfig(
+      command_script_content=self._renderScript(self.experiment.command_template_string, parameter_configs),
+      experiment_dict=self.experiment.asdict(),
+      setup_script_content=self._renderScript(self.experiment.setup_template_string, parameter_configs),
+      finish_script_content=self._renderScript(self.experiment.finish_template_string, parameter_configs),
+    )
+    return self.parsl_app(run_config)
+
+  def progress(self):
+    """Returns the run's progress
+
+    Returns:
+      progress(dict):
+        phase: starting, provisioning (loading compute and waiting for blocks), running, then finished,
+          stopped or failed
+        trials_done: trials measured or reused so far, of which trials_reused were reused from the cache
+        best_objective: lowest objective so far
+        current_parameters: parameters of the trials in flight
+        timings: seconds spent provisioning compute, running trial commands, and in the overhead of trials
+          beyond their command (dispatch plus setup and finish scripts)
+        last_trial_at: unix time trials were last saved
+    """
+    return {
+      'phase': self._phase,
+      'trials_done': self._trials_measured + self._trials_reused,
+      'trials_reused': self._trials_reused,
+      'best_objective': self._best_objective,
+      'current_parameters': [running['parameters'] for _, running in sorted(self._running.items())],
+      'timings': dict(self._timings),
+      'last_trial_at': self._last_trial_at,
+    }
+
+  def _reportProgress(self, phase=None):
+    """Report progress to on_progress; a new phase forces the report"""
+    if phase != None:
+      self._phase = phase
+    if self.on_progress != None:
+      try:
+        self.on_progress(self.progress(), phase != None)
+      except Exception:
+        # progress is informational, it mustn't fail the run
+        logger.exception('Failed to report progress')
+
+  def _countTrial(self, trial, reused):
+    if reused:
+      self._trials_reused += 1
+    else:
+      self._trials_measured += 1
+    if not isFullFidelity(trial, self.fidelities):
+      return
+    if self._best_objective == None or trial.outcome < self._best_objective:
+      self._best_objective = trial.outcome
+
+  def _recordTrial(self, parameter_configs, run_number, result):
+    """Register a finished trial with the optimizer and queue it to be saved
+
+    Returns:
+      trial(Trial): the trial; None if the trial failed
+    """
+    running = self._running.pop(run_number, None)
+    if running != None and result.get('run_time') != None:
+      self._timings['command_seconds'] += result['run_time']
+      self._timings['overhead_seconds'] += max(0.0, time.time() - running['submitted_at'] - result['run_time'])
+    if result['returncode'] != 0:
+      self._trials_failed += 1
+      self.run_result['success'] = False
+      self.run_result['message']['run {}'.format(run_number)] = (
+        'Trial failed with return code {} and output: {}'.format(result['returncode'], result.get('stdout')))
+      return None
+    trial = Trial(
+      outcome=result['run_time'],
+      parameter_configs=parameter_configs,
+      run_number=run_number,
+      experiment_id=self.experiment.id,
+    )
+    self._unsaved.append(trial)
+    if self.trial_cache != None:
+      self.trial_cache.add(trial)
+    self.optimizer.register(trial)
+    self.run_result['message']['run {}'.format(run_number)] = TRIAL_SUCCEEDED_MESSAGE
+    self._countTrial(trial, reused=False)
+    self._checkStop(trial)
+    return trial
+
+  def _flushTrials(self, force=False):
+    """Save the measured trials waiting to be saved in one transaction, if there are enough or they've waited long enough
+
+    Trials stay queued if saving them fails, so they're retried with the next flush.
+    """
+    if len(self._unsaved) == 0:
+      return
+    if not force and len(self._unsaved) < self.flush_size and time.time() - self._flushed_at < self.flush_seconds:
+      return
+    self.session.add_all(self._unsaved)
+    self.session.commit()
+    trials, self._unsaved = self._unsaved, []
+    self._flushed_at = self._last_trial_at = time.time()
+    self._flushes += 1
+    if self.on_flush != None:
+      self.on_flush(trials)
+    if self.on_trial != None:
+      for trial in trials:
+        self.on_trial(trial)
+
+  def _checkStop(self, trial=None):
+    """Check stopping rules (accounting for trial if given) and stop requests, setting stop_reason"""
+    if self.stop_reason != None:
+      return
+    # partial runs would meet targets and reset patience with runtimes of a fraction of the work
+    if trial != None and not isFullFidelity(trial, self.fidelities):
+      trial = None
+    if self.stopping_rules != None:
+      self.stop_reason = self.stopping_rules.update(trial) if trial != None else self.stopping_rules.check()
+    if self.stop_reason == None and self.stop_requested != None and self.stop_requested():
+      self.stop_reason = 'stop requested'
+    if self.stop_reason != None:
+      logger.info('Stopping run: {}'.format(self.stop_reason))
+
+  def _reuseTrial(self, parameter_configs):
+    """Register the cached trial of a configuration with the optimizer instead of dispatching it
+
+    Returns:
+      reused(bool): False if the configuration must be measured
+    """
+    if self.trial_cache == None:
+      return False
+    trial = self.trial_cache.get(parameter_configs)
+    if trial == None:
+      return False
+    self._discardConfigs(parameter_configs)
+    logger.info('Reusing trial {} for configs {}'.format(trial.id, parameter_configs))
+    self.optimizer.register(trial)
+    self._countTrial(trial, reused=True)
+    self._checkStop(trial)
+    return True
+
+  def _discardConfigs(self, parameter_configs):
+    """Keep suggested configs that won't be saved out of the session"""
+    for config in parameter_configs:
+      if config in self.session:
+        self.session.expunge(config)
+
+  def _storedTrialChunks(self, since=None):
+    """Iterate over the experiment's stored trials in chunks, by id
+
+    The session only keeps weak references to clean trials, so trials which aren't cached are freed as the
+    next chunks load.
+
+    Args:
+      since(datetime): only trials recorded at or after this (UTC); None for all
+    """
+    last_id = None
+    while True:
+      query = self.session.query(Trial).filter(Trial.experiment_id == self.experiment.id)
+      if last_id != None:
+        query = query.filter(Trial.id > last_id)
+      if since != None:
+        query = query.filter(Trial.timestamp >= since)
+      trials = (query
+        .options(selectinload(Trial.parameter_configs))
+        .order_by(Trial.id)
+        .limit(STORED_TRIALS_CHUNK_SIZE)
+        .all())
+      if len(trials) == 0:
+        return
+      yield trials
+      last_id = trials[-1].id
+
+  def _loadCompute(self):
+    reused = False
+    if self.compute_pool == None:
+      self._dfk = parsl.load(self.parsl_config)
+    else:
+      self._dfk, reused = self.compute_pool.acquire(self.compute_key, self.parsl_config, self.concurrency)
+    self._loaded_at = time.time()
+    self.run_result['compute'] = {
+      'reused': reused,
+      'startup_seconds': None,
+      'saved_seconds': self.compute_pool.startupSeconds() if reused else None,
+    }
+    if self.on_blocks != None:
+      self.on_blocks(self._blockIds())
+    if not reused and self.worker_probe != None:
+      self._awaitWorkers()
+
+  def _blockIds(self):
+    """Returns the provider ids (eg EC2 instance ids) of the blocks launched by the run's executors"""
+    block_ids = []
+    for executor in self._dfk.executors.values():
+      provider = getattr(executor, 'provider', None)
+      block_ids += list(getattr(provider, 'resources', None) or {})
+    return block_ids
+
+  def _awaitWorkers(self):
+    """Wait for the first fresh block to start and check its environment, recording how long it took
+
+    Raises:
+      Exception: if the block doesn't start within setup_timeout or runs a different paropt version
+    """
+    future = self.worker_probe()
+    while True:
+      done, _ = concurrent.futures.wait([future], timeout=STOP_POLL_SECONDS)
+      if len(done) > 0:
+        break
+      self._checkStop()
+      if self.stop_reason != None:
+        return
+      if self.setup_timeout != None and time.time() - self._loaded_at > self.setup_timeout:
+        raise Exception('Blocks did not start within {} seconds'.format(self.setup_timeout))
+    info = future.result()
+    startup_seconds = time.time() - self._loaded_at
+    logger.info('Block {} started in {:.1f} seconds'.format(info.get('hostname'), startup_seconds))
+    self.run_result['compute']['startup_seconds'] = startup_seconds
+    if self.compute_pool != None:
+      self.compute_pool.recordStartup(startup_seconds)
+    if self.paropt_version != None and info.get('paropt_version') != self.paropt_version:
+      raise Exception('Block {} has paropt version {} but the server has {}'.format(
+        info.get('hostname'), info.get('paropt_version'), self.paropt_version))
+
+  def _nextConfigs(self, configs_iter, count):
+    """Get up to count parameter configurations from the optimizer"""
+    if hasattr(self.optimizer, 'suggestBatch'):
+      # batch optimizers suggest all configs at once, accounting for the trials still running
+      return self.optimizer.suggestBatch(count)
+    configs = []
+    for _ in range(count):
+      try:
+        configs.append(next(configs_iter))
+      except StopIteration:
+        break
+    return configs
+
+  def run(self):
+    """Run trials until the optimizer is exhausted, a trial fails or the run is stopped"""
+    self.session = self.storage.Session()
+    if self.stopping_rules != None:
+      self.stopping_rules.start()
+    try:
+      self.experiment, _, _ = self.storage.getOrCreateExperiment(self.session, self.experiment)
+      self.optimizer.setExperiment(self.experiment)
+      warm_start = getattr(self.optimizer, 'warm_start', False)
+      load_cache = self.trial_cache != None and self.trial_cache.reusesStored()
+      if load_cache or warm_start:
+        # warm starts fit to every stored trial; otherwise only trials the cache could reuse are loaded
+        since = self.trial_cache.reusableSince() if not warm_start else None
+        loaded = 0
+        for trials in self._storedTrialChunks(since):
+          if load_cache:
+            self.trial_cache.load(trials)
+          if warm_start:
+            self.optimizer.warmStart([trial for trial in trials if isFullFidelity(trial, self.fidelities)])
+          loaded += len(trials)
+        logger.info('Loaded {} stored trials'.format(loaded))
+      self._reportProgress('provisioning')
+      provisioning_started_at = time.time()
+      self._loadCompute()
+      self._timings['provisioning_seconds'] = time.time() - provisioning_started_at
+      self._reportProgress('running')
+
+      configs_iter = iter(self.optimizer)
+      in_flight = {}
+      exhausted = False
+      while True:
+        self._checkStop()
+        free_slots = self.concurrency - len(in_flight)
+        while not exhausted and self.run_result['success'] and self.stop_reason == None and free_slots > 0:
+          configs = self._nextConfigs(configs_iter, free_slots)
+          if len(configs) == 0:
+            # optimizers which suggest in stages (eg hyperband's rungs) can have nothing to suggest until the
+            # trials in flight finish
+            exhausted = not (hasattr(self.optimizer, 'isWaiting') and self.optimizer.isWaiting())
+            break
+          for parameter_configs in configs:
+            if self.stop_reason != None:
+              self._discardConfigs(parameter_configs)
+              continue
+            if self._reuseTrial(parameter_configs):
+              continue
+            self.run_number += 1
+            logger.info('Starting trial {} with configs {}'.format(self.run_number, parameter_configs))
+            in_flight[self._submitTrial(parameter_configs)] = (parameter_configs, self.run_number)
+            self._running[self.run_number] = {
+              'parameters': {config.parameter.name: float(config.value) for config in parameter_configs},
+              'submitted_at': time.time(),
+            }
+          free_slots = self.concurrency - len(in_flight)
+          self._reportProgress()
+        if len(in_flight) == 0:
+          break
+
+        done, _ = concurrent.futures.wait(
+          list(in_flight),
+          timeout=STOP_POLL_SECONDS,
+          return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          parameter_configs, run_number = in_flight.pop(future)
+          try:
+            result = future.result()
+          except Exception as e:
+            logger.exception('Trial {} raised an exception'.format(run_number))
+            result = {'returncode': -1, 'stdout': str(e)}
+          self._recordTrial(parameter_configs, run_number, result)
+        self._flushTrials()
+        self._reportProgress()
+    except Exception as e:
+      self.session.rollback()
+      self.run_result['success'] = False
+      self.run_result['message']['error'] = 'Runner failed: {}'.format(e)
+      logger.exception('Runner failed')
+    finally:
+      if self.trial_cache != None:
+        self.run_result['cache'] = self.trial_cache.stats()
+      if self.stop_reason != None:
+        self.run_result['stopped'] = self.stop_reason
+      try:
+        self._flushTrials(force=True)
+      except Exception as e:
+        self.session.rollback()
+        self.run_result['success'] = False
+        self.run_result['message']['error'] = 'Failed to save {} trials: {}'.format(len(self._unsaved), e)
+        logger.exception('Failed to save trials')
+      self.run_result['trial_flushes'] = self._flushes
+      self.run_result['trials'] = {
+        'measured': self._trials_measured,
+        'reused': self._trials_reused,
+        'failed': self._trials_failed,
+      }
+      self.session.close()
+      self._running.clear()
+      if not self.run_result['success']:
+        self._reportProgress('failed')
+      else:
+        self._reportProgress('stopped' if self.stop_reason != None else 'finished')
+
+  def cleanup(self):
+    """Shut down parsl executors and the blocks they launched, or return them to the compute pool"""
+    if self._dfk == None:
+      return
+    if self.compute_pool != None:
+      # an error in the runner (rather than a failed trial) may have left the blocks unusable
+      self.compute_pool.release(discard='error' in self.run_result['message'])
+    else:
+      self._dfk.cleanup()
+      parsl.clear()
+    self._dfk = None
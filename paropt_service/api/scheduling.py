@@ -0,0 +1,168 @@
+"""Scheduling of experiment jobs across priority queues, users and EC2 capacity
+
+Fair share: within a queue, jobs are ordered by a virtual finish tag (start-time fair queuing). A job's tag is
+its share's previous tag (or the queue's virtual time, if later) plus the job's estimated cost, and the queue
+list is kept sorted by tag. So a share (user or tool) that enqueues a lot of expensive jobs can't hold back
+jobs of other shares, while jobs of the same share still run in order. The queue's virtual time advances to
+the tag of each job a worker starts.
+
+Admission: workers hold EC2 instances under their own name, and only launch blocks when the instances held
+by all workers stay within the configured limit. The ids of the blocks a worker launched are kept under its
+name too, so the blocks of a lost worker can be shut down by whoever releases its instances.
+"""
+import json
+import random
+
+from redis.client import Pipeline
+
+# keys are formatted with the queue name
+TAGS_KEY_TEMPLATE = 'paropt:fairshare:{}:tags'
+SHARES_KEY_TEMPLATE = 'paropt:fairshare:{}:shares'
+VTIME_KEY_TEMPLATE = 'paropt:fairshare:{}:vtime'
+INSTANCES_KEY = 'paropt:ec2_instances'
+BLOCKS_KEY = 'paropt:ec2_blocks'
+
+# moves a just enqueued job in front of the first queued job with a later tag
+_PLACE_SCRIPT = """
+local vtime = tonumber(redis.call('GET', KEYS[4]) or '0')
+local last = tonumber(redis.call('HGET', KEYS[3], ARGV[2]) or '0')
+local tag = math.max(vtime, last) + tonumber(ARGV[3])
+redis.call('HSET', KEYS[3], ARGV[2], tostring(tag))
+-- the job may already have been dequeued
+if redis.call('LREM', KEYS[1], -1, ARGV[1]) == 0 then
+  return tostring(tag)
+end
+redis.call('ZADD', KEYS[2], tag, ARGV[1])
+for _, pivot in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '(' .. tag, '+inf')) do
+  if redis.call('LINSERT', KEYS[1], 'BEFORE', pivot, ARGV[1]) > 0 then
+    return tostring(tag)
+  end
+  -- no longer queued
+  redis.call('ZREM', KEYS[2], pivot)
+end
+redis.call('RPUSH', KEYS[1], ARGV[1])
+return tostring(tag)
+"""
+
+_START_SCRIPT = """
+local tag = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if tag then
+  redis.call('ZREM', KEYS[1], ARGV[1])
+  if tonumber(tag) > tonumber(redis.call('GET', KEYS[2]) or '0') then
+    redis.call('SET', KEYS[2], tag)
+  end
+end
+"""
+
+# sets the instances held by a worker if the total stays within the limit
+_ACQUIRE_SCRIPT = """
+local held = 0
+local values = redis.call('HGETALL', KEYS[1])
+for i = 1, #values, 2 do
+  if values[i] ~= ARGV[1] then
+    held = held + tonumber(values[i + 1])
+  end
+end
+if held + tonumber(ARGV[2]) > tonumber(ARGV[3]) then
+  return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
+
+def weightedOrder(queues, weights, rand=random):
+  """Order queues for a worker to check, picking each next queue with probability proportional to its weight
+
+  Args:
+    queues([]Queue): queues to order
+    weights(dict): queue name to weight; unlisted queues have a weight of 1
+
+  Returns:
+    queues([]Queue): reordered queues
+  """
+  remaining = list(queues)
+  ordered = []
+  while len(remaining) > 0:
+    point = rand.uniform(0, sum(weights.get(q.name, 1) for q in remaining))
+    for i, queue in enumerate(remaining):
+      point -= weights.get(queue.name, 1)
+      if point <= 0 or i == len(remaining) - 1:
+        ordered.append(remaining.pop(i))
+        break
+  return ordered
+
+def placeJob(conn, queue, job_id, share, cost):
+  """Move a job enqueued at the back of the queue to its fair share position
+
+  Args:
+    conn(Redis): redis connection, or a pipeline the job was enqueued with
+    queue(Queue): queue the job was enqueued to
+    job_id(str): id of the job
+    share(str): user or tool the job is accounted to
+    cost(float): estimated cost of the job, eg its number of trials
+
+  Returns:
+    tag(float): the job's fair share tag; None with a pipeline
+  """
+  tag = conn.eval(
+    _PLACE_SCRIPT,
+    4,
+    queue.key,
+    TAGS_KEY_TEMPLATE.format(queue.name),
+    SHARES_KEY_TEMPLATE.format(queue.name),
+    VTIME_KEY_TEMPLATE.format(queue.name),
+    job_id,
+    share,
+    max(cost, 0))
+  return float(tag) if not isinstance(conn, Pipeline) else None
+
+def jobStarted(conn, queue_name, job_id):
+  """Advance the queue's virtual time to the tag of a job taken off it"""
+  conn.eval(_START_SCRIPT, 2, TAGS_KEY_TEMPLATE.format(queue_name), VTIME_KEY_TEMPLATE.format(queue_name), job_id)
+
+def jobRemoved(conn, queue_name, job_id):
+  """Forget the tag of a job removed from the queue without running"""
+  conn.zrem(TAGS_KEY_TEMPLATE.format(queue_name), job_id)
+
+def acquireInstances(conn, holder, count, limit):
+  """Set the number of EC2 instances held by a worker, if the total held stays within limit
+
+  Args:
+    conn(Redis): redis connection
+    holder(str): name of the worker
+    count(int): instances the worker will hold, including instances it already holds
+    limit(int): max instances held by all workers
+
+  Returns:
+    admitted(bool): False if the instances weren't acquired
+  """
+  return conn.eval(_ACQUIRE_SCRIPT, 1, INSTANCES_KEY, holder, count, limit) == 1
+
+def holderName(hostname, pid):
+  """Returns the name a process holds EC2 instances under"""
+  return '{}:{}'.format(hostname, pid)
+
+def parseHolderName(holder):
+  """Returns the hostname and pid of a holder name, see holderName"""
+  hostname, pid = holder.rsplit(':', 1)
+  return hostname, int(pid)
+
+def holders(conn):
+  """Returns the names of processes holding EC2 instances or blocks"""
+  return set(holder.decode() for holder in conn.hkeys(INSTANCES_KEY) + conn.hkeys(BLOCKS_KEY))
+
+def releaseInstances(conn, holder):
+  conn.pipeline(transaction=False).hdel(INSTANCES_KEY, holder).hdel(BLOCKS_KEY, holder).execute()
+
+def recordBlocks(conn, holder, block_ids):
+  """Record the ids of the blocks (EC2 instances) a worker launched, replacing the ones recorded before"""
+  conn.hset(BLOCKS_KEY, holder, json.dumps(block_ids))
+
+def heldBlocks(conn, holder):
+  """Returns the ids of the blocks recorded for a worker"""
+  raw = conn.hget(BLOCKS_KEY, holder)
+  return json.loads(raw) if raw != None else []
+
+def instancesHeld(conn):
+  """Returns the number of EC2 instances held by all workers"""
+  return sum(int(count) for count in conn.hvals(INSTANCES_KEY))
@@ -0,0 +1,64 @@
+import time
+
+class StoppingRules():
+  """Early stopping criteria for an experiment run
+
+  The run stops submitting trials once any rule is met; trials already running are allowed to finish.
+  """
+  def __init__(self, patience=None, target=None, max_seconds=None, max_cost=None, hourly_cost=0.0):
+    """
+    Args:
+      patience(int): stop after this many consecutive trials without improving the best objective
+      target(float): stop once a trial's objective is at or below target
+      max_seconds(float): stop once the run has taken this many seconds
+      max_cost(float): stop once the run's compute has cost this much (USD)
+      hourly_cost(float): cost per hour of the run's compute, ie instance price times instances
+    """
+    self.patience = patience
+    self.target = target
+    self.max_seconds = max_seconds
+    self.max_cost = max_cost
+    self.hourly_cost = hourly_cost
+    self.best = None
+    self.trials_since_improvement = 0
+    self._started_at = None
+
+  def start(self):
+    self._started_at = time.time()
+
+  def elapsedSeconds(self):
+    return time.time() - self._started_at if self._started_at != None else 0.0
+
+  def cost(self):
+    """Cost of the run's compute so far"""
+    return self.hourly_cost * self.elapsedSeconds() / 3600.0
+
+  def update(self, trial):
+    """Account for a finished trial
+
+    Returns:
+      reason(str): why the run should stop; None to continue
+    """
+    if trial.outcome != None:
+      if self.best == None or trial.outcome < self.best:
+        self.best = trial.outcome
+        self.trials_since_improvement = 0
+      else:
+        self.trials_since_improvement += 1
+    return self.check()
+
+  def check(self):
+    """Check the rules
+
+    Returns:
+      reason(str): why the run should stop; None to continue
+    """
+    if self.target != None and self.best != None and self.best <= self.target:
+      return 'reached target objective {}'.format(self.target)
+    if self.patience != None and self.trials_since_improvement >= self.patience:
+      return 'no improvement in {} trials'.format(self.patience)
+    if self.max_seconds != None and self.elapsedSeconds() >= self.max_seconds:
+      return 'reached time budget of {} seconds'.format(self.max_seconds)
+    if self.max_cost != None and self.cost() >= self.max_cost:
+      return 'reached cost budget of {}'.format(self.max_cost)
+    return None
@@ -0,0 +1,212 @@
+"""Supervisor scaling the worker processes of `app.py --workers` with the amount of queued and running jobs"""
+import json
+import logging
+import os
+import signal
+import socket
+import time
+from multiprocessing import Process
+
+from rq import Queue, Worker
+from rq.registry import StartedJobRegistry
+from rq.utils import as_text
+
+from . import scheduling, recovery
+
+logger = logging.getLogger(__name__)
+
+STATS_KEY = 'paropt:supervisor:{}'
+DECISIONS_KEY = 'paropt:supervisor:{}:decisions'
+# number of scaling decisions kept
+MAX_DECISIONS = 100
+
+class WorkerSupervisor():
+  """Keeps between min_workers and max_workers worker processes running
+
+  The target number of workers is the number of jobs queued or running, within the bounds. Workers are
+  started as soon as jobs are waiting, and idle workers are drained once there have been more workers than
+  needed for `scale_down_delay` seconds. Draining sends the worker SIGTERM, which makes an RQ worker exit
+  once its current job (if any) is done. Workers which exit without being drained are counted as crashed and
+  replaced.
+
+  With `max_recoveries`, jobs orphaned by dead workers (on any host) are recovered every `recovery_interval`
+  seconds, see recovery.
+
+  Scaling decisions and counters are written to redis for /stats.
+  """
+  def __init__(self, conn, target, args, queue_names, min_workers, max_workers, interval=5, scale_down_delay=60,
+      max_recoveries=None, recovery_interval=30, terminate_blocks=None):
+    """
+    Args:
+      conn(Redis): redis connection
+      target(function): entry point of a worker process
+      args(tuple): args of target
+      queue_names([]str): queues the workers take jobs from
+      min_workers(int): workers to keep running when there are no jobs
+      max_workers(int): max number of workers
+      interval(float): seconds between scaling checks
+      scale_down_delay(float): seconds there must be more workers than needed before draining any
+      max_recoveries(int): times an orphaned job is requeued before it's failed; None to not recover jobs
+      recovery_interval(float): seconds between checks for orphaned jobs
+      terminate_blocks(callable): shuts down the blocks of lost workers, see recovery.releaseWorkerInstances
+    """
+    self.conn = conn
+    self.target = target
+    self.args = args
+    self.queue_names = queue_names
+    self.min_workers = min_workers
+    self.max_workers = max_workers
+    self.interval = interval
+    self.scale_down_delay = scale_down_delay
+    self.max_recoveries = max_recoveries
+    self.recovery_interval = recovery_interval
+    self.terminate_blocks = terminate_blocks
+    self.name = socket.gethostname()
+    self.workers = []
+    self.draining = []
+    self.counters = {'started': 0, 'drained': 0, 'crashed': 0}
+    self._surplus_since = None
+    self._recovered_at = None
+    self._stopping = False
+
+  def run(self):
+    """Supervise workers until SIGTERM or SIGINT, then drain all workers and wait for them to exit"""
+    signal.signal(signal.SIGTERM, self._requestStop)
+    signal.signal(signal.SIGINT, self._requestStop)
+    while not self._stopping:
+      self.check()
+      time.sleep(self.interval)
+    logger.info('Stopping supervisor, draining {} workers'.format(len(self.workers)))
+    self._drain(list(self.workers))
+    for proc in self.draining:
+      proc.join()
+    self.conn.delete(STATS_KEY.format(self.name))
+
+  def check(self):
+    """Reap exited workers, recover orphaned jobs and scale to the current demand"""
+    self._reap()
+    self._recover()
+    queued = sum(Queue(name, connection=self.conn).count for name in self.queue_names)
+    running = sum(StartedJobRegistry(name, connection=self.conn).count for name in self.queue_names)
+    desired = max(self.min_workers, min(self.max_workers, queued + running))
+    current = len(self.workers)
+    if desired > current:
+      self._surplus_since = None
+      for _ in range(desired - current):
+        self._start()
+      self._recordDecision(current, desired, queued, running, 'scale up')
+    elif desired < current:
+      now = time.time()
+      if self._surplus_since == None:
+        self._surplus_since = now
+      elif now - self._surplus_since >= self.scale_down_delay:
+        drained = self._drain(self._idleWorkers()[:current - desired])
+        if len(drained) > 0:
+          self._recordDecision(current, current - len(drained), queued, running, 'scale down')
+        self._surplus_since = None
+    else:
+      self._surplus_since = None
+    self._writeStats(desired, queued, running)
+
+  def _start(self):
+    proc = Process(target=_workerMain, args=(self.target, self.args))
+    proc.start()
+    self.workers.append(proc)
+    self.counters['started'] += 1
+    logger.info('Started worker {}'.format(proc.pid))
+
+  def _reap(self):
+    for proc in list(self.workers):
+      if not proc.is_alive():
+        proc.join()
+        self.workers.remove(proc)
+        self.counters['crashed'] += 1
+        # instances launched by a worker running jobs in-process were held under its pid
+        recovery.releaseWorkerInstances(self.conn, scheduling.holderName(self.name, proc.pid), self.terminate_blocks)
+        logger.warning('Worker {} exited with code {}, replacing it'.format(proc.pid, proc.exitcode))
+        self._recordDecision(len(self.workers) + 1, len(self.workers), None, None, 'worker crashed')
+    for proc in list(self.draining):
+      if not proc.is_alive():
+        proc.join()
+        self.draining.remove(proc)
+
+  def _recover(self):
+    if self.max_recoveries == None:
+      return
+    now = time.time()
+    if self._recovered_at != None and now - self._recovered_at < self.recovery_interval:
+      return
+    self._recovered_at = now
+    for job_id in recovery.recoverOrphans(self.conn, self.queue_names, self.max_recoveries, self.terminate_blocks):
+      logger.warning('Recovered job {} orphaned by a lost worker'.format(job_id))
+
+  def _idleWorkers(self):
+    """Returns worker processes which aren't running a job, per their RQ worker state"""
+    idle_pids = set(
+      worker.pid for worker in Worker.all(connection=self.conn)
+      if as_text(worker.hostname) == self.name and worker.get_state() == 'idle')
+    return [proc for proc in self.workers if proc.pid in idle_pids]
+
+  def _drain(self, procs):
+    for proc in procs:
+      os.kill(proc.pid, signal.SIGTERM)
+      self.workers.remove(proc)
+      self.draining.append(proc)
+      self.counters['drained'] += 1
+      logger.info('Draining worker {}'.format(proc.pid))
+    return procs
+
+  def _requestStop(self, signum, frame):
+    self._stopping = True
+
+  def _recordDecision(self, from_workers, to_workers, queued, running, reason):
+    decision = {
+      'time': time.time(),
+      'from': from_workers,
+      'to': to_workers,
+      'queued': queued,
+      'running': running,
+      'reason': reason,
+    }
+    logger.info('Scaling decision: {}'.format(decision))
+    pipeline = self.conn.pipeline(transaction=False)
+    pipeline.lpush(DECISIONS_KEY.format(self.name), json.dumps(decision))
+    pipeline.ltrim(DECISIONS_KEY.format(self.name), 0, MAX_DECISIONS - 1)
+    pipeline.execute()
+
+  def _writeStats(self, desired, queued, running):
+    stats = dict(self.counters)
+    stats.update({
+      'workers': len(self.workers),
+      'draining': len(self.draining),
+      'desired': desired,
+      'min_workers': self.min_workers,
+      'max_workers': self.max_workers,
+      'queued': queued,
+      'running': running,
+      'updated_at': time.time(),
+    })
+    # expires if the supervisor dies
+    self.conn.set(STATS_KEY.format(self.name), json.dumps(stats), ex=max(60, int(self.interval * 10)))
+
+def _workerMain(target, args):
+  # leave the supervisor's process group, so a ctrl-c meant for the supervisor doesn't reach the workers,
+  # which are drained by the supervisor instead
+  os.setpgrp()
+  target(*args)
+
+def getStats(conn, recent_decisions=10):
+  """Returns the stats and recent scaling decisions of each running supervisor, by host"""
+  supervisors = {}
+  for key in conn.scan_iter(match=STATS_KEY.format('*')):
+    key = key.decode()
+    if key.endswith(':decisions'):
+      continue
+    raw = conn.get(key)
+    if raw == None:
+      continue
+    name = key[len(STATS_KEY.format('')):]
+    stats = json.loads(raw)
+    stats['decisions'] = [json.loads(d) for d in conn.lrange(DECISIONS_KEY.format(name), 0, recent_decisions - 1)]
+    supervisors[name] = stats
+  return supervisors
@@ -0,0 +1,137 @@
+"""Cache of access token introspections, so authenticated requests don't each wait on Globus Auth"""
+import collections
+import hashlib
+import threading
+import time
+
+class TokenIntrospectionCache():
+  """Thread-safe LRU cache of token introspection results
+
+  Active tokens are cached for `ttl` seconds, but never past the token's own expiry (`exp`), so a cached
+  result can't outlive the token. Inactive tokens are cached for `negative_ttl` seconds, so clients retrying
+  with a bad token don't hammer the auth server either. Concurrent lookups of a token which isn't cached
+  wait for a single introspection instead of each making their own.
+
+  Tokens are keyed by their sha256 digest so the cache doesn't hold them in memory.
+  """
+  def __init__(self, introspect, ttl=60, negative_ttl=10, max_size=10000):
+    """
+    Args:
+      introspect(callable): returns the introspection dict of a token, eg with keys active, username and exp
+      ttl(float): max seconds to cache the result of an active token
+      negative_ttl(float): seconds to cache the result of an inactive token
+      max_size(int): max number of cached tokens; least recently used tokens are evicted first
+    """
+    self.introspect = introspect
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self.max_size = max_size
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()
+    # introspections in progress, by token key
+    self._pending = {}
+    self._counters = {'hits': 0, 'misses': 0, 'collapsed': 0, 'evictions': 0, 'errors': 0}
+
+  @staticmethod
+  def key(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+  def get(self, token):
+    """Get the introspection of a token, from the cache or the auth server
+
+    Raises:
+      Exception: when introspecting the token fails; failures aren't cached
+    """
+    key = self.key(token)
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry != None:
+        expires_at, data = entry
+        if expires_at > time.time():
+          self._entries.move_to_end(key)
+          self._counters['hits'] += 1
+          return data
+        del self._entries[key]
+      pending = self._pending.get(key)
+      if pending == None:
+        pending = self._pending[key] = _PendingIntrospection()
+        leader = True
+        self._counters['misses'] += 1
+      else:
+        leader = False
+        self._counters['collapsed'] += 1
+
+    if not leader:
+      return pending.wait()
+
+    try:
+      data = self.introspect(token)
+    except Exception as e:
+      with self._lock:
+        self._counters['errors'] += 1
+        del self._pending[key]
+      pending.fail(e)
+      raise
+    with self._lock:
+      self._put(key, data)
+      del self._pending[key]
+    pending.succeed(data)
+    return data
+
+  def _put(self, key, data):
+    now = time.time()
+    if data.get('active', False) == True:
+      expires_at = now + self.ttl
+      if data.get('exp') != None:
+        expires_at = min(expires_at, float(data['exp']))
+    else:
+      expires_at = now + self.negative_ttl
+    if expires_at <= now:
+      return
+    self._entries[key] = (expires_at, data)
+    self._entries.move_to_end(key)
+    while len(self._entries) > self.max_size:
+      self._entries.popitem(last=False)
+      self._counters['evictions'] += 1
+
+  def stats(self):
+    with self._lock:
+      stats = dict(self._counters)
+      stats['size'] = len(self._entries)
+    lookups = stats['hits'] + stats['misses'] + stats['collapsed']
+    stats['hit_rate'] = (stats['hits'] + stats['collapsed']) / lookups if lookups > 0 else None
+    return stats
+
+class _PendingIntrospection():
+  """Result of an introspection in progress, shared with the lookups waiting on it"""
+  def __init__(self):
+    self._done = threading.Event()
+    self._data = None
+    self._error = None
+
+  def succeed(self, data):
+    self._data = data
+    self._done.set()
+
+  def fail(self, error):
+    self._error = error
+    self._done.set()
+
+  def wait(self):
+    self._done.wait()
+    if self._error != None:
+      raise self._error
+    return self._data
+
+def stubIntrospect(tokens, lifetime=3600):
+  """Returns an offline introspection function, for testing auth without Globus
+
+  Args:
+    tokens(dict): usernames of the valid tokens, by token
+    lifetime(float): seconds until a token expires, from when it's introspected
+  """
+  def introspect(token):
+    if token not in tokens:
+      return {'active': False}
+    return {'active': True, 'username': tokens[token], 'exp': int(time.time() + lifetime)}
+  return introspect
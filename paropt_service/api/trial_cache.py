@@ -0,0 +1,84 @@
+import datetime
+
+class TrialCache():
+  """Lookup of already measured trials of an experiment by parameter configuration
+
+  The cache is filled from the experiment's stored trials when a run starts and with each trial the run
+  records, so configurations measured by earlier runs (or earlier in the same run) aren't dispatched again.
+  Trials are scoped to one experiment, which pins the compute they were measured on.
+
+  Trials recorded since `resume_since` are always reused, regardless of ttl and force, so a run resumed after
+  losing its worker doesn't measure its own trials again.
+
+  Trials the run measured but hasn't saved yet have no timestamp; they're aged from when they were added.
+  """
+  def __init__(self, ttl=None, force=False, resume_since=None):
+    """
+    Args:
+      ttl(float): max age in seconds of a trial to reuse; None to reuse trials of any age
+      force(bool): never reuse trials, re-measuring every configuration
+      resume_since(datetime): UTC time the resumed run first started; None if the run isn't resumed
+    """
+    self.ttl = ttl
+    self.force = force
+    self.resume_since = resume_since
+    self.hits = 0
+    self.misses = 0
+    # (trial, UTC time it was recorded) by key
+    self._trials = {}
+
+  @staticmethod
+  def key(parameter_configs):
+    return tuple(sorted((config.parameter.name, float(config.value)) for config in parameter_configs))
+
+  def add(self, trial):
+    """Add a recorded trial, replacing older trials of the same configuration"""
+    if trial.outcome == None:
+      return
+    key = self.key(trial.parameter_configs)
+    # trial timestamps are UTC
+    recorded_at = trial.timestamp if trial.timestamp != None else datetime.datetime.utcnow()
+    cached = self._trials.get(key)
+    if cached == None or recorded_at >= cached[1]:
+      self._trials[key] = (trial, recorded_at)
+
+  def load(self, trials):
+    for trial in trials:
+      self.add(trial)
+
+  def reusesStored(self):
+    """Returns False if no stored trial would be reused, so there's no need to load any"""
+    return not self.force or self.resume_since != None
+
+  def reusableSince(self):
+    """Returns the UTC time of the oldest stored trial which could be reused; None for trials of any age"""
+    if self.force:
+      return self.resume_since
+    if self.ttl == None:
+      return None
+    oldest = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl)
+    return min(oldest, self.resume_since) if self.resume_since != None else oldest
+
+  def get(self, parameter_configs):
+    """Get the stored trial for a configuration
+
+    Returns:
+      trial(Trial): stored trial; None on a miss, if it's older than ttl, or if force is set (unless it was
+        recorded since resume_since)
+    """
+    trial, recorded_at = self._trials.get(self.key(parameter_configs), (None, None))
+    resumed = trial != None and self.resume_since != None and recorded_at >= self.resume_since
+    if not resumed:
+      if self.force:
+        trial = None
+      elif (trial != None and self.ttl != None and
+          datetime.datetime.utcnow() - recorded_at > datetime.timedelta(seconds=self.ttl)):
+        trial = None
+    if trial == None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return trial
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses}
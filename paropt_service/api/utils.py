@@ -1,8 +1,37 @@
 from functools import wraps
 import os
-from flask import session, request, redirect, url_for
+import threading
+from flask import session, request, redirect, url_for, g
 
-from config import _load_funcx_client, in_production
+from config import (_load_funcx_client, in_production, TOKEN_INTROSPECTION, STUB_TOKENS, TOKEN_CACHE_TTL,
+  TOKEN_CACHE_NEGATIVE_TTL, TOKEN_CACHE_SIZE)
+from .token_cache import TokenIntrospectionCache, stubIntrospect
+
+# the stub backend is for testing auth, so it's checked outside of production too
+_check_auth = in_production or TOKEN_INTROSPECTION == 'stub'
+
+_token_cache = None
+_token_cache_lock = threading.Lock()
+
+def getTokenCache():
+  """Returns the process's token introspection cache, creating it (and its auth client) on first use"""
+  global _token_cache
+  with _token_cache_lock:
+    if _token_cache == None:
+      if TOKEN_INTROSPECTION == 'stub':
+        introspect = stubIntrospect(STUB_TOKENS)
+      elif TOKEN_INTROSPECTION == 'globus':
+        # one client for all requests, reusing its http connections
+        client = _load_funcx_client()
+        introspect = lambda token: client.oauth2_token_introspect(token).data
+      else:
+        raise ValueError("Unknown token introspection backend '{}'".format(TOKEN_INTROSPECTION))
+      _token_cache = TokenIntrospectionCache(
+        introspect,
+        ttl=TOKEN_CACHE_TTL,
+        negative_ttl=TOKEN_CACHE_NEGATIVE_TTL,
+        max_size=TOKEN_CACHE_SIZE)
+    return _token_cache
 
 def login_required(f):
   @wraps(f)
@@ -11,19 +40,23 @@ def login_required(f):
     # if not in_production:
     #   return f(*args, **kwargs)
     # if user already has auth'd session, continue call
-    if not in_production or session.get('is_authenticated') == True:
+    if not _check_auth or session.get('is_authenticated') == True:
       return f(*args, **kwargs)
     # if use set Authorization header, check if token is valid
     elif 'Authorization' in request.headers:
       at = request.headers.get('Authorization').replace('Bearer', '').strip()
       if at:
-        client = _load_funcx_client()
-        data = client.oauth2_token_introspect(at)
+        data = getTokenCache().get(at)
         if data.get('active', False) != True:
           return "Invalid token - token not active for client", 401
         else: # valid token
+          g.username = data.get('username')
           return f(*args, **kwargs)
     # no auth, redirect to login
     else:
       return redirect(url_for('login', next=request.url))
   return decorated_function
+
+def currentUser():
+  """Returns the username of the authenticated user of the request; None if unknown (eg in development)"""
+  return g.get('username', session.get('username'))
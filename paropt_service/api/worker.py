@@ -0,0 +1,114 @@
+import os
+import socket
+import threading
+import time
+
+from rq import Worker
+from rq.job import Job
+from rq.exceptions import NoSuchJobError
+from rq.registry import StartedJobRegistry
+from rq.utils import utcnow
+from rq.worker import WorkerStatus
+
+from . import job_index, scheduling, recovery, events
+
+class ParoptWorker(Worker):
+  """RQ worker which keeps the experiment job index up to date as jobs finish or fail
+
+  With `fork_jobs` off, jobs run in the worker process instead of a forked work horse, so state kept by
+  the process (eg the compute pool's warm blocks) carries over from one job to the next.
+
+  With `queue_weights`, the worker takes jobs from its queues in weighted random order instead of always
+  emptying the first queue, so lower priority queues aren't starved.
+
+  With `lease_ttl`, the worker holds a lease on the job it's running, renewed with its heartbeats, so the job
+  can be recovered if the worker dies (see recovery). The job's started registry entry then never expires,
+  since the lease tells whether it's still running.
+
+  When a work horse is killed (eg out of memory), the EC2 instances it held are released and its blocks shut
+  down with `terminate_blocks`, as its own cleanup never ran.
+  """
+
+  def __init__(self, *args, fork_jobs=True, queue_weights=None, lease_ttl=None, terminate_blocks=None, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.fork_jobs = fork_jobs
+    self.queue_weights = queue_weights
+    self.lease_ttl = lease_ttl
+    self.terminate_blocks = terminate_blocks
+    self._leased_job_id = None
+
+  def dequeue_job_and_maintain_ttl(self, timeout):
+    if self.queue_weights != None:
+      self.queues = scheduling.weightedOrder(self.queues, self.queue_weights)
+    return super().dequeue_job_and_maintain_ttl(timeout)
+
+  def prepare_job_execution(self, job, heartbeat_ttl=None):
+    scheduling.jobStarted(self.connection, job.origin, job.id)
+    if job.enqueued_at != None:
+      job.meta['queue_wait_seconds'] = (utcnow() - job.enqueued_at).total_seconds()
+    # kept when a recovered job is started again, so it can resume from the trials recorded since
+    job.meta.setdefault('first_started_at', time.time())
+    job.save_meta()
+    super().prepare_job_execution(job, heartbeat_ttl=heartbeat_ttl)
+    if self.lease_ttl != None:
+      StartedJobRegistry(job.origin, self.connection, job_class=self.job_class).add(job, -1)
+    events.publishJob(self.connection, job, 'started')
+
+  def heartbeat(self, timeout=None, pipeline=None):
+    super().heartbeat(timeout=timeout, pipeline=pipeline)
+    if self._leased_job_id != None:
+      recovery.renewLease(self.connection, self._leased_job_id, self.lease_ttl)
+
+  def execute_job(self, job, queue):
+    if self.lease_ttl == None:
+      return self._executeJob(job, queue)
+    # the lease is taken before the job is added to the started registry, so it's never seen without one
+    recovery.renewLease(self.connection, job.id, self.lease_ttl)
+    self._leased_job_id = job.id
+    try:
+      return self._executeJob(job, queue)
+    finally:
+      self._leased_job_id = None
+      recovery.releaseLease(self.connection, job.id)
+
+  def _executeJob(self, job, queue):
+    if self.fork_jobs:
+      return super().execute_job(job, queue)
+    self.set_state(WorkerStatus.BUSY)
+    # the worker isn't free to send heartbeats while it runs the job, like it does while monitoring a work horse
+    done = threading.Event()
+    heartbeat = threading.Thread(target=self._heartbeatUntil, args=(done,), daemon=True)
+    heartbeat.start()
+    try:
+      self.perform_job(job, queue, heartbeat_ttl=self.job_monitoring_interval + 5)
+    finally:
+      done.set()
+      heartbeat.join()
+    self.set_state(WorkerStatus.IDLE)
+
+  def _heartbeatUntil(self, done):
+    while not done.wait(self.job_monitoring_interval):
+      self.heartbeat(self.job_monitoring_interval + 5)
+
+  def handle_job_success(self, job, queue, started_job_registry):
+    super().handle_job_success(job, queue, started_job_registry)
+    job_index.releaseJob(self.connection, job)
+    events.publishJob(self.connection, job, 'finished')
+
+  def handle_job_failure(self, job, started_job_registry=None, exc_string=''):
+    # also called by the worker when the work horse is terminated unexpectedly
+    super().handle_job_failure(job, started_job_registry=started_job_registry, exc_string=exc_string)
+    self._releaseHorseInstances(job)
+    job_index.releaseJob(self.connection, job)
+    events.publishJob(self.connection, job, 'failed')
+
+  def _releaseHorseInstances(self, job):
+    """Release the instances held by the job's work horse if it was lost; a process running the job (the
+    work horse itself, or this worker with fork_jobs off) releases its own when the run ends"""
+    try:
+      # the work horse recorded its holder after this worker fetched the job
+      holder = Job.fetch(job.id, connection=self.connection).meta.get('instance_holder')
+    except NoSuchJobError:
+      return
+    if holder != None and holder != scheduling.holderName(socket.gethostname(), os.getpid()):
+      recovery.releaseWorkerInstances(self.connection, holder, self.terminate_blocks)
@@ -0,0 +1,22 @@
+"""Checks of the environment parsl blocks run trials in"""
+import pkg_resources
+
+from parsl.app.app import python_app
+
+def pinnedVersion():
+  """Returns the version of paropt installed on the server, which blocks must match; None if unknown"""
+  try:
+    return pkg_resources.get_distribution('paropt').version
+  except pkg_resources.DistributionNotFound:
+    return None
+
+@python_app
+def workerInfo():
+  """Describe the block running this app. Runs on the block, so imports are done here"""
+  import socket
+  import pkg_resources
+  try:
+    version = pkg_resources.get_distribution('paropt').version
+  except pkg_resources.DistributionNotFound:
+    version = None
+  return {'hostname': socket.gethostname(), 'paropt_version': version}
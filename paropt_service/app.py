@@ -1,17 +1,21 @@
 import argparse
-from multiprocessing import Process
+import logging
+import socket
 import sys
 
 from flask import (Flask, request, flash, redirect, session, url_for)
 
 import redis
 from rq import Connection, Worker, Queue
-from rq.registry import StartedJobRegistry
-from rq.job import Job
 
 from api.api import api
 from api.paropt_manager import ParoptManager
-from config import SECRET_KEY, _load_funcx_client, SERVER_DOMAIN, GLOBUS_CLIENT
+from api.worker import ParoptWorker
+from api import recovery
+from api.supervisor import WorkerSupervisor
+from config import (SECRET_KEY, _load_funcx_client, SERVER_DOMAIN, GLOBUS_CLIENT, REDIS_URL, QUEUE_NAMES, QUEUE_WEIGHTS,
+    SUPERVISOR_INTERVAL, SCALE_DOWN_DELAY, JOB_LEASE_TTL, RECOVERY_INTERVAL, MAX_JOB_RECOVERIES, in_production,
+    terminateAWSInstances)
 
 
 app = Flask(__name__)
@@ -65,7 +69,8 @@ def callback():
         print(id_token)
         session.update(
             tokens=tokens.by_resource_server,
-            is_authenticated=True
+            is_authenticated=True,
+            username=id_token.get('preferred_username')
         )
 
         return redirect(f'https://{SERVER_DOMAIN}')
@@ -109,8 +114,8 @@ def logout():
 
 app.secret_key = SECRET_KEY
 app.config['SESSION_TYPE'] = 'filesystem'
-app.config['REDIS_URL'] = 'redis://redis:6379/0'
-app.config['QUEUES'] = ['default']
+app.config['REDIS_URL'] = REDIS_URL
+app.config['QUEUES'] = QUEUE_NAMES
 
 def setupAWS():
     # launch a small parsl job on AWS to initialize parsl's AWS VPC stuff
@@ -185,22 +190,34 @@ def setupAWS():
     from shutil import copyfile
     copyfile("awsproviderstate.json", f'{container_state_file_dir}/awsproviderstate.json') 
 
-def startWorker(redis_url, queues):
+def startWorker(queues):
     ParoptManager.start()
-    redis_connection = redis.from_url(redis_url)
-    with Connection(redis_connection):
-        worker = Worker(queues)
+    with Connection(ParoptManager.getRedis()):
+        # with a compute pool (COMPUTE_IDLE_TIMEOUT > 0), keep jobs in the worker process so consecutive runs
+        # can reuse its warm compute; otherwise fork a work horse per job as rq does
+        worker = ParoptWorker(
+            queues,
+            fork_jobs=ParoptManager.compute_pool == None,
+            queue_weights=QUEUE_WEIGHTS,
+            lease_ttl=JOB_LEASE_TTL,
+            terminate_blocks=terminateAWSInstances if in_production else None)
         worker.work()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run paropt server or workers.')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('--server', action='store_true', help='run as server')
-    group.add_argument('--workers', type=int, help='number of workers to start')
+    group.add_argument('--dev-server', action='store_true', help='run the flask development server, with debug mode and reloading')
+    group.add_argument('--workers', type=int, help='number of workers to start; the minimum number with --max-workers')
     group.add_argument('--setupaws', action='store_true', help='launch a single small job to setup awsproviderstate.json; intended to be used with `docker run ...` before first run of production server')
+    parser.add_argument('--max-workers', type=int, help='scale workers up to this number while jobs are waiting')
     args = parser.parse_args()
 
     if args.server:
+        # worker processes start the manager after they're forked
+        from wsgi_server import ParoptServer
+        ParoptServer(app).run()
+    elif args.dev_server:
         ParoptManager.start()
         app.run(debug=True, host="0.0.0.0", port=8080, use_reloader=False, ssl_context='adhoc')
     elif args.setupaws:
@@ -210,19 +227,31 @@ if __name__ == "__main__":
         if args.workers <= 0:
             print("Error: --workers must be an integer > 0")
             sys.exit(1)
+        max_workers = args.max_workers if args.max_workers != None else args.workers
+        if max_workers < args.workers:
+            print("Error: --max-workers must be at least --workers")
+            sys.exit(1)
         
-        redis_url = app.config['REDIS_URL']
-        # clear previously started started jobs - if shut down while running a job, the job will remain in StartedJobsRegistry
-        # when it's restarted, which is a problem because it's not actually running anymore
-        with Connection(redis.from_url(redis_url)) as conn:
-            registry = StartedJobRegistry('default', connection=conn)
-            for job_id in registry.get_job_ids():
-                registry.remove(Job.fetch(job_id, connection=conn))
-
-        procs = []
-        for i in range(args.workers):
-            procs.append(Process(target=startWorker,
-                                 args=(redis_url, app.config['QUEUES'])))
-            procs[i].start()
-        for proc in procs:
-            proc.join()
+        logging.basicConfig(level=logging.INFO)
+        conn = redis.from_url(app.config['REDIS_URL'])
+        terminate_blocks = terminateAWSInstances if in_production else None
+        # workers of this host which held instances before a restart are gone; other hosts' runs may be live
+        for holder in recovery.releaseDeadLocalHolders(conn, socket.gethostname(), terminate_blocks):
+            logging.warning('Released EC2 instances held by dead process {}'.format(holder))
+
+        # keeps the workers running, replacing crashed ones and scaling with the number of jobs. Jobs left
+        # running by workers which died (eg before a restart) are requeued by its checks once their
+        # leases expire; jobs of workers still alive on other hosts are left alone
+        supervisor = WorkerSupervisor(
+            conn,
+            target=startWorker,
+            args=(app.config['QUEUES'],),
+            queue_names=app.config['QUEUES'],
+            min_workers=args.workers,
+            max_workers=max_workers,
+            interval=SUPERVISOR_INTERVAL,
+            scale_down_delay=SCALE_DOWN_DELAY,
+            max_recoveries=MAX_JOB_RECOVERIES,
+            recovery_interval=RECOVERY_INTERVAL,
+            terminate_blocks=terminate_blocks)
+        supervisor.run()
@@ -2,13 +2,18 @@ import psycopg2.extras
 import globus_sdk
 import psycopg2
 import os
+import json
+import multiprocessing
+import urllib.parse
 import urllib.request
 
+import boto3
+
 from parsl.launchers import SingleNodeLauncher
 from parsl.channels import SSHInteractiveLoginChannel, LocalChannel
 from parsl.providers import CobaltProvider, LocalProvider, AWSProvider
 from parsl.config import Config
-from parsl.executors import HighThroughputExecutor
+from parsl.executors import HighThroughputExecutor, ThreadPoolExecutor
 from parsl.executors.ipp import IPyParallelExecutor
 from parsl.executors.ipp_controller import Controller
 
@@ -18,7 +23,109 @@ public_ip = os.getenv('PUBLIC_IP')
 _domain = os.getenv('SERVER_DOMAIN')
 SERVER_DOMAIN = _domain if _domain != None else f'{public_ip}:8080'
 
-def getAWSConfig():
+# max number of trials an experiment run can evaluate at once
+MAX_TRIAL_CONCURRENCY = int(os.environ.get('MAX_TRIAL_CONCURRENCY', 8))
+
+# job queues by priority, and the relative rate at which workers take jobs from each
+QUEUE_NAMES = ['high', 'default', 'low']
+DEFAULT_QUEUE = 'default'
+QUEUE_WEIGHTS = {
+  name: float(weight)
+  for name, weight in (item.split(':') for item in os.environ.get('QUEUE_WEIGHTS', 'high:6,default:3,low:1').split(','))
+}
+# what jobs are fair shared between within a queue: 'user' or 'tool'
+FAIR_SHARE_BY = os.environ.get('FAIR_SHARE_BY', 'user')
+# max EC2 instances launched by all workers at once; 0 for no limit
+MAX_EC2_INSTANCES = int(os.environ.get('MAX_EC2_INSTANCES', 0))
+
+# seconds between the worker supervisor's scaling checks, and seconds there must be more workers than jobs
+# before it drains idle workers
+SUPERVISOR_INTERVAL = float(os.environ.get('SUPERVISOR_INTERVAL', 5))
+SCALE_DOWN_DELAY = float(os.environ.get('SCALE_DOWN_DELAY', 60))
+
+# seconds a worker's lease on its running job lasts without a heartbeat; must be longer than the 30s between
+# heartbeats of a busy worker
+JOB_LEASE_TTL = float(os.environ.get('JOB_LEASE_TTL', 120))
+# seconds between the worker supervisor's checks for jobs orphaned by dead workers, and times an orphaned job
+# is requeued before it's failed instead
+RECOVERY_INTERVAL = float(os.environ.get('RECOVERY_INTERVAL', 30))
+MAX_JOB_RECOVERIES = int(os.environ.get('MAX_JOB_RECOVERIES', 2))
+
+# seconds a worker keeps the blocks of its last run alive for the next run with the same compute;
+# 0 (default) launches and shuts down blocks for each run.
+# Keeping blocks alive means workers run jobs in their own process instead of a forked work horse, so a job
+# which crashes or leaks memory takes the worker down with it, and a killed job can't be cleaned up by the
+# worker; only turn it on when saving instance boot time is worth losing that isolation
+COMPUTE_IDLE_TIMEOUT = float(os.environ.get('COMPUTE_IDLE_TIMEOUT', 0))
+
+# how EC2 blocks get paropt before running trials:
+#   git: pip install from github, at PAROPT_GIT_REF if set
+#   wheelhouse: pip install offline from the pre-built wheels (paropt and its dependencies) at WORKER_WHEELHOUSE_URL
+#   image: paropt is already installed in the AMI
+WORKER_ENV = os.environ.get('WORKER_ENV', 'git')
+# per AMI overrides of WORKER_ENV as a json object, eg {"ami-0123": "image"}
+WORKER_ENVS = json.loads(os.environ.get('WORKER_ENVS', '{}'))
+PAROPT_GIT_REF = os.environ.get('PAROPT_GIT_REF')
+WORKER_WHEELHOUSE_URL = os.environ.get('WORKER_WHEELHOUSE_URL')
+# seconds to wait for the first block of a run to start and pass the environment check
+WORKER_SETUP_TIMEOUT = float(os.environ.get('WORKER_SETUP_TIMEOUT', 1800))
+
+# on-demand USD per hour of EC2 instance models, used for cost budgets of experiment runs
+EC2_HOURLY_PRICES = {
+  't2.micro': 0.0116,
+  't2.small': 0.023,
+  't2.medium': 0.0464,
+  't2.large': 0.0928,
+  't2.xlarge': 0.1856,
+  't2.2xlarge': 0.3712,
+  'c5.large': 0.085,
+  'c5.xlarge': 0.17,
+  'c5.2xlarge': 0.34,
+  'c5.4xlarge': 0.68,
+  'm5.large': 0.096,
+  'm5.xlarge': 0.192,
+  'm5.2xlarge': 0.384,
+  'm5.4xlarge': 0.768,
+}
+
+def getWorkerInit(image_id, paropt_version=None):
+  """Commands setting up paropt on a block, per the worker environment configured for its AMI
+
+  Args:
+    image_id(str): AMI of the block
+    paropt_version(str): version of paropt to install from a wheelhouse; None for the latest one there
+
+  Returns:
+    worker_init(str)
+  """
+  worker_env = WORKER_ENVS.get(image_id, WORKER_ENV)
+  if worker_env == 'image':
+    return ''
+  if worker_env == 'wheelhouse':
+    if WORKER_WHEELHOUSE_URL == None:
+      raise ValueError('WORKER_WHEELHOUSE_URL must be set for wheelhouse worker environments')
+    requirement = 'paropt=={}'.format(paropt_version) if paropt_version != None else 'paropt'
+    return 'pip3 install --no-index --find-links {} {}'.format(WORKER_WHEELHOUSE_URL, requirement)
+  if worker_env == 'git':
+    ref = '@{}'.format(PAROPT_GIT_REF) if PAROPT_GIT_REF else ''
+    return 'pip3 install git+https://git@github.com/macintoshpie/paropt{}'.format(ref)
+  raise ValueError("Unknown worker environment '{}'".format(worker_env))
+
+# region EC2 blocks are launched in
+AWS_REGION = 'us-east-2'
+
+def getAWSConfig(image_id='ami-073e3f122e47832bf', instance_type='t2.small', max_blocks=1, worker_init=None):
+  """Parsl config for running trials on EC2, one trial per instance
+
+  Args:
+    image_id(str): AMI of the instances; the default is an image with bio tools installed
+    instance_type(str): EC2 instance model
+    max_blocks(int): number of instances to launch, ie number of trials run at once
+    worker_init(str): commands setting up paropt on the instances; None for the AMI's configured environment
+
+  Returns:
+    Config
+  """
   return Config(
     executors=[
       HighThroughputExecutor(
@@ -27,16 +134,18 @@ def getAWSConfig():
         worker_port_range=(54000, 54050),
         interchange_port_range=(54051, 54100),
         cores_per_worker=1,
+        # one worker per node so that concurrent trials don't affect each other's timing
         max_workers=1,
         provider=AWSProvider(
-          image_id='ami-073e3f122e47832bf', # image with bio tools installed 
-          worker_init='pip3 install git+https://git@github.com/macintoshpie/paropt',
-          region='us-east-2',
+          image_id=image_id,
+          instance_type=instance_type,
+          worker_init=worker_init if worker_init != None else getWorkerInit(image_id),
+          region=AWS_REGION,
           key_name='testKeyPair',
           state_file='/etc/awsproviderstate.json',
           nodes_per_block=1,
-          init_blocks=1,
-          max_blocks=1,
+          init_blocks=max_blocks,
+          max_blocks=max_blocks,
           min_blocks=0,
           walltime='01:00:00',
         ),
@@ -45,6 +154,30 @@ def getAWSConfig():
     strategy=None,
   )
 
+def terminateAWSInstances(instance_ids):
+  """Terminate EC2 instances launched by getAWSConfig, eg the blocks of a worker which was lost"""
+  if len(instance_ids) > 0:
+    boto3.client('ec2', region_name=AWS_REGION).terminate_instances(InstanceIds=instance_ids)
+
+def getLocalConfig(max_threads=1):
+  """Parsl config for running trials on the worker's machine, for development and testing without AWS
+
+  Args:
+    max_threads(int): number of trials run at once
+
+  Returns:
+    Config
+  """
+  return Config(
+    executors=[
+      ThreadPoolExecutor(
+        label='local_threads',
+        max_threads=max_threads,
+      )
+    ],
+    strategy=None,
+  )
+
 GLOBUS_KEY = os.environ.get('globus_key')
 # IMPORTANT: these client id's must NOT be None due to their use in auth checking
 # This is why we set them to empty strings if missing
@@ -53,10 +186,106 @@ GLOBUS_CLIENT_NATIVE = os.environ.get('globus_client_native', '')
 
 SECRET_KEY = os.environ.get('secret_key')
 
+# production API server (app.py --server): address, worker processes, threads per worker, seconds to keep idle
+# connections open, seconds before a silent worker is restarted, seconds workers get to finish requests when
+# reloaded or stopped, and requests a worker serves before being replaced (0 for never)
+SERVER_BIND = os.environ.get('SERVER_BIND', '0.0.0.0:8080')
+WEB_WORKERS = int(os.environ.get('WEB_WORKERS', 2 * multiprocessing.cpu_count() + 1))
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 4))
+WEB_KEEPALIVE = int(os.environ.get('WEB_KEEPALIVE', 5))
+WEB_TIMEOUT = int(os.environ.get('WEB_TIMEOUT', 60))
+WEB_GRACEFUL_TIMEOUT = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+WEB_MAX_REQUESTS = int(os.environ.get('WEB_MAX_REQUESTS', 0))
+# comma separated addresses of proxies trusted to set X-Forwarded-* headers, eg one terminating TLS
+WEB_FORWARDED_ALLOW_IPS = os.environ.get('WEB_FORWARDED_ALLOW_IPS', '127.0.0.1')
+# TLS of the API server:
+#   adhoc: self-signed certificate made when the server starts
+#   files: certificate and key at TLS_CERT_FILE and TLS_KEY_FILE
+#   off: plain HTTP, eg behind a proxy terminating TLS
+SERVER_TLS = os.environ.get('SERVER_TLS', 'adhoc')
+TLS_CERT_FILE = os.environ.get('TLS_CERT_FILE')
+TLS_KEY_FILE = os.environ.get('TLS_KEY_FILE')
+
+# how bearer tokens are checked: 'globus' introspects them with Globus Auth, 'stub' accepts the tokens in
+# STUB_TOKENS (a json object of usernames by token), for testing auth offline; auth is checked in development
+# too when using the stub
+TOKEN_INTROSPECTION = os.environ.get('TOKEN_INTROSPECTION', 'globus')
+STUB_TOKENS = json.loads(os.environ.get('STUB_TOKENS', '{}'))
+# max seconds a token's introspection is cached (never past the token's expiry), seconds an inactive token's
+# introspection is cached, and max number of cached tokens
+TOKEN_CACHE_TTL = float(os.environ.get('TOKEN_CACHE_TTL', 60))
+TOKEN_CACHE_NEGATIVE_TTL = float(os.environ.get('TOKEN_CACHE_NEGATIVE_TTL', 10))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+
 DB_HOST = os.environ.get('DB_HOST')
 DB_USER = os.environ.get('DB_USER')
 DB_NAME = os.environ.get('DB_NAME')
 DB_PASSWORD = os.environ.get('DB_PASSWORD')
+# credentials are quoted so characters like '@', ':' or '/' in them don't break the url
+DB_URL = 'postgresql://{}:{}@{}/{}'.format(
+  urllib.parse.quote_plus(DB_USER or ''), urllib.parse.quote_plus(DB_PASSWORD or ''), DB_HOST, DB_NAME)
+# shared database connection pool, one per process: connections kept open, and extra connections opened when
+# they're all in use. A server process runs at most WEB_THREADS requests at once, so it never needs more than that.
+# Every process can open DB_POOL_SIZE + DB_MAX_OVERFLOW connections, so
+# (WEB_WORKERS + worker processes) * (DB_POOL_SIZE + DB_MAX_OVERFLOW) must stay below the database's connection
+# limit (max_connections, 100 by default on postgres)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', WEB_THREADS))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 0))
+# seconds to wait for a free connection when all are in use
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+# seconds after which connections are replaced, before the database or a proxy drops them; -1 for never
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+# test connections with a ping when they're checked out, replacing dropped ones
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+# trials measured by a run are saved in batches: once TRIAL_FLUSH_SIZE trials are waiting, or the oldest has
+# waited TRIAL_FLUSH_SECONDS
+TRIAL_FLUSH_SIZE = int(os.environ.get('TRIAL_FLUSH_SIZE', 20))
+TRIAL_FLUSH_SECONDS = float(os.environ.get('TRIAL_FLUSH_SECONDS', 30))
+
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://redis:6379/0')
+# shared redis connection pool, one per process
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 50))
+# seconds to wait for a free connection when all are in use
+REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', 10))
+REDIS_CONNECT_TIMEOUT = float(os.environ.get('REDIS_CONNECT_TIMEOUT', 5))
+# leave unset by default: rq workers block on the queue for minutes at a time
+_redis_socket_timeout = os.environ.get('REDIS_SOCKET_TIMEOUT')
+REDIS_SOCKET_TIMEOUT = float(_redis_socket_timeout) if _redis_socket_timeout else None
+# seconds a connection can be idle before it's checked with a PING when checked out
+REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get('REDIS_HEALTH_CHECK_INTERVAL', 30))
+
+# seconds between keep-alive comments on idle event streams, and seconds an event stream stays open before the
+# client has to reconnect (each open stream holds a server thread and a redis connection)
+EVENTS_KEEPALIVE = float(os.environ.get('EVENTS_KEEPALIVE', 15))
+EVENTS_MAX_SECONDS = float(os.environ.get('EVENTS_MAX_SECONDS', 3600))
+# max event streams open at once per server process; more are refused with 503. With gunicorn's gthread
+# workers each stream holds one of the WEB_THREADS threads until the client disconnects, so the default keeps
+# half of them for other requests. Serving many streams needs an async worker class (eg gevent) instead, where
+# a stream only holds a greenlet and this limit can be raised accordingly
+EVENTS_MAX_STREAMS = int(os.environ.get('EVENTS_MAX_STREAMS', max(1, WEB_THREADS // 2)))
+
+# min seconds between progress reports of a running job
+PROGRESS_INTERVAL = float(os.environ.get('PROGRESS_INTERVAL', 5))
+
+# max number of experiments cached by each process, and max seconds trial summaries are cached (they're also
+# invalidated as trials are saved)
+EXPERIMENT_CACHE_SIZE = int(os.environ.get('EXPERIMENT_CACHE_SIZE', 1000))
+TRIAL_SUMMARY_CACHE_TTL = int(os.environ.get('TRIAL_SUMMARY_CACHE_TTL', 300))
+
+# max number of experiments or runs in a request to the batch endpoints
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', 500))
+
+# page sizes for the job listing endpoints (/jobs/running, /jobs/failed, /jobs/queued) when paging with cursor or
+# limit; unpaged responses return all jobs
+JOBS_PAGE_SIZE = int(os.environ.get('JOBS_PAGE_SIZE', 100))
+JOBS_MAX_PAGE_SIZE = int(os.environ.get('JOBS_MAX_PAGE_SIZE', 1000))
+
+# page sizes for the trials endpoint when paging with limit or after_id; unpaged and streamed (ndjson) responses
+# aren't limited by default
+TRIALS_PAGE_SIZE = int(os.environ.get('TRIALS_PAGE_SIZE', 1000))
+TRIALS_MAX_PAGE_SIZE = int(os.environ.get('TRIALS_MAX_PAGE_SIZE', 10000))
+# number of trials loaded from the database per query when paging through trials
+TRIALS_CHUNK_SIZE = int(os.environ.get('TRIALS_CHUNK_SIZE', 500))
 
 _prod = in_production
 
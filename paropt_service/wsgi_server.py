@@ -0,0 +1,64 @@
+"""Production server for the API: gunicorn with threaded worker processes"""
+import os
+import tempfile
+
+from gunicorn.app.base import BaseApplication
+
+from api.paropt_manager import ParoptManager
+from config import (SERVER_BIND, WEB_WORKERS, WEB_THREADS, WEB_KEEPALIVE, WEB_TIMEOUT, WEB_GRACEFUL_TIMEOUT,
+  WEB_MAX_REQUESTS, WEB_FORWARDED_ALLOW_IPS, SERVER_TLS, TLS_CERT_FILE, TLS_KEY_FILE)
+
+def postFork(server, worker):
+  # redis and database connections can't be shared across a fork, so each worker process makes its own
+  ParoptManager.start()
+
+def getTLSFiles():
+  """Returns the cert and key files to serve TLS with per SERVER_TLS; (None, None) for plain HTTP"""
+  if SERVER_TLS == 'off':
+    return None, None
+  if SERVER_TLS == 'files':
+    if TLS_CERT_FILE == None or TLS_KEY_FILE == None:
+      raise ValueError('TLS_CERT_FILE and TLS_KEY_FILE must be set when SERVER_TLS is files')
+    return TLS_CERT_FILE, TLS_KEY_FILE
+  if SERVER_TLS == 'adhoc':
+    # self-signed cert, made once at start and shared by the workers
+    from werkzeug.serving import make_ssl_devcert
+    return make_ssl_devcert(os.path.join(tempfile.mkdtemp(), 'paropt'), host='localhost')
+  raise ValueError("Unknown SERVER_TLS '{}'".format(SERVER_TLS))
+
+class ParoptServer(BaseApplication):
+  """Serves a WSGI app with gunicorn, configured from config.py
+
+  Requests are handled by WEB_WORKERS processes with WEB_THREADS threads each, keeping connections alive
+  for WEB_KEEPALIVE seconds. SIGHUP gracefully reloads the workers: new workers are started and old ones
+  finish their requests (for up to WEB_GRACEFUL_TIMEOUT seconds) before exiting. SIGTERM shuts down the same way.
+  """
+  def __init__(self, app):
+    self.application = app
+    super().__init__()
+
+  def load_config(self):
+    certfile, keyfile = getTLSFiles()
+    options = {
+      'bind': SERVER_BIND,
+      'workers': WEB_WORKERS,
+      'worker_class': 'gthread',
+      'threads': WEB_THREADS,
+      'keepalive': WEB_KEEPALIVE,
+      'timeout': WEB_TIMEOUT,
+      'graceful_timeout': WEB_GRACEFUL_TIMEOUT,
+      'max_requests': WEB_MAX_REQUESTS,
+      'max_requests_jitter': WEB_MAX_REQUESTS // 10,
+      'forwarded_allow_ips': WEB_FORWARDED_ALLOW_IPS,
+      'certfile': certfile,
+      'keyfile': keyfile,
+      # the app is loaded in the master, the manager's connections are made in each worker
+      'preload_app': True,
+      'post_fork': postFork,
+      'accesslog': '-',
+    }
+    for key, value in options.items():
+      self.cfg.set(key, value)
+
+  def load(self):
+    return self.application